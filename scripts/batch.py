@@ -0,0 +1,232 @@
+# scripts/batch.py
+import argparse
+import json
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import Any, Dict, List
+
+from scripts.connect import get_key_manager
+from scripts.auto_split import run_kaggle_cli
+from scripts.keyword_extract_book import extract_keywords_for_book
+from sgk_extract.les_top_pipeline import run_extract_save_split
+from sgk_extract.chunk_pipeline import run_extract_and_split_chunks_for_book
+from sgk_extract.pdf_output import project_root_from_here
+from sgk_extract.split_state import load_dirty
+from sgk_extract.state_db import close_state_db, open_state_db
+from sgk_extract.chunk_index import close_chunk_index
+
+# Kaggle dùng chung 1 kaggle_pack/ + 1 dataset => mỗi lúc chỉ 1 book được push
+_kaggle_lock = threading.Lock()
+# OCR local rất nặng RAM/CPU => mỗi lúc chỉ 1 book chạy postprocess local
+_ocr_lock = threading.Lock()
+_print_lock = threading.Lock()
+
+# giống prepare_workspace: Output/ luôn ở project root, không phụ thuộc cwd
+OUTPUT_ROOT = project_root_from_here() / "Output"
+
+
+def log(book_stem: str, *args) -> None:
+    with _print_lock:
+        print(f"[{book_stem}]", *args, flush=True)
+
+
+def discover_pdfs(input_dir: Path) -> List[Path]:
+    return sorted(p for p in input_dir.rglob("*.pdf") if p.is_file())
+
+
+def duplicate_stems(pdfs: List[Path]) -> Dict[str, List[Path]]:
+    """
+    Output/<book> đặt theo stem => 2 PDF cùng tên ở 2 thư mục con sẽ ghi đè nhau.
+    """
+    by_stem: Dict[str, List[Path]] = {}
+    for p in pdfs:
+        by_stem.setdefault(p.stem, []).append(p)
+    return {k: v for k, v in by_stem.items() if len(v) > 1}
+
+
+def _stage_done(book_dir: Path, stage: str) -> bool:
+    return open_state_db(book_dir).is_done("book", book_dir.name, stage)
+
+
+def run_book(
+    key_manager,
+    pdf_path: Path,
+    *,
+    model: str,
+    postprocess: str,
+    force: bool,
+    lesson_workers: int = 1,
+    direct: bool = False,
+    local_headings: bool = False,
+    ocr_workers: int = 1,
+    ocr_threads: int = 2,
+) -> Dict[str, Any]:
+    """
+    Chạy đủ stage cho 1 book, resume theo state db (Output/<book>/pipeline_state.sqlite):
+      book_split -> chunk_split -> postprocess (kaggle|local|skip) -> keywords
+    """
+    book_stem = pdf_path.stem
+    book_dir = OUTPUT_ROOT / book_stem
+    if force:
+        open_state_db(book_dir).invalidate("book", [book_stem])
+    result: Dict[str, Any] = {"book": book_stem, "pdf": str(pdf_path), "status": "ok", "stages": {}}
+
+    def timed(stage: str, fn):
+        t0 = time.perf_counter()
+        log(book_stem, f"-> {stage}")
+        try:
+            out = fn()
+        except Exception as e:
+            open_state_db(book_dir).record("book", book_stem, stage, "failed", sec=time.perf_counter() - t0, error=repr(e))
+            raise
+        sec = time.perf_counter() - t0
+        open_state_db(book_dir).record("book", book_stem, stage, "done", sec=sec)
+        result["stages"][stage] = {"sec": round(sec, 2)}
+        log(book_stem, f"<- {stage} ({sec:.1f}s)")
+        return out
+
+    try:
+        # 1) book_split (Gemini đọc mục lục + cắt topic/lesson)
+        if _stage_done(book_dir, "book_split") and (book_dir / f"{book_stem}.json").exists():
+            result["stages"]["book_split"] = {"skipped": True}
+        else:
+            _data, _json_path, split_result = timed(
+                "book_split",
+                lambda: run_extract_save_split(key_manager, str(pdf_path), model=model, lazy_lessons=direct),
+            )
+            result["stages"]["book_split"].update({
+                "topics": len(split_result["topics"]),
+                "lessons": len(split_result["lessons"]),
+            })
+
+        # 2) chunk_split (tự resume theo lesson)
+        chunk_summary = timed(
+            "chunk_split",
+            lambda: run_extract_and_split_chunks_for_book(
+                key_manager, book_dir, model=model, resume=True, workers=lesson_workers, direct=direct,
+                local_headings=local_headings,
+            ),
+        )
+        new_chunks = len(chunk_summary["chunk_pdf_files"])
+        result["stages"]["chunk_split"].update({
+            "new_chunks": new_chunks,
+            "skipped_lessons": len(chunk_summary["skipped_lessons"]),
+        })
+
+        # 3) postprocess: chỉ chạy lại khi có chunk mới / lesson dirty
+        need_pp = (
+            (not _stage_done(book_dir, "postprocess"))
+            or new_chunks > 0
+            or any("postprocess" in st for st in load_dirty(book_dir).values())
+        )
+        if postprocess == "skip" or not need_pp:
+            result["stages"]["postprocess"] = {"skipped": True}
+        elif postprocess == "kaggle":
+            def _kaggle():
+                with _kaggle_lock:
+                    # zip Kaggle trả về thay cả folder book (kèm state db mới) => đóng db đang mở
+                    close_state_db(book_dir)
+                    close_chunk_index(book_dir)
+                    run_kaggle_cli(book_stem, run_local=False, overwrite=True)
+                    close_state_db(book_dir)
+                    close_chunk_index(book_dir)
+            timed("postprocess", _kaggle)
+        else:
+            def _local():
+                with _ocr_lock:
+                    from sgk_extract.chunk_postprocess import run_postprocess_for_book
+                    return run_postprocess_for_book(book_dir, workers=ocr_workers, threads=ocr_threads)
+            pp = timed("postprocess", _local)
+            result["stages"]["postprocess"].update({k: pp[k] for k in ("ok", "skip", "fail")})
+
+        # 4) keywords (tự resume theo chunk)
+        kw = timed(
+            "keywords",
+            lambda: extract_keywords_for_book(key_manager=key_manager, book_dir=book_dir, model=model),
+        )
+        result["stages"]["keywords"].update(kw.to_dict())
+
+    except Exception as e:
+        result["status"] = "failed"
+        result["error"] = repr(e)
+        log(book_stem, "[FAIL]", repr(e))
+        traceback.print_exc()
+
+    return result
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Chạy pipeline cho mọi PDF trong 1 thư mục")
+    ap.add_argument("input_dir", nargs="?", default="Input")
+    ap.add_argument("--jobs", type=int, default=2, help="Số book chạy song song")
+    ap.add_argument("--lesson-workers", type=int, default=4, help="Số lesson/book gọi Gemini song song (<= số key)")
+    ap.add_argument("--config", default="config.env")
+    ap.add_argument("--model", default="gemini-2.5-flash-lite")
+    ap.add_argument("--postprocess", choices=["kaggle", "local", "skip"], default="kaggle")
+    ap.add_argument("--ocr-workers", type=int, default=1, help="Postprocess local: số process OCR (mỗi process 1 PaddleOCR)")
+    ap.add_argument("--ocr-threads", type=int, default=2, help="Postprocess local: số thread CPU / process OCR")
+    ap.add_argument("--force", action="store_true", help="Bỏ qua state của các stage cấp book, chạy lại mọi stage")
+    ap.add_argument("--local-headings", action="store_true", help="Dò mục chính bằng OCR local, chỉ gọi Gemini khi không chắc")
+    ap.add_argument("--direct", action="store_true", help="Cắt chunk thẳng từ PDF gốc, lesson PDF chỉ tạo khi upload")
+    ap.add_argument("--status", action="store_true", help="Chỉ in trạng thái các stage (đọc state db), không chạy")
+    args = ap.parse_args()
+
+    pdfs = discover_pdfs(Path(args.input_dir))
+    if not pdfs:
+        raise SystemExit(f"Không có PDF nào trong: {args.input_dir}")
+    dups = duplicate_stems(pdfs)
+    if dups:
+        lines = [f"  {stem}: " + ", ".join(str(p) for p in paths) for stem, paths in sorted(dups.items())]
+        raise SystemExit("Trùng tên PDF (Output/<tên> sẽ ghi đè nhau), đổi tên rồi chạy lại:\n" + "\n".join(lines))
+
+    if args.status:
+        for pdf in pdfs:
+            book_dir = OUTPUT_ROOT / pdf.stem
+            summary = open_state_db(book_dir).summary() if book_dir.exists() else {}
+            print(pdf.stem, json.dumps(summary, ensure_ascii=False))
+        return
+    print(f"Found {len(pdfs)} book(s), jobs={args.jobs}")
+
+    key_manager = get_key_manager(args.config)   # 1 key pool cho mọi book
+
+    t0 = time.perf_counter()
+    results: Dict[str, Dict[str, Any]] = {}
+    with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+        futs = {
+            pool.submit(
+                run_book, key_manager, pdf,
+                model=args.model, postprocess=args.postprocess, force=args.force,
+                lesson_workers=args.lesson_workers, direct=args.direct,
+                local_headings=args.local_headings,
+                ocr_workers=args.ocr_workers, ocr_threads=args.ocr_threads,
+            ): pdf
+            for pdf in pdfs
+        }
+        for fut in as_completed(futs):
+            res = fut.result()
+            results[res["book"]] = res
+
+    ordered = [results[p.stem] for p in pdfs]
+    summary = {
+        "books": len(ordered),
+        "ok": sum(1 for r in ordered if r["status"] == "ok"),
+        "failed": sum(1 for r in ordered if r["status"] != "ok"),
+        "wall_sec": round(time.perf_counter() - t0, 2),
+        "results": ordered,
+    }
+    out = OUTPUT_ROOT / "_batch_summary.json"
+    out.parent.mkdir(parents=True, exist_ok=True)
+    out.write_text(json.dumps(summary, ensure_ascii=False, indent=2), encoding="utf-8")
+
+    print("\n=== BATCH SUMMARY ===")
+    for r in ordered:
+        stages = ", ".join(f"{k}:{'skip' if v.get('skipped') else v.get('sec')}" for k, v in r["stages"].items())
+        print(f"{r['status']:6} | {r['book']} | {stages}" + (f" | {r.get('error')}" if r.get("error") else ""))
+    print(f"OK={summary['ok']} FAILED={summary['failed']} wall={summary['wall_sec']}s -> {out}")
+
+
+if __name__ == "__main__":
+    main()
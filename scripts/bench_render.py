@@ -0,0 +1,110 @@
+# scripts/bench_render.py
+"""
+Đo RAM đỉnh + thời gian / trang cho các kiểu render page0 của postprocess:
+  pil  : đường cũ (pdfium -> to_pil -> np.array -> cvtColor RGB2BGR, split/debug copy)
+  view : pdfium BGR -> to_numpy (view), split/debug dùng view
+  gray : như view nhưng render xám 1 kênh
+
+Mỗi mode chạy trong 1 process riêng (spawn) => peak RSS không lẫn nhau.
+
+  python -m scripts.bench_render Output/<book>/Chunk/<lesson>/chunk_02/<stem>.pdf --dpi 260
+"""
+import argparse
+import multiprocessing as mp
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+try:
+    import resource   # không có trên Windows => chỉ báo số tracemalloc
+except ImportError:
+    resource = None
+
+MODES = ("pil", "view", "gray")
+
+
+def _maxrss_mb() -> float:
+    if resource is None:
+        return 0.0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024   # macOS: byte, Linux: KB
+
+
+def _render_pil(pdf_path: Path, dpi: int):
+    import cv2
+    import numpy as np
+    import pypdfium2 as pdfium
+
+    pdf = pdfium.PdfDocument(str(pdf_path))
+    page = pdf.get_page(0)
+    rgb = np.array(page.render(scale=float(dpi) / 72.0).to_pil(), dtype=np.uint8)
+    page.close()
+    pdf.close()
+    return cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR)
+
+
+def _run_mode(mode: str, pdf_path: str, dpi: int, q) -> None:
+    # tắt render cache: đo đúng chi phí render
+    import os
+    os.environ["SGK_RENDER_CACHE_MB"] = "0"
+    from sgk_extract import chunk_postprocess as cp
+
+    pdf = Path(pdf_path)
+    line = {"x0": 50.0, "x1": 500.0, "y0": 400.0, "y1": 440.0}
+    base_rss = _maxrss_mb()
+
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    with tempfile.TemporaryDirectory() as td:
+        out = Path(td)
+        if mode == "pil":
+            img = _render_pil(pdf, dpi)
+            t_render = time.perf_counter() - t0
+            cp.draw_debug(img, line, 390, out / "dbg.png", label="bench")
+            # split kiểu cũ: copy top/bot
+            top, bot = img[:390].copy(), img[390:].copy()
+            cp.imwrite_unicode(out / "top.png", top)
+            cp.imwrite_unicode(out / "bot.png", bot)
+        else:
+            img = cp.render_pdf_page_to_bgr(pdf, 0, dpi, gray=(mode == "gray"))
+            t_render = time.perf_counter() - t0
+            cp.split_and_save(img, 390, out / "top.png", out / "bot.png")
+            cp.draw_debug(img, line, 390, out / "dbg.png", label="bench", inplace=True)
+        shape = tuple(img.shape)
+    total = time.perf_counter() - t0
+    _cur, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    q.put({
+        "mode": mode,
+        "shape": shape,
+        "render_sec": round(t_render, 3),
+        "total_sec": round(total, 3),
+        "traced_peak_mb": round(peak / (1024 * 1024), 1),
+        "rss_peak_delta_mb": round(_maxrss_mb() - base_rss, 1),
+    })
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark RAM đỉnh / trang của các kiểu render page0")
+    ap.add_argument("pdf", help="PDF chunk (đo trang 0)")
+    ap.add_argument("--dpi", type=int, default=260)
+    ap.add_argument("--modes", nargs="+", default=list(MODES), choices=list(MODES))
+    args = ap.parse_args()
+
+    ctx = mp.get_context("spawn")
+    q = ctx.Queue()
+    print(f"{'mode':5} | {'shape':>18} | render s | total s | traced peak MB | RSS peak +MB")
+    for mode in args.modes:
+        p = ctx.Process(target=_run_mode, args=(mode, args.pdf, args.dpi, q))
+        p.start()
+        r = q.get()
+        p.join()
+        print(f"{r['mode']:5} | {str(r['shape']):>18} | {r['render_sec']:8} | {r['total_sec']:7} | "
+              f"{r['traced_peak_mb']:14} | {r['rss_peak_delta_mb']:12}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+# scripts/check_layout_equiv.py
+"""
+So group_to_lines / find_heading_left_for_line (bản cửa sổ + bisect) với bản quét cũ
+trên 1 corpus dets: fixture trang thật (tests/fixtures/layout_dets.json) + dets trong
+Output/*/ocr_cache/ (nếu có) + trang tổng hợp dày (seed cố định).
+Lệch 1 trang => exit 1. In thêm thời gian 2 bản. Fixture cũng chạy trong tests/test_layout_equiv.py.
+
+  python -m scripts.check_layout_equiv [--synthetic 200] [--dets 350]
+"""
+import argparse
+import json
+import random
+import sys
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from sgk_extract import chunk_postprocess as cp
+
+Y_TOLS = (4.0, 10.0, 14.0, 22.0)
+FIXTURE = Path(__file__).resolve().parents[1] / "tests" / "fixtures" / "layout_dets.json"
+
+
+# ---------- bản cũ (tham chiếu) ----------
+def ref_group_to_lines(dets: List[Dict[str, Any]], y_tol: float) -> List[Dict[str, Any]]:
+    dets = sorted(dets, key=lambda d: (((d["y0"] + d["y1"]) * 0.5), d["x0"]))
+    groups: List[Dict[str, Any]] = []
+
+    for d in dets:
+        yc = 0.5 * (d["y0"] + d["y1"])
+        for g in groups:
+            if abs(yc - g["y_ref"]) <= y_tol:
+                g["items"].append(d)
+                g["y_ref"] = (g["y_ref"] * (len(g["items"]) - 1) + yc) / len(g["items"])
+                break
+        else:
+            groups.append({"y_ref": yc, "items": [d]})
+
+    lines: List[Dict[str, Any]] = []
+    for g in sorted(groups, key=lambda x: x["y_ref"]):
+        items = sorted(g["items"], key=lambda d: d["x0"])
+        x0 = min(it["x0"] for it in items)
+        x1 = max(it["x1"] for it in items)
+        y0 = min(it["y0"] for it in items)
+        y1 = max(it["y1"] for it in items)
+        text = " ".join(it["text"] for it in items)
+        lines.append({"items": items, "text": text, "x0": x0, "x1": x1, "y0": y0, "y1": y1})
+    return lines
+
+
+def ref_find_heading_left_for_line(heading_cands, ln, *, x_gap_max=220.0, min_v_overlap=0.25) -> Optional[Dict[str, Any]]:
+    best = None
+    for h in heading_cands:
+        if float(h["x1"]) > float(ln["x0"]) + 20:
+            continue
+        gap = float(ln["x0"]) - float(h["x1"])
+        if gap < 0 or gap > x_gap_max:
+            continue
+        ov = cp._v_overlap_ratio(float(h["y0"]), float(h["y1"]), float(ln["y0"]), float(ln["y1"]))
+        if ov < min_v_overlap:
+            continue
+        key = (gap, -ov)
+        if best is None or key < best[0]:
+            best = (key, h)
+    return best[1] if best else None
+
+
+# ---------- corpus ----------
+def fixture_pages() -> List[List[Dict[str, Any]]]:
+    data = json.loads(FIXTURE.read_text(encoding="utf-8"))
+    return [pg["dets"] for pg in data["pages"]]
+
+
+def cached_pages() -> List[List[Dict[str, Any]]]:
+    pages = []
+    for p in sorted(Path("Output").glob("*/ocr_cache/*/*.json")):
+        try:
+            dets = json.loads(p.read_text(encoding="utf-8")).get("dets")
+        except Exception:
+            continue
+        if isinstance(dets, list) and dets:
+            pages.append(dets)
+    return pages
+
+
+def synthetic_page(rng: random.Random, n_dets: int) -> List[Dict[str, Any]]:
+    """
+    Trang 1-2 cột, dòng lệch nhẹ, token heading rời ("1", "2.") bên trái, chữ lẫn box trùng toạ độ.
+    """
+    dets: List[Dict[str, Any]] = []
+    cols = rng.choice([1, 2])
+    col_w = 2000.0 / cols
+    y = 120.0
+    while len(dets) < n_dets:
+        h = rng.uniform(22.0, 48.0)
+        for c in range(cols):
+            x = 80.0 + c * col_w + rng.uniform(-4, 4)
+            if rng.random() < 0.15:
+                num = rng.randint(1, 5)
+                tok = f"{num}." if rng.random() < 0.6 else str(num)
+                dets.append({"x0": x, "y0": y + rng.uniform(-3, 3), "x1": x + 30, "y1": y + h, "text": tok, "score": 0.9})
+                x += 30 + rng.uniform(5, 260)
+            for _w in range(rng.randint(1, 4)):
+                w = rng.uniform(40, col_w / 3)
+                jy = rng.uniform(-h * 0.3, h * 0.3)
+                dets.append({"x0": x, "y0": y + jy, "x1": x + w, "y1": y + jy + h, "text": rng.choice(["Mạng", "máy", "TÍNH", "a", "Bài"]), "score": 0.9})
+                x += w + rng.uniform(8, 30)
+        y += h * rng.uniform(0.9, 1.8)
+    rng.shuffle(dets)
+    return dets
+
+
+def _line_sig(lines: List[Dict[str, Any]]):
+    return [([id(it) for it in ln["items"]], ln["text"], ln["x0"], ln["x1"], ln["y0"], ln["y1"]) for ln in lines]
+
+
+def compare_pages(pages: List[List[Dict[str, Any]]]) -> Dict[str, Any]:
+    """
+    Chạy 2 bản trên mọi trang x Y_TOLS x heading 1..5.
+    Return {"bad", "lines", "heading_hits", "t_ref", "t_new"}.
+    """
+    bad = lines = hits = 0
+    t_ref = t_new = 0.0
+    for pi, dets in enumerate(pages):
+        for y_tol in Y_TOLS:
+            t0 = time.perf_counter()
+            a = ref_group_to_lines(dets, y_tol)
+            t1 = time.perf_counter()
+            b = cp.group_to_lines(dets, y_tol)
+            t2 = time.perf_counter()
+            t_ref += t1 - t0
+            t_new += t2 - t1
+            lines += len(a)
+            if _line_sig(a) != _line_sig(b):
+                bad += 1
+                print(f"[DIFF] group_to_lines page={pi} y_tol={y_tol}")
+                continue
+
+            for hn in range(1, 6):
+                cands = cp.collect_heading_candidates(dets, hn)
+                index = cp.index_heading_candidates(cands)
+                # thêm line gom từ det không phải số heading (số lệch baseline => nằm line riêng)
+                titles = ref_group_to_lines(
+                    [d for d in dets if not cp.is_pure_heading_token(d.get("text", ""), hn)[0]], y_tol,
+                ) if cands else []
+                for ln in a + titles:
+                    t0 = time.perf_counter()
+                    ha = ref_find_heading_left_for_line(cands, ln)
+                    t1 = time.perf_counter()
+                    hb = cp.find_heading_left_for_line(cands, ln, index=index)
+                    t2 = time.perf_counter()
+                    t_ref += t1 - t0
+                    t_new += t2 - t1
+                    hits += ha is not None
+                    if (ha is None) != (hb is None) or (ha is not None and ha != hb):
+                        bad += 1
+                        print(f"[DIFF] find_heading_left page={pi} y_tol={y_tol} heading={hn} line_y0={ln['y0']:.1f}")
+    return {"bad": bad, "lines": lines, "heading_hits": hits, "t_ref": t_ref, "t_new": t_new}
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Kiểm tra layout engine mới cho kết quả y hệt bản cũ")
+    ap.add_argument("--synthetic", type=int, default=200, help="Số trang tổng hợp")
+    ap.add_argument("--dets", type=int, default=350, help="Số det / trang tổng hợp")
+    args = ap.parse_args()
+
+    rng = random.Random(1610)
+    fixture = fixture_pages()
+    real = cached_pages()
+    pages = fixture + real + [synthetic_page(rng, args.dets) for _ in range(args.synthetic)]
+    print(f"corpus: {len(fixture)} trang fixture + {len(real)} trang thật (ocr_cache) + {args.synthetic} trang tổng hợp")
+
+    res = compare_pages(pages)
+    t_ref, t_new = res["t_ref"], res["t_new"]
+    print(f"ref: {t_ref:.3f}s | new: {t_new:.3f}s | x{(t_ref / t_new) if t_new else 0:.1f}")
+    if res["bad"]:
+        print("FAIL:", res["bad"], "khác biệt")
+        sys.exit(1)
+    print("OK: khớp hoàn toàn")
+
+
+if __name__ == "__main__":
+    main()
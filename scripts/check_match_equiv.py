@@ -0,0 +1,237 @@
+# scripts/check_match_equiv.py
+"""
+So lõi match mới (sgk_extract/heading_match.py) với bản cũ (DP LCS, regex compile mỗi lần gọi):
+  - robust_match_count / lcs_len / HeadingMatcher.match trên chuỗi initials ngẫu nhiên (seed cố định)
+  - split_heading_prefix / has_dot_heading / is_pure_heading_token / initials trên text dòng
+    (text fixture trang thật tests/fixtures/layout_dets.json + Output/*/ocr_cache/ nếu có + text tổng hợp)
+Lệch 1 case => exit 1. Kèm micro-benchmark (µs / lần gọi). Bản rút gọn chạy trong tests/test_match_equiv.py.
+
+  python -m scripts.check_match_equiv [--cases 20000]
+"""
+import argparse
+import json
+import random
+import re
+import sys
+import time
+import unicodedata
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+from sgk_extract import heading_match as hm
+
+ALPHA = "BCDHKLMNTV"   # bảng chữ nhỏ => nhiều chữ trùng, LCS khó
+FIXTURE = Path(__file__).resolve().parents[1] / "tests" / "fixtures" / "layout_dets.json"
+
+
+# ---------- bản cũ (tham chiếu) ----------
+def ref_remove_diacritics(ch: str) -> Optional[str]:
+    if not ch:
+        return None
+    if ch == "Đ":
+        return "D"
+    if ch == "đ":
+        return None
+    if (not ch.isalpha()) or (not ch.isupper()):
+        return None
+    base = unicodedata.normalize("NFD", ch)
+    base = "".join(c for c in base if unicodedata.category(c) != "Mn")
+    if len(base) != 1 or (not base.isalpha()) or (not base.isupper()):
+        return None
+    return base
+
+
+def ref_initials(text: str) -> List[str]:
+    out: List[str] = []
+    for tok in re.findall(r"[0-9]+|[A-Za-zÀ-Ỵà-ỵĐđ]+", text or ""):
+        if tok.isdigit():
+            continue
+        base = ref_remove_diacritics(tok[0])
+        if base:
+            out.append(base)
+    return out
+
+
+def ref_is_pure_heading_token(text: str, heading_num: int) -> Tuple[bool, bool]:
+    t = (text or "").strip()
+    if re.match(rf"^\s*{heading_num}\s*\)\s*$", t):
+        return False, False
+    m = re.match(rf"^\s*{heading_num}\s*(\.)?\s*$", t)
+    if not m:
+        return False, False
+    return True, bool(m.group(1))
+
+
+def ref_has_dot_heading(text: str, heading_num: int) -> bool:
+    t = (text or "").strip()
+    return bool(re.search(rf"^\s*{heading_num}\s*\.", t))
+
+
+def ref_split_heading_prefix(raw_text: str, heading_num: int, require_dot: bool = False) -> Tuple[bool, str]:
+    t = (raw_text or "").strip()
+    if re.match(rf"^\s*{heading_num}\s*\)", t):
+        return False, ""
+    if require_dot:
+        m = re.match(rf"^\s*{heading_num}\s*\.\s*(\S.+)$", t)
+        if m:
+            rem = m.group(1).strip()
+            if rem and not rem[0].isdigit():
+                return True, rem
+        return False, ""
+    m = re.match(rf"^\s*{heading_num}\s*\.?\s*(\S.+)$", t)
+    if m:
+        rem = m.group(1).strip()
+        if rem and not rem[0].isdigit():
+            return True, rem
+    return False, ""
+
+
+def ref_lcs_len(a: List[str], b: List[str]) -> int:
+    n, m = len(a), len(b)
+    dp = [0] * (m + 1)
+    for i in range(1, n + 1):
+        prev = 0
+        ai = a[i - 1]
+        for j in range(1, m + 1):
+            cur = dp[j]
+            if ai == b[j - 1]:
+                dp[j] = prev + 1
+            else:
+                dp[j] = dp[j] if dp[j] >= dp[j - 1] else dp[j - 1]
+            prev = cur
+    return dp[m]
+
+
+def ref_robust_match_count(observed: List[str], expected: List[str]) -> int:
+    n_exp = len(expected)
+    p = 0
+    for i in range(min(len(observed), n_exp)):
+        if observed[i] == expected[i]:
+            p += 1
+        else:
+            break
+    anchor = 2 if n_exp <= 4 else 3
+    if p < min(anchor, n_exp):
+        r = p
+    else:
+        j = p
+        for ch in observed[p:]:
+            if j < n_exp and ch == expected[j]:
+                j += 1
+        r = j
+    if n_exp >= 6:
+        thresh = (8 * n_exp + 9) // 10
+        if expected[0] in observed[:3]:
+            lcs = ref_lcs_len(expected, observed)
+            if lcs >= thresh:
+                return lcs
+    return r
+
+
+# ---------- corpus ----------
+def initials_pairs(rng: random.Random, n: int):
+    for _ in range(n):
+        exp = [rng.choice(ALPHA) for _ in range(rng.randint(0, 14))]
+        if exp and rng.random() < 0.6:
+            # obs = exp bị rụng / thêm / đổi vài chữ (giống OCR thật)
+            obs = [c for c in exp if rng.random() > 0.15]
+            for _k in range(rng.randint(0, 4)):
+                obs.insert(rng.randint(0, len(obs)), rng.choice(ALPHA))
+        else:
+            obs = [rng.choice(ALPHA) for _ in range(rng.randint(0, 20))]
+        yield obs, exp
+
+
+def line_texts(rng: random.Random, n: int) -> List[str]:
+    texts = [str(d.get("text", "")) for pg in json.loads(FIXTURE.read_text(encoding="utf-8"))["pages"] for d in pg["dets"]]
+    for p in sorted(Path("Output").glob("*/ocr_cache/*/*.json")):
+        try:
+            dets = json.loads(p.read_text(encoding="utf-8")).get("dets") or []
+        except Exception:
+            continue
+        texts.extend(str(d.get("text", "")) for d in dets)
+    words = ["Mạng", "MÁY", "tính", "Đường", "đi", "Ứng", "DỤNG", "Bài", "x", "3.5", "(a)"]
+    heads = ["{n}.", "{n}", " {n} . ", "{n})", "{n}.{n}", "1{n}.", "{n}:", ""]
+    for _ in range(n):
+        head = rng.choice(heads).format(n=rng.randint(1, 5))
+        body = " ".join(rng.choice(words) for _ in range(rng.randint(0, 6)))
+        texts.append(f"{head} {body}" if rng.random() < 0.8 else head + body)
+    return texts
+
+
+def _bench(fn, args, repeat: int = 3) -> float:
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for a in args:
+            fn(*a)
+        dt = time.perf_counter() - t0
+        best = dt if best is None else min(best, dt)
+    return 1e6 * best / max(1, len(args))
+
+
+def compare(pairs, texts: List[str]) -> int:
+    """
+    Số case bản mới lệch bản cũ (in từng case lệch).
+    """
+    bad = 0
+
+    for obs, exp in pairs:
+        want = ref_robust_match_count(obs, exp)
+        got = (hm.robust_match_count(obs, exp), hm.HeadingMatcher(1, exp).match(obs))
+        lcs = (ref_lcs_len(exp, obs), hm.lcs_len(exp, obs), hm.HeadingMatcher(1, exp).lcs(obs))
+        if got != (want, want) or len(set(lcs)) != 1:
+            bad += 1
+            print(f"[DIFF] obs={''.join(obs)} exp={''.join(exp)} robust={want}/{got} lcs={lcs}")
+
+    for t in texts:
+        if ref_initials(t) != hm.extract_initials_no_case_change(t):
+            bad += 1
+            print(f"[DIFF] initials {t!r}")
+        for n in range(1, 6):
+            for rd in (False, True):
+                if ref_split_heading_prefix(t, n, rd) != hm.split_heading_prefix(t, n, rd):
+                    bad += 1
+                    print(f"[DIFF] split_heading_prefix {t!r} n={n} require_dot={rd}")
+            if ref_has_dot_heading(t, n) != hm.has_dot_heading(t, n):
+                bad += 1
+                print(f"[DIFF] has_dot_heading {t!r} n={n}")
+            if ref_is_pure_heading_token(t, n) != hm.is_pure_heading_token(t, n):
+                bad += 1
+                print(f"[DIFF] is_pure_heading_token {t!r} n={n}")
+    return bad
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Kiểm tra lõi match mới cho kết quả y hệt bản cũ + đo tốc độ")
+    ap.add_argument("--cases", type=int, default=20000)
+    args = ap.parse_args()
+
+    rng = random.Random(1610)
+    pairs = list(initials_pairs(rng, args.cases))
+    texts = line_texts(rng, args.cases // 4)
+    bad = compare(pairs, texts)
+
+    print(f"corpus: {len(pairs)} cặp initials, {len(texts)} text dòng")
+
+    long_pairs = [(o, e) for o, e in pairs if len(e) >= 6]
+    rows = [
+        ("robust_match_count", _bench(ref_robust_match_count, pairs), _bench(hm.robust_match_count, pairs)),
+        ("  (title >= 6 chữ)", _bench(ref_robust_match_count, long_pairs), _bench(hm.robust_match_count, long_pairs)),
+        ("lcs_len", _bench(ref_lcs_len, [(e, o) for o, e in pairs]), _bench(hm.lcs_len, [(e, o) for o, e in pairs])),
+        ("split_heading_prefix", _bench(ref_split_heading_prefix, [(t, 2) for t in texts]),
+         _bench(hm.split_heading_prefix, [(t, 2) for t in texts])),
+        ("initials", _bench(ref_initials, [(t,) for t in texts]), _bench(hm.extract_initials_no_case_change, [(t,) for t in texts])),
+    ]
+    print(f"{'':22} | {'cũ µs':>8} | {'mới µs':>8} | x")
+    for name, old, new in rows:
+        print(f"{name:22} | {old:8.2f} | {new:8.2f} | {old / new if new else 0:.1f}")
+
+    if bad:
+        print("FAIL:", bad, "khác biệt")
+        sys.exit(1)
+    print("OK: khớp hoàn toàn")
+
+
+if __name__ == "__main__":
+    main()
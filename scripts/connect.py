@@ -1,5 +1,7 @@
 # scripts/connect.py
 import os
+import threading
+from contextlib import contextmanager
 from pathlib import Path
 from dotenv import load_dotenv
 
@@ -10,6 +12,9 @@ class KeyManager:
     def __init__(self, keys: list[str], state_file: Path = STATE_FILE):
         self.keys = keys
         self.state_file = state_file
+        self._lock = threading.Lock()   # nhiều book/lesson chạy song song dùng chung key pool
+        # trần request Gemini đồng thời cho CẢ process (mọi book x mọi lesson) = số key
+        self._slots = threading.BoundedSemaphore(max(1, len(keys)))
         Path("Output").mkdir(parents=True, exist_ok=True)
 
     def _read_index(self) -> int:
@@ -28,10 +33,19 @@ class KeyManager:
         Mỗi lần chạy program: bắt đầu từ 1 key khác (round-robin).
         """
         n = len(self.keys)
-        idx = self._read_index() % n
-        self._write_index((idx + 1) % n)
+        with self._lock:
+            idx = self._read_index() % n
+            self._write_index((idx + 1) % n)
         return idx
 
+    @contextmanager
+    def slot(self):
+        """
+        Giữ 1 suất gọi Gemini; hết suất thì chờ (--jobs N book x lesson workers không vượt số key).
+        """
+        with self._slots:
+            yield
+
 
 def get_key_manager(env_path: str = "config.env") -> KeyManager:
     load_dotenv(env_path)
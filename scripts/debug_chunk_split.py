@@ -4,6 +4,7 @@ import shutil
 from pathlib import Path
 
 from .connect import get_key_manager
+from .kaggle.utils import POSTPROCESS_CODE_FILES, book_pack_ignore
 from sgk_extract.chunk_pipeline import run_extract_and_split_chunks_for_book
 
 
@@ -16,14 +17,15 @@ def _push_kaggle_dataset(book_stem: str):
     Path("kaggle_pack/sgk_extract").mkdir(parents=True, exist_ok=True)
     Path("kaggle_pack/Output").mkdir(parents=True, exist_ok=True)
 
-    shutil.copy2("sgk_extract/chunk_postprocess.py", "kaggle_pack/sgk_extract/chunk_postprocess.py")
+    for name in POSTPROCESS_CODE_FILES:
+        shutil.copy2(f"sgk_extract/{name}", f"kaggle_pack/sgk_extract/{name}")
 
     src_book = Path("Output") / book_stem
     dst_book = Path("kaggle_pack/Output") / book_stem
     if not src_book.exists():
         raise FileNotFoundError(f"Không thấy output book: {src_book}")
 
-    shutil.copytree(src_book, dst_book, dirs_exist_ok=True)
+    shutil.copytree(src_book, dst_book, dirs_exist_ok=True, ignore=book_pack_ignore(src_book))
 
     # dataset-metadata.json (đã có thì giữ)
     meta = Path("kaggle_pack/dataset-metadata.json")
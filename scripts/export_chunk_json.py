@@ -0,0 +1,23 @@
+# scripts/export_chunk_json.py
+import argparse
+from pathlib import Path
+
+from sgk_extract.chunk_index import open_chunk_index
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Tạo lại json rời (meta/keywords/cutline) từ chunk index của 1 book")
+    ap.add_argument("book_stem", help="Tên book_stem (Output/<book_stem>)")
+    ap.add_argument("--kinds", nargs="+", default=["meta", "keywords", "cutline"], choices=["meta", "keywords", "cutline"])
+    args = ap.parse_args()
+
+    book_dir = Path("Output") / args.book_stem
+    if not book_dir.exists():
+        raise SystemExit(f"Không thấy: {book_dir}")
+
+    n = open_chunk_index(book_dir).export_json_layout(kinds=args.kinds)
+    print(f"Exported {n} json file(s) -> {book_dir / 'Chunk'}")
+
+
+if __name__ == "__main__":
+    main()
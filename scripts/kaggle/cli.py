@@ -95,6 +95,13 @@ def main():
     if not args.no_apply:
         dst = safe_extract_zip_to_output(zip_path, OUTPUT_ROOT, overwrite=args.overwrite)
         log.info("✅ Applied to: %s", dst)
+
+        # pack không ship json rời trong Chunk/ => tạo lại từ chunk index cho tool cũ
+        from sgk_extract.chunk_index import JSON_MIRROR, close_chunk_index, open_chunk_index
+        if JSON_MIRROR:
+            n = open_chunk_index(dst).export_json_layout()
+            close_chunk_index(dst)
+            log.info("Exported %d json file(s) from chunk index", n)
     else:
         log.info("No-apply: kept zip at %s", zip_path)
 
@@ -203,80 +203,9 @@ book_dir = WORK / "Output" / book_stem
 chunk_root = book_dir / "Chunk"
 assert chunk_root.exists(), f"Missing chunk_root: {chunk_root}"
 
-# Lấy tất cả meta json (trừ keywords)
-json_files = sorted([
-    p for p in chunk_root.rglob("*.json")
-    if (not p.name.endswith(".keywords.json"))
-    and ("DebugCutlines" not in p.parts)         # ✅ bỏ debug folder
-    and (not p.stem.endswith("_cutline"))        # ✅ bỏ *_cutline.json
-])
-print("ChunkRoot:", chunk_root)
-print("Total meta json:", len(json_files))
-
-ocr = cp.build_ocr()
-
-ok = skip = fail = 0
-last_debug_dir = None
-
-for jp in json_files:
-    try:
-        meta = cp.read_json(jp)
-    except Exception:
-        print("[FAIL] JSON parse:", jp)
-        fail += 1
-        continue
-
-    heading = str(meta.get("heading", "")).strip()
-    heading_num = cp.extract_heading_num(heading)
-
-    is_content_head = bool(meta.get("content_head", False))
-    is_force_heading = (heading_num in getattr(cp, "FORCE_HEADING_NUMS", set()))
-
-    if (not is_content_head) and (not is_force_heading):
-        skip += 1
-        continue
-
-    pdf_path = jp.with_suffix(".pdf")
-    if not pdf_path.exists():
-        print("[FAIL] Missing chunk pdf:", pdf_path)
-        fail += 1
-        continue
-
-    # skip nếu đã làm rồi (giữ logic cũ)
-    already_done = (is_content_head and bool(meta.get(getattr(cp, "EXTRACT_KEY", "extract"), False))) or (
-        (not is_content_head) and bool(meta.get(getattr(cp, "EXTRACT_HEADING_KEY", "extract_heading"), False))
-    )
-    if (not getattr(cp, "FORCE_REPROCESS", False)) and already_done:
-        skip += 1
-        continue
-
-    try:
-        out_dir = jp.parent / "DebugCutlines"
-        shutil.rmtree(out_dir, ignore_errors=True)   # ✅ xoá debug cũ của chunk này
-        out_dir.mkdir(parents=True, exist_ok=True)
-        last_debug_dir = out_dir
-
-        payload = cp.process_one_chunk(ocr, jp, pdf_path, out_dir)
-        if payload is None:
-            skip += 1
-            continue
-
-        ok += 1
-
-        mark_extract = is_content_head
-        mark_extract_heading = (not is_content_head) and (heading_num in getattr(cp, "FORCE_HEADING_NUMS", set()))
-        cp.mark_chunk_processed(jp, meta, mark_extract=mark_extract, mark_extract_heading=mark_extract_heading)
-
-    except Exception as e:
-        print("[FAIL]", jp, "=>", repr(e))
-        fail += 1
-
-print("")
-print("=== POSTPROCESS SUMMARY ===")
-print("OK  :", ok)
-print("SKIP:", skip)
-print("FAIL:", fail)
-print("debug_example:", str(last_debug_dir) if last_debug_dir else None)
+# ✅ dùng chung vòng lặp với local (resume, dirty lessons, per-chunk DebugCutlines)
+summary = cp.run_postprocess_for_book(book_dir, reset_debug_dir=True)
+print("debug_example:", summary.get("debug_example"))
 
 # ==============
 # (5) Zip result for download
@@ -11,6 +11,44 @@ from typing import Optional
 
 log = logging.getLogger(__name__)
 
+# chunk_postprocess.py chạy rời trên Kaggle => module nó import cũng phải được pack
+POSTPROCESS_CODE_FILES = [
+    "chunk_postprocess.py",
+    "split_state.py",
+    "state_db.py",
+    "chunk_index.py",
+    "ocr_cache.py",
+    "render_cache.py",
+    "heading_match.py",
+    "pdf_edits.py",
+    "scan_image.py",
+    "page_ocr.py",
+]
+
+
+def book_pack_ignore(src_book: Path):
+    """
+    Book đã có chunk index => không ship json rời trong Chunk/ (meta/keywords/cutline nằm hết trong index).
+    Json rời sửa ngoài index (mới hơn row) được nạp vào index trước khi bỏ.
+    Dùng làm `ignore=` cho shutil.copytree.
+    """
+    from sgk_extract.chunk_index import close_chunk_index, open_chunk_index
+
+    # book cũ: open import json rời vào index; book đã có index: nạp json mới hơn row
+    n = open_chunk_index(src_book).sync_json_layout()
+    close_chunk_index(src_book)
+    if n:
+        log.info("Synced %d chunk(s) from newer json into chunk index", n)
+    chunk_root = (src_book / "Chunk").resolve()
+
+    def _ignore(dirpath: str, names: list[str]) -> list[str]:
+        d = Path(dirpath).resolve()
+        if d != chunk_root and chunk_root not in d.parents:
+            return []
+        return [n for n in names if n.endswith(".json")]
+
+    return _ignore
+
 def run_cmd(cmd: list[str], *, cwd: Optional[Path] = None, stream: bool = False) -> str:
     log.info(">>> %s", " ".join(map(str, cmd)))
     if stream:
@@ -85,7 +123,7 @@ def build_kaggle_pack(pack_dir: Path, *, book_stem: str, project_root: Path, dat
       kaggle_pack/
         dataset-metadata.json
         book_stem.txt                  ✅ để kernel đọc book cần xử lí
-        sgk_extract/chunk_postprocess.py
+        sgk_extract/chunk_postprocess.py (+ module phụ trong POSTPROCESS_CODE_FILES)
         Output/<book_stem>/...
     """
     if pack_dir.exists():
@@ -100,19 +138,20 @@ def build_kaggle_pack(pack_dir: Path, *, book_stem: str, project_root: Path, dat
     log.info("Packed book_stem marker: %s", pack_dir / "book_stem.txt")
 
     # copy code (đảm bảo kernel import cp là bản mới)
-    src_code = project_root / "sgk_extract" / "chunk_postprocess.py"
-    if src_code.exists():
-        shutil.copy2(src_code, pack_dir / "sgk_extract" / "chunk_postprocess.py")
-        log.info("Packed code: %s", src_code)
-    else:
-        log.warning("Missing %s (still ok if kernel doesn't need it).", src_code)
+    for name in POSTPROCESS_CODE_FILES:
+        src_code = project_root / "sgk_extract" / name
+        if src_code.exists():
+            shutil.copy2(src_code, pack_dir / "sgk_extract" / name)
+            log.info("Packed code: %s", src_code)
+        else:
+            log.warning("Missing %s (still ok if kernel doesn't need it).", src_code)
 
     # copy book output
     src_book = project_root / "Output" / book_stem
     dst_book = pack_dir / "Output" / book_stem
     if not src_book.exists():
         raise FileNotFoundError(f"Missing book output: {src_book}")
-    shutil.copytree(src_book, dst_book, dirs_exist_ok=True)
+    shutil.copytree(src_book, dst_book, dirs_exist_ok=True, ignore=book_pack_ignore(src_book))
     log.info("Packed book Output: %s", src_book)
 
     # ✅ always write dataset-metadata.json (vì pack_dir bị recreate)
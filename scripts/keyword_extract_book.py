@@ -5,9 +5,13 @@ from dataclasses import dataclass
 from pathlib import Path
 from typing import Any, Dict, List, Optional, Tuple
 import re
+import time
 
 from scripts.connect import get_key_manager
 from scripts.keyword_extract_one import extract_keywords_from_chunk_pdf
+from sgk_extract.split_state import clear_dirty, is_dirty, load_dirty
+from sgk_extract.state_db import open_state_db
+from sgk_extract.chunk_index import JSON_MIRROR, open_chunk_index
 
 
 # ----------------------------
@@ -223,13 +227,32 @@ def extract_keywords_for_book(
     lesson_dirs = sorted([d for d in chunk_root.iterdir() if d.is_dir()])
     summary.total_lessons = len(lesson_dirs)
 
+    # lesson đổi range: chưa chunk lại => bỏ qua; đã chunk lại => trích lại keywords
+    dirty = load_dirty(book_dir)
+
+    # state db: chunk đã có keywords => skip, khỏi parse .keywords.json
+    db = open_state_db(book_dir)
+    done_chunks = db.keys_with_status("chunk", "keywords", "done")
+
+    # chunk index: keywords / lesson_type đọc 1 lần cho cả book, ghi vào index (json rời nếu JSON_MIRROR)
+    index = open_chunk_index(book_dir)
+    indexed = {row["stem"]: row for row in index.chunks()}
+    lesson_rows = index.lessons()
+
     for lesson_dir in lesson_dirs:
+        if is_dirty(dirty, lesson_dir.name, "chunk"):
+            print(f"[DIRTY] {lesson_dir.name}: chưa chunk lại, bỏ qua")
+            continue
+        force_lesson = force_reprocess or is_dirty(dirty, lesson_dir.name, "keywords")
+        failed_before = summary.failed
+
         chunk_dirs = _chunk_dirs_of_lesson(lesson_dir)
         if not chunk_dirs:
             continue
 
         lesson_type = infer_lesson_type(chunk_dirs)
         nk = num_keywords_for_lesson_type(lesson_type)
+        lesson_fields = {"lesson_type": lesson_type, "chunk_count": len(chunk_dirs)}
         # ✅ update lesson-level json: Output/<book>/Lesson/lesson_XX/<book>_lesson_XX.json
         lesson_json = update_lesson_level_json(
             book_dir=book_dir,
@@ -242,11 +265,18 @@ def extract_keywords_for_book(
         else:
             print(f"[LESSON_META] Not found for: {lesson_dir.name}")
 
-        # Write lesson_type into meta json (chunk_01 meta preferred)
-        meta_path, changed = _update_lesson_type_meta(lesson_dir, lesson_type, len(chunk_dirs))
-        if changed:
+        # lesson_type vào index (bảng lessons + meta chunk đầu tiên)
+        if lesson_rows.get(lesson_dir.name) != lesson_fields:
+            index.put_lesson(lesson_dir.name, lesson_type, len(chunk_dirs))
+            first_pdf = _find_chunk_pdf(chunk_dirs[0])
+            if first_pdf is not None:
+                index.update_meta(first_pdf.stem, lesson_fields)
             summary.lesson_type_written += 1
-            print(f"[META] {lesson_dir.name}: lesson_type={lesson_type}, chunk_count={len(chunk_dirs)} -> {meta_path}")
+            print(f"[META] {lesson_dir.name}: lesson_type={lesson_type}, chunk_count={len(chunk_dirs)} -> index")
+
+        # Write lesson_type into meta json (chunk_01 meta preferred)
+        if JSON_MIRROR:
+            _update_lesson_type_meta(lesson_dir, lesson_type, len(chunk_dirs))
 
         for chunk_dir in chunk_dirs:
             chunk_pdf = _find_chunk_pdf(chunk_dir)
@@ -256,11 +286,18 @@ def extract_keywords_for_book(
             summary.total_chunks += 1
 
             kw_path = chunk_pdf.with_suffix(".keywords.json")
-            if (not force_reprocess) and kw_path.exists() and _has_nonempty_keywords(kw_path):
+            if (not force_lesson) and chunk_pdf.stem in done_chunks:
                 summary.skipped += 1
+                continue
+            row_kws = (indexed.get(chunk_pdf.stem) or {}).get("keywords") or {}
+            has_kws = bool(row_kws.get("keywords")) or (kw_path.exists() and _has_nonempty_keywords(kw_path))
+            if (not force_lesson) and has_kws:
+                summary.skipped += 1
+                db.record("chunk", chunk_pdf.stem, "keywords", "done", outputs=[str(kw_path)])
                 print(f"[SKIP] {kw_path} (already has keywords)")
                 continue
 
+            t0 = time.perf_counter()
             try:
                 result = extract_keywords_from_chunk_pdf(
                     key_manager=key_manager,
@@ -274,17 +311,28 @@ def extract_keywords_for_book(
                 if isinstance(kws, list):
                     result["keywords"] = kws[:nk]
 
-                kw_path.write_text(json.dumps(result, ensure_ascii=False, indent=2), encoding="utf-8")
+                index.put_keywords(chunk_pdf.stem, result)
+                if JSON_MIRROR:
+                    kw_path.write_text(json.dumps(result, ensure_ascii=False, indent=2), encoding="utf-8")
                 summary.extracted += 1
+                db.record("chunk", chunk_pdf.stem, "keywords", "done", outputs=[str(kw_path)], sec=time.perf_counter() - t0)
                 print(f"[OK] {kw_path} ({len(result.get('keywords', []))} keywords)")
 
             except Exception as e:
                 summary.failed += 1
                 # Ghi file để lần sau biết chunk nào fail (vẫn giữ schema keywords)
                 fail_payload = {"keywords": [], "error": str(e)}
-                kw_path.write_text(json.dumps(fail_payload, ensure_ascii=False, indent=2), encoding="utf-8")
+                index.put_keywords(chunk_pdf.stem, fail_payload)
+                if JSON_MIRROR:
+                    kw_path.write_text(json.dumps(fail_payload, ensure_ascii=False, indent=2), encoding="utf-8")
+                db.record("chunk", chunk_pdf.stem, "keywords", "failed", sec=time.perf_counter() - t0, error=str(e))
                 print(f"[FAIL] {chunk_pdf} -> {e}")
 
+        if summary.failed == failed_before:
+            db.record("lesson", lesson_dir.name, "keywords", "done")
+            if is_dirty(dirty, lesson_dir.name, "keywords"):
+                clear_dirty(book_dir, lesson_dir.name, "keywords")
+
     return summary
 
 
@@ -8,6 +8,7 @@ from typing import Any, Dict, List, Union
 
 from .connect import get_key_manager
 from sgk_extract.gemini_runner import extract_structure_from_pdf
+from sgk_extract.chunk_index import INDEX_NAME, open_chunk_index
 
 
 def build_keyword_prompt(num_keywords: int) -> str:
@@ -128,6 +129,11 @@ def main():
     print(json.dumps(result, ensure_ascii=False, indent=2))
 
     if args.save_json:
+        # Output/<book>/Chunk/<lesson>/chunk_XX/<stem>.pdf: book có chunk index => ghi vào index trước,
+        # không thì pack / apply Kaggle export đè mất
+        parents = chunk_pdf.resolve().parents
+        if len(parents) > 3 and (parents[3] / INDEX_NAME).exists():
+            open_chunk_index(parents[3]).put_keywords(chunk_pdf.stem, result)
         out_path = chunk_pdf.with_suffix(".keywords.json")
         out_path.write_text(json.dumps(result, ensure_ascii=False, indent=2), encoding="utf-8")
         print(f"\nSaved: {out_path}")
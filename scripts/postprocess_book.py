@@ -0,0 +1,34 @@
+# scripts/postprocess_book.py
+import argparse
+from pathlib import Path
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Chạy postprocess (cutline) local cho 1 book")
+    ap.add_argument("book_stem", help="Tên book_stem (Output/<book_stem>)")
+    ap.add_argument("--replay", action="store_true",
+                    help="Không OCR: chạy lại matching + quyết định cắt từ dets trong ocr_cache, ghi replay_report.json")
+    ap.add_argument("--workers", type=int, default=None, help="Số process OCR (mặc định OCR_WORKERS)")
+    ap.add_argument("--threads", type=int, default=None, help="Số thread CPU / process OCR")
+    ap.add_argument("--reset-debug", action="store_true", help="Xoá DebugCutlines cũ của chunk trước khi xử lý")
+    ap.add_argument("--image-codec", default=None,
+                    help='Codec ảnh thay trang: "png" | "jpeg:80" | "webp:75", thêm ",gray" / ",dpi=200" '
+                         "(mặc định: Output/<book_stem>/image_codec.txt hoặc env SGK_IMAGE_CODEC)")
+    args = ap.parse_args()
+
+    book_dir = Path("Output") / args.book_stem
+    if not book_dir.exists():
+        raise SystemExit(f"Không thấy: {book_dir}")
+
+    from sgk_extract import chunk_postprocess as cp
+    if args.replay:
+        cp.replay_postprocess_for_book(book_dir)
+    else:
+        cp.run_postprocess_for_book(
+            book_dir, reset_debug_dir=args.reset_debug, workers=args.workers, threads=args.threads,
+            image_codec=args.image_codec,
+        )
+
+
+if __name__ == "__main__":
+    main()
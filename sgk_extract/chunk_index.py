@@ -0,0 +1,314 @@
+# sgk_extract/chunk_index.py
+from __future__ import annotations
+
+import calendar
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional
+
+# Output/<book>/chunk_index.sqlite: meta + keywords + cutline của mọi chunk, lesson_type/chunk_count
+INDEX_NAME = "chunk_index.sqlite"
+
+# ghi thêm bản json rời (<stem>.json, <stem>.keywords.json, DebugCutlines/<stem>_cutline.json)
+# cho tool cũ; SGK_JSON_MIRROR=0 => chỉ ghi index, cần thì export_json_layout()
+JSON_MIRROR = os.getenv("SGK_JSON_MIRROR", "1") == "1"
+
+# json rời có mtime mới hơn updated_at của row quá mức này => coi là sửa ngoài index
+# (bản mirror ghi ngay sau row nên luôn lệch < 1-2s)
+JSON_NEWER_SLACK_SEC = 2.0
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS chunks (
+    stem        TEXT PRIMARY KEY,
+    lesson_stem TEXT NOT NULL,
+    chunk       TEXT NOT NULL,
+    pdf_rel     TEXT NOT NULL,
+    meta        TEXT NOT NULL,
+    keywords    TEXT,
+    cutline     TEXT,
+    updated_at  TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_chunks_lesson ON chunks (lesson_stem);
+CREATE TABLE IF NOT EXISTS lessons (
+    stem        TEXT PRIMARY KEY,
+    lesson_type TEXT,
+    chunk_count INTEGER,
+    updated_at  TEXT NOT NULL
+);
+"""
+
+_open_lock = threading.Lock()
+_indexes: Dict[str, "ChunkIndex"] = {}
+
+
+def _now() -> str:
+    # UTC => so được với mtime file dù index ghi ở máy khác múi giờ (Kaggle)
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+
+
+def _ts(updated_at: str) -> float:
+    try:
+        return float(calendar.timegm(time.strptime(updated_at, "%Y-%m-%d %H:%M:%S")))
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _dumps(data: Any) -> Optional[str]:
+    return None if data is None else json.dumps(data, ensure_ascii=False)
+
+
+def _loads(raw: Optional[str]) -> Any:
+    return None if raw is None else json.loads(raw)
+
+
+def _read_json(p: Path) -> Any:
+    try:
+        return json.loads(p.read_text(encoding="utf-8"))
+    except Exception:
+        return None
+
+
+def _is_newer(p: Path, row_ts: float) -> bool:
+    try:
+        return p.stat().st_mtime > row_ts + JSON_NEWER_SLACK_SEC
+    except OSError:
+        return False
+
+
+def write_json_file(path: Path, data: Dict[str, Any]) -> None:
+    tmp = path.with_suffix(path.suffix + ".tmp")
+    tmp.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+    os.replace(str(tmp), str(path))
+
+
+class ChunkIndex:
+    """
+    Index chunk của 1 book. Path lưu tương đối so với book dir => mang lên Kaggle vẫn đúng.
+    """
+
+    def __init__(self, book_dir: Path):
+        self.book_dir = book_dir
+        self.path = book_dir / INDEX_NAME
+        book_dir.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False, timeout=30.0)
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._conn:
+            self._conn.executescript(_SCHEMA)
+
+    # ---------- paths ----------
+    def chunk_pdf(self, row: Dict[str, Any]) -> Path:
+        return self.book_dir / row["pdf_rel"]
+
+    def _rel(self, pdf_path: Path) -> str:
+        try:
+            return Path(pdf_path).resolve().relative_to(self.book_dir.resolve()).as_posix()
+        except ValueError:
+            return Path(pdf_path).as_posix()
+
+    # ---------- write ----------
+    def put_chunks(self, items: Iterable[Dict[str, Any]]) -> None:
+        """
+        items: {"pdf": Path, "lesson_stem", "chunk", "meta": {...}} (chunk mới => keywords/cutline reset).
+        """
+        now = _now()
+        rows = [
+            (Path(it["pdf"]).stem, it["lesson_stem"], it["chunk"], self._rel(Path(it["pdf"])), _dumps(it["meta"]), now)
+            for it in items
+        ]
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO chunks (stem, lesson_stem, chunk, pdf_rel, meta, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+
+    def delete_lesson(self, lesson_stem: str) -> None:
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM chunks WHERE lesson_stem=?", (lesson_stem,))
+            self._conn.execute("DELETE FROM lessons WHERE stem=?", (lesson_stem,))
+
+    def update_meta(self, stem: str, fields: Dict[str, Any], drop: Iterable[str] = ()) -> Optional[Dict[str, Any]]:
+        """
+        Merge fields vào meta (1 transaction). Return meta mới, None nếu chunk không có trong index.
+        """
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT meta FROM chunks WHERE stem=?", (stem,)).fetchone()
+            if row is None:
+                return None
+            meta = json.loads(row[0])
+            meta.update(fields)
+            for k in drop:
+                meta.pop(k, None)
+            self._conn.execute("UPDATE chunks SET meta=?, updated_at=? WHERE stem=?", (_dumps(meta), _now(), stem))
+        return meta
+
+    def _set_col(self, col: str, stem: str, data: Optional[Dict[str, Any]]) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(f"UPDATE chunks SET {col}=?, updated_at=? WHERE stem=?", (_dumps(data), _now(), stem))
+
+    def put_keywords(self, stem: str, data: Dict[str, Any]) -> None:
+        self._set_col("keywords", stem, data)
+
+    def put_cutline(self, stem: str, payload: Dict[str, Any]) -> None:
+        self._set_col("cutline", stem, payload)
+
+    def put_lesson(self, lesson_stem: str, lesson_type: str, chunk_count: int) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO lessons (stem, lesson_type, chunk_count, updated_at) VALUES (?, ?, ?, ?)",
+                (lesson_stem, lesson_type, int(chunk_count), _now()),
+            )
+
+    # ---------- read (bulk) ----------
+    def chunks(self, lesson_stem: Optional[str] = None) -> List[Dict[str, Any]]:
+        sql = "SELECT stem, lesson_stem, chunk, pdf_rel, meta, keywords, cutline, updated_at FROM chunks"
+        args: tuple = ()
+        if lesson_stem is not None:
+            sql += " WHERE lesson_stem=?"
+            args = (lesson_stem,)
+        with self._lock:
+            rows = self._conn.execute(sql + " ORDER BY stem", args).fetchall()
+        return [
+            {"stem": r[0], "lesson_stem": r[1], "chunk": r[2], "pdf_rel": r[3],
+             "meta": json.loads(r[4]), "keywords": _loads(r[5]), "cutline": _loads(r[6]), "updated_at": r[7]}
+            for r in rows
+        ]
+
+    def get(self, stem: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            r = self._conn.execute(
+                "SELECT stem, lesson_stem, chunk, pdf_rel, meta, keywords, cutline, updated_at FROM chunks WHERE stem=?",
+                (stem,),
+            ).fetchone()
+        if r is None:
+            return None
+        return {"stem": r[0], "lesson_stem": r[1], "chunk": r[2], "pdf_rel": r[3],
+                "meta": json.loads(r[4]), "keywords": _loads(r[5]), "cutline": _loads(r[6]), "updated_at": r[7]}
+
+    def lessons(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            rows = self._conn.execute("SELECT stem, lesson_type, chunk_count FROM lessons").fetchall()
+        return {r[0]: {"lesson_type": r[1], "chunk_count": r[2]} for r in rows}
+
+    def count(self) -> int:
+        with self._lock:
+            return int(self._conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0])
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    # ---------- json layout <-> index ----------
+    @staticmethod
+    def _json_paths(pdf: Path) -> Dict[str, Path]:
+        return {
+            "meta": pdf.with_suffix(".json"),
+            "keywords": pdf.with_suffix(".keywords.json"),
+            "cutline": pdf.parent / "DebugCutlines" / f"{pdf.stem}_cutline.json",
+        }
+
+    def import_json_layout(self) -> int:
+        """
+        Book cũ (chỉ có json rời) => nạp hết vào index trong 1 transaction.
+        Chunk/<lesson_stem>/chunk_XX/<stem>.{json,keywords.json}, DebugCutlines/<stem>_cutline.json
+        """
+        chunk_root = self.book_dir / "Chunk"
+        if not chunk_root.exists():
+            return 0
+
+        now = _now()
+        rows = []
+        for pdf in sorted(chunk_root.glob("*/chunk_*/*.pdf")):
+            paths = self._json_paths(pdf)
+            meta = _read_json(paths["meta"])
+            if not isinstance(meta, dict):
+                continue
+            rows.append((
+                pdf.stem, pdf.parent.parent.name, pdf.parent.name, self._rel(pdf), _dumps(meta),
+                _dumps(_read_json(paths["keywords"])), _dumps(_read_json(paths["cutline"])), now,
+            ))
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO chunks (stem, lesson_stem, chunk, pdf_rel, meta, keywords, cutline, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+        return len(rows)
+
+    def sync_json_layout(self) -> int:
+        """
+        Json rời bị ghi ngoài index (tool cũ, keyword_extract_one --save_json...) sau lần ghi row cuối
+        => nạp lại vào index, để pack / export không làm mất. Return số row đã cập nhật.
+        """
+        n = 0
+        for row in self.chunks():
+            paths = self._json_paths(self.chunk_pdf(row))
+            row_ts = _ts(row["updated_at"])
+            changed = {}
+            for kind, p in paths.items():
+                if not _is_newer(p, row_ts):
+                    continue
+                data = _read_json(p)
+                if isinstance(data, dict) and data != row[kind]:
+                    changed[kind] = data
+            if not changed:
+                continue
+            sets = ", ".join(f"{k}=?" for k in changed)
+            with self._lock, self._conn:
+                self._conn.execute(
+                    f"UPDATE chunks SET {sets}, updated_at=? WHERE stem=?",
+                    (*(_dumps(v) for v in changed.values()), _now(), row["stem"]),
+                )
+            n += 1
+        return n
+
+    def export_json_layout(self, kinds: Iterable[str] = ("meta", "keywords", "cutline")) -> int:
+        """
+        Tạo lại json rời từ index (tương thích tool cũ / sau khi apply zip Kaggle).
+        File mới hơn row của nó (sửa ngoài index) thì giữ nguyên, cần nạp => sync_json_layout().
+        Return số file đã ghi.
+        """
+        kinds = set(kinds)
+        n = 0
+        for row in self.chunks():
+            pdf = self.chunk_pdf(row)
+            if not pdf.parent.exists():
+                continue
+            paths = self._json_paths(pdf)
+            row_ts = _ts(row["updated_at"])
+            data = {"meta": row["meta"], "keywords": row["keywords"] or {"keywords": []}, "cutline": row["cutline"]}
+            for kind in ("meta", "keywords", "cutline"):
+                if kind not in kinds or data[kind] is None or _is_newer(paths[kind], row_ts):
+                    continue
+                paths[kind].parent.mkdir(parents=True, exist_ok=True)
+                write_json_file(paths[kind], data[kind])
+                n += 1
+        return n
+
+
+def open_chunk_index(book_dir: str | Path) -> ChunkIndex:
+    """
+    1 index / book dir / process. Index rỗng mà book đã có json rời => import 1 lần.
+    """
+    book_dir = Path(book_dir).resolve()
+    with _open_lock:
+        idx = _indexes.get(str(book_dir))
+        if idx is None:
+            idx = ChunkIndex(book_dir)
+            if idx.count() == 0:
+                idx.import_json_layout()
+            _indexes[str(book_dir)] = idx
+        return idx
+
+
+def close_chunk_index(book_dir: str | Path) -> None:
+    book_dir = Path(book_dir).resolve()
+    with _open_lock:
+        idx = _indexes.pop(str(book_dir), None)
+    if idx is not None:
+        idx.close()
@@ -1,15 +1,26 @@
 # sgk_extract/chunk_pipeline.py
 from __future__ import annotations
 
+import hashlib
 import json
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Any, Dict, List, Tuple
 
 from pypdf import PdfReader
 
 from .gemini_runner import extract_structure_from_pdf
+from .heading_detect import HEAD_MIN_CONFIDENCE, detect_lesson_headings
 from .prompts import build_chunk_prompt_start_head
-from .pdf_output import split_pdf_by_ranges
+from .pdf_output import load_item_meta, materialize_item_pdf, split_pdf_by_ranges
+from .pdf_meta import get_page_count
+from .manifest_validate import repair_start_head, validate_chunk_list
+from .split_state import clear_dirty, is_dirty, load_dirty
+from .state_db import open_state_db
+from .chunk_index import JSON_MIRROR, open_chunk_index
 
 
 def _flatten_start_head(list_chunk: List[Dict[str, Dict[str, Any]]]) -> List[Tuple[int, bool, str, str]]:
@@ -111,13 +122,287 @@ def _to_ranges(list_chunk_computed: List[Dict[str, Dict[str, Any]]]) -> List[Tup
     return ranges
 
 
+def _new_lesson_result() -> Dict[str, List[Any]]:
+    return {"chunk_pdf_files": [], "chunk_meta_files": [], "skipped_lessons": [], "chunk_repairs": [], "lesson_timings": []}
+
+
+# 1 reader PDF gốc / thread (pypdf reader không an toàn khi nhiều thread cùng đọc stream)
+_tls = threading.local()
+
+
+def _book_reader(book_pdf: str) -> PdfReader:
+    """
+    Reader của PDF gốc, dùng lại cho mọi lesson mà thread này xử lý.
+    Mỗi thread chỉ giữ 1 reader (đổi sách => bỏ reader cũ).
+    """
+    cached = getattr(_tls, "book", None)
+    if cached is None or cached[0] != book_pdf:
+        cached = (book_pdf, PdfReader(book_pdf))
+        _tls.book = cached
+    return cached[1]
+
+
+def _book_source(lesson_pdf: Path) -> Tuple[str, int, int] | None:
+    """
+    (book_pdf, start, end) của lesson theo meta json (trang PDF gốc, 1-based).
+    None nếu meta thiếu / PDF gốc không còn.
+    """
+    meta = load_item_meta(lesson_pdf)
+    src, s, e = meta.get("source_pdf"), meta.get("start"), meta.get("end")
+    if not (isinstance(src, str) and isinstance(s, int) and isinstance(e, int)) or not Path(src).exists():
+        return None
+    e = min(e, get_page_count(src))
+    return (src, s, e) if 1 <= s <= e else None
+
+
+def _lesson_input_hash(lesson_pdf: Path) -> str:
+    """
+    Input của chunk stage = range lesson trong PDF gốc (giống nhau cho lesson lazy / đã cắt).
+    """
+    meta = load_item_meta(lesson_pdf)
+    payload = {k: meta.get(k) for k in ("source_pdf", "start", "end")}
+    if not any(payload.values()) and lesson_pdf.exists():
+        st = lesson_pdf.stat()
+        payload = {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+    return hashlib.sha1(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def _discover_lessons(lesson_dir: Path) -> List[Path]:
+    """
+    Lesson PDF đã cắt + lesson lazy (chỉ có meta json, PDF chưa tạo).
+    """
+    found = set(lesson_dir.rglob("*.pdf"))
+    for meta_path in lesson_dir.rglob("*.json"):
+        if load_item_meta(meta_path.with_suffix(".pdf")).get("kind") == "lesson":
+            found.add(meta_path.with_suffix(".pdf"))
+    return sorted(found)
+
+
+def _write_lesson_chunks(
+    lesson_pdf: Path,
+    list_chunk_computed: List[Dict[str, Dict[str, Any]]],
+    lesson_chunk_dir: Path,
+    total_pages: int,
+    book: Tuple[str, int, int] | None = None,
+) -> Tuple[List[str], List[str]]:
+    """
+    Parse lesson PDF 1 lần, ghi hết chunk_XX/<lesson_stem>_chunk_XX.pdf, meta vào chunk index
+    (1 transaction / lesson) + json rời nếu JSON_MIRROR.
+    book=(book_pdf, start, end): cắt thẳng từ PDF gốc (trang lesson i -> trang gốc start + i - 1),
+    không đọc lại lesson PDF.
+    Return (chunk_pdf_files, chunk_meta_files).
+    """
+    lesson_stem = lesson_pdf.stem
+    lesson_chunk_dir.mkdir(parents=True, exist_ok=True)
+    index = open_chunk_index(lesson_chunk_dir.parent.parent)   # Output/<book>/Chunk/<lesson_stem>
+    if book is not None:
+        src_pdf, offset = book[0], book[1] - 1
+        reader = _book_reader(src_pdf)
+    else:
+        src_pdf, offset = str(lesson_pdf), 0
+        reader = PdfReader(src_pdf)
+
+    pdf_files: List[str] = []
+    meta_files: List[str] = []
+    index_items: List[Dict[str, Any]] = []
+
+    # ---- mỗi chunk -> 1 folder ----
+    for item in list_chunk_computed:
+        chunk_name, obj = next(iter(item.items()))
+        start = int(obj.get("start", 1))
+        end = int(obj.get("end", start))
+
+        chunk_dir = lesson_chunk_dir / chunk_name
+        chunk_dir.mkdir(parents=True, exist_ok=True)
+
+        # cắt pdf cho đúng chunk này, output vào chunk_dir (dùng chung reader)
+        paths = split_pdf_by_ranges(
+            src_pdf=src_pdf,
+            ranges=[(chunk_name, start + offset, end + offset)],
+            out_dir=chunk_dir,
+            pdf_stem=lesson_stem,
+            reader=reader,
+        )
+
+        if not paths:
+            continue
+
+        chunk_pdf_path = paths[0]
+        pdf_files.append(str(chunk_pdf_path))
+
+        # JSON cùng tên với PDF: file_name.pdf -> file_name.json
+        meta_path = chunk_pdf_path.with_suffix(".json")
+
+        payload = {
+            "source_lesson_pdf": str(lesson_pdf),
+            "lesson_stem": lesson_stem,
+            "chunk": chunk_name,
+            "chunk_pdf": str(chunk_pdf_path),
+            "heading": obj.get("heading", ""),
+            "title": obj.get("title", ""),
+            "start": start,
+            "end": end,
+            "content_head": obj.get("content_head"),
+            "total_pages": total_pages,
+        }
+        if book is not None:
+            payload.update({"source_pdf": src_pdf, "book_start": start + offset, "book_end": end + offset})
+
+        index_items.append({"pdf": chunk_pdf_path, "lesson_stem": lesson_stem, "chunk": chunk_name, "meta": payload})
+        if not JSON_MIRROR:
+            continue
+
+        meta_path.write_text(
+            json.dumps(payload, ensure_ascii=False, indent=2),
+            encoding="utf-8",
+        )
+        meta_files.append(str(meta_path))
+
+        # tạo file keywords rỗng để sau này fill
+        kw_path = chunk_pdf_path.with_suffix(".keywords.json")
+        if not kw_path.exists():
+            kw_path.write_text(json.dumps({"keywords": []}, ensure_ascii=False, indent=2), encoding="utf-8")
+
+    # chunk cũ của lesson (nếu chunk lại) bỏ hết, ghi mới 1 lần
+    index.delete_lesson(lesson_stem)
+    index.put_chunks(index_items)
+
+    return pdf_files, meta_files
+
+
+def _process_one_lesson(
+    key_manager,
+    lesson_pdf: Path,
+    book_dir: Path,
+    chunk_root: Path,
+    dirty: Dict[str, List[str]],
+    model: str,
+    resume: bool,
+    direct: bool = False,
+    local_headings: bool = False,
+) -> Dict[str, List[Any]]:
+    """
+    1 lesson: Gemini tìm mục chính -> validate -> cắt Chunk/<lesson_stem>/chunk_XX/.
+    Chỉ ghi vào folder của chính lesson => chạy song song nhiều lesson được.
+    direct=True (hoặc lesson lazy): chunk cắt thẳng từ PDF gốc.
+    local_headings=True: OCR tìm mục chính trước, chỉ gọi Gemini khi độ tin cậy thấp.
+    Return phần summary của lesson này (caller gộp theo thứ tự lesson).
+    """
+    res = _new_lesson_result()
+    lesson_stem = lesson_pdf.stem
+    db = open_state_db(book_dir)
+    in_hash = _lesson_input_hash(lesson_pdf)
+
+    if is_dirty(dirty, lesson_stem, "chunk"):
+        shutil.rmtree(chunk_root / lesson_stem, ignore_errors=True)
+        db.invalidate_lesson(lesson_stem)
+        open_chunk_index(book_dir).delete_lesson(lesson_stem)
+
+    # resume: state db (O(1)); book cũ chưa có db => fallback xem đã có chunk pdf chưa
+    elif resume:
+        row = db.get("lesson", lesson_stem, "chunk")
+        if row is not None:
+            done = row["status"] == "done" and row["input_hash"] == in_hash
+        else:
+            lesson_chunk_dir = chunk_root / lesson_stem
+            done = lesson_chunk_dir.exists() and any(lesson_chunk_dir.rglob("*.pdf"))
+        if done:
+            res["skipped_lessons"].append({"lesson": str(lesson_pdf), "reason": "Đã có chunk pdf, skip"})
+            return res
+
+    t_start = time.perf_counter()
+    try:
+        book = _book_source(lesson_pdf) if (direct or not lesson_pdf.exists()) else None
+        total_pages = book[2] - book[1] + 1 if book is not None else get_page_count(lesson_pdf)
+        t_detect = time.perf_counter()
+
+        local = detect_lesson_headings(lesson_pdf, source=book) if local_headings else None
+        if local is not None and local["list_chunk"] and local["confidence"] >= HEAD_MIN_CONFIDENCE:
+            raw: Dict[str, Any] = local
+        else:
+            if book is not None:
+                # lesson lazy: chỉ tạo PDF lesson khi thật sự upload Gemini
+                materialize_item_pdf(lesson_pdf, reader=_book_reader(book[0]))
+            prompt = build_chunk_prompt_start_head(total_pages=total_pages)
+            raw = extract_structure_from_pdf(
+                key_manager,
+                str(lesson_pdf),
+                prompt,
+                model=model,
+            )
+
+        list_chunk_raw = raw.get("list_chunk")
+        items: List[Tuple[int, bool, str, str]] = []
+        if isinstance(list_chunk_raw, list) and list_chunk_raw:
+            items = _flatten_start_head(list_chunk_raw)
+        items, repairs = repair_start_head(items)
+
+        list_chunk_computed = _compute_chunks_from_start_head(items, total_pages)
+
+        if not list_chunk_computed:
+            reason = "Không tạo được list_chunk_computed"
+            res["skipped_lessons"].append({"lesson": str(lesson_pdf), "reason": reason})
+            db.record("lesson", lesson_stem, "chunk", "failed", input_hash=in_hash, error=reason)
+            return res
+
+        # ✅ validate trước khi cắt: phủ kín [1, total_pages], không chồng/hở trang
+        report = validate_chunk_list(list_chunk_computed, total_pages)
+        if repairs:
+            res["chunk_repairs"].append({"lesson": str(lesson_pdf), "repairs": repairs})
+        if not report["ok"]:
+            reason = f"list_chunk không hợp lệ: {report['errors']}"
+            res["skipped_lessons"].append({"lesson": str(lesson_pdf), "reason": reason})
+            db.record("lesson", lesson_stem, "chunk", "failed", input_hash=in_hash, error=reason)
+            return res
+
+        # folder: Chunk/<lesson_stem>/chunk_XX/
+        t_split = time.perf_counter()
+        pdf_files, meta_files = _write_lesson_chunks(
+            lesson_pdf, list_chunk_computed, chunk_root / lesson_stem, total_pages, book=book,
+        )
+        res["chunk_pdf_files"].extend(pdf_files)
+        res["chunk_meta_files"].extend(meta_files)
+        res["lesson_timings"].append({
+            "lesson": str(lesson_pdf),
+            "chunks": len(pdf_files),
+            "heading_source": raw.get("source", "gemini"),
+            "local_confidence": local["confidence"] if local is not None else None,
+            "detect_sec": round(t_split - t_detect, 3),
+            "split_sec": round(time.perf_counter() - t_split, 3),
+        })
+
+        # chunk mới => postprocess/keywords của lesson phải chạy lại
+        db.invalidate_lesson(lesson_stem, stages=("postprocess", "keywords"))
+        db.record(
+            "lesson", lesson_stem, "chunk", "done",
+            input_hash=in_hash, outputs=pdf_files, sec=time.perf_counter() - t_start,
+        )
+        clear_dirty(book_dir, lesson_stem, "chunk")
+
+    except Exception as e:
+        res["skipped_lessons"].append({"lesson": str(lesson_pdf), "reason": str(e)})
+        db.record("lesson", lesson_stem, "chunk", "failed", input_hash=in_hash, error=repr(e))
+
+    return res
+
+
 def run_extract_and_split_chunks_for_book(
     key_manager,
     book_dir: str | Path,
     model: str = "gemini-2.5-flash",
     resume: bool = True,
+    workers: int = 1,
+    direct: bool = False,
+    local_headings: bool = False,
 ) -> Dict[str, Any]:
-
+    """
+    workers > 1: xử lý song song tối đa `workers` lesson (không vượt số API key),
+    phần lớn thời gian mỗi lesson là chờ upload + Gemini. Trần chung cho mọi book chạy
+    song song nằm ở key_manager.slot() (gemini_runner).
+    Summary luôn gộp theo thứ tự lesson (giống chạy tuần tự).
+    direct=True: chunk PDF cắt thẳng từ PDF gốc (không đọc lại lesson PDF).
+    local_headings=True: dò mục chính bằng OCR local, Gemini chỉ là fallback.
+    """
     book_dir = Path(book_dir)
     lesson_dir = book_dir / "Lesson"
     chunk_root = book_dir / "Chunk"          # <-- giữ tên Chunk
@@ -126,106 +411,31 @@ def run_extract_and_split_chunks_for_book(
     if not lesson_dir.exists():
         raise RuntimeError(f"Không thấy thư mục Lesson: {lesson_dir}")
 
-    lesson_pdfs = sorted(lesson_dir.rglob("*.pdf"))
+    lesson_pdfs = _discover_lessons(lesson_dir)
     if not lesson_pdfs:
         raise RuntimeError(f"Không có file PDF nào trong: {lesson_dir}")
 
     summary: Dict[str, Any] = {
         "book_dir": str(book_dir),
         "lesson_count": len(lesson_pdfs),
-        "chunk_pdf_files": [],
-        "chunk_meta_files": [],      # <-- đổi tên rõ nghĩa
-        "skipped_lessons": [],
+        **_new_lesson_result(),
     }
 
-    for lesson_pdf in lesson_pdfs:
-        lesson_stem = lesson_pdf.stem
+    # lesson vừa bị cắt lại (range đổi) => chunk cũ không còn đúng
+    dirty = load_dirty(book_dir)
 
-        # resume: nếu đã có chunk pdf trong Chunk/<lesson_stem>/ thì skip
-        if resume:
-            lesson_chunk_dir = chunk_root / lesson_stem
-            if lesson_chunk_dir.exists() and any(lesson_chunk_dir.rglob("*.pdf")):
-                summary["skipped_lessons"].append({"lesson": str(lesson_pdf), "reason": "Đã có chunk pdf, skip"})
-                continue
+    n_workers = max(1, min(int(workers), len(key_manager.keys), len(lesson_pdfs)))
+    args = (book_dir, chunk_root, dirty, model, resume, direct, local_headings)
 
-        try:
-            total_pages = len(PdfReader(str(lesson_pdf)).pages)
-            prompt = build_chunk_prompt_start_head(total_pages=total_pages)
+    if n_workers == 1:
+        results = [_process_one_lesson(key_manager, lp, *args) for lp in lesson_pdfs]
+    else:
+        with ThreadPoolExecutor(max_workers=n_workers) as pool:
+            results = list(pool.map(lambda lp: _process_one_lesson(key_manager, lp, *args), lesson_pdfs))
 
-            raw: Dict[str, Any] = extract_structure_from_pdf(
-                key_manager,
-                str(lesson_pdf),
-                prompt,
-                model=model,
-            )
+    # gộp ở thread chính, theo thứ tự lesson => deterministic
+    for res in results:
+        for k, v in res.items():
+            summary[k].extend(v)
 
-            list_chunk_raw = raw.get("list_chunk")
-            items: List[Tuple[int, bool, str, str]] = []
-            if isinstance(list_chunk_raw, list) and list_chunk_raw:
-                items = _flatten_start_head(list_chunk_raw)
-
-            list_chunk_computed = _compute_chunks_from_start_head(items, total_pages)
-
-            if not list_chunk_computed:
-                summary["skipped_lessons"].append({"lesson": str(lesson_pdf), "reason": "Không tạo được list_chunk_computed"})
-                continue
-
-            # folder: Chunk/<lesson_stem>/chunk_XX/
-            lesson_chunk_dir = chunk_root / lesson_stem
-            lesson_chunk_dir.mkdir(parents=True, exist_ok=True)
-
-            # ---- CHỖ THAY ĐỔI: mỗi chunk -> 1 folder ----
-            for item in list_chunk_computed:
-                chunk_name, obj = next(iter(item.items()))
-                start = int(obj.get("start", 1))
-                end = int(obj.get("end", start))
-
-                chunk_dir = lesson_chunk_dir / chunk_name
-                chunk_dir.mkdir(parents=True, exist_ok=True)
-
-                # cắt pdf cho đúng chunk này, output vào chunk_dir
-                paths = split_pdf_by_ranges(
-                    src_pdf=str(lesson_pdf),
-                    ranges=[(chunk_name, start, end)],
-                    out_dir=chunk_dir,
-                    pdf_stem=lesson_stem,
-                )
-
-                if not paths:
-                    continue
-
-                chunk_pdf_path = paths[0]
-                summary["chunk_pdf_files"].append(str(chunk_pdf_path))
-
-                # JSON cùng tên với PDF: file_name.pdf -> file_name.json
-                meta_path = chunk_pdf_path.with_suffix(".json")
-
-                payload = {
-                    "source_lesson_pdf": str(lesson_pdf),
-                    "lesson_stem": lesson_stem,
-                    "chunk": chunk_name,
-                    "chunk_pdf": str(chunk_pdf_path),
-                    "heading": obj.get("heading", ""),
-                    "title": obj.get("title", ""),
-                    "start": start,
-                    "end": end,
-                    "content_head": obj.get("content_head"),
-                    "total_pages": total_pages,
-                }
-
-                meta_path.write_text(
-                    json.dumps(payload, ensure_ascii=False, indent=2),
-                    encoding="utf-8",
-                )
-
-                # nếu bạn vẫn dùng key này
-                summary["chunk_meta_files"].append(str(meta_path))
-                # tạo file keywords rỗng để sau này fill
-                kw_path = chunk_pdf_path.with_suffix(".keywords.json")
-                if not kw_path.exists():
-                    kw_path.write_text(json.dumps({"keywords": []}, ensure_ascii=False, indent=2), encoding="utf-8")
-
-        except Exception as e:
-            summary["skipped_lessons"].append({"lesson": str(lesson_pdf), "reason": str(e)})
-
-    return summary
\ No newline at end of file
+    return summary
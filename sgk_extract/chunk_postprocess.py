@@ -1,19 +1,76 @@
 # sgk_extract/chunk_postprocess.py
+from __future__ import annotations
+
 import os
 os.environ["DISABLE_MODEL_SOURCE_CHECK"] = "True"
-os.environ["OMP_NUM_THREADS"] = "2"
-os.environ["VECLIB_MAXIMUM_THREADS"] = "2"
+# worker pool (spawn) set sẵn env cho process con => không ghi đè
+os.environ.setdefault("OMP_NUM_THREADS", "2")
+os.environ.setdefault("VECLIB_MAXIMUM_THREADS", "2")
 
 import re
 import json
-import unicodedata
+import shutil
 import tempfile
+import time
+import bisect
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Tuple
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
 
 import cv2
 import numpy as np
-from paddleocr import PaddleOCR
+
+if TYPE_CHECKING:   # chỉ để annotate; PaddleOCR thật import lúc build_ocr (page_ocr)
+    from paddleocr import PaddleOCR
+
+# chạy được cả trong package (local) lẫn file rời (Kaggle: sys.path -> sgk_extract/)
+try:
+    from .split_state import clear_dirty, is_dirty, load_dirty
+    from .state_db import open_state_db
+    from .chunk_index import JSON_MIRROR, ChunkIndex, open_chunk_index
+    from .ocr_cache import OCR_CACHE_ENABLED, OcrCache, cache_key, page_hash
+    from .pdf_edits import (
+        PdfEditPlan, apply_pdf_edits, make_clip_edit, make_edit, merge_edit_stats, page_clip_y,
+        pdf_image_supported, summarize_edits,
+    )
+    from .scan_image import decode_jpeg, embedded_jpeg
+    from .page_ocr import (
+        as_bgr, build_ocr as _build_ocr, group_to_lines, ocr_image_dets as _ocr_image_dets, poly_bbox, render_page,
+    )
+    from .heading_match import (
+        HeadingMatcher,
+        has_dot_heading,
+        is_pure_heading_token,
+        lcs_len,
+        prefix_match_count,
+        remove_diacritics_char_no_case_change,
+        split_heading_prefix,
+        tokenize_words,
+    )
+except ImportError:
+    from split_state import clear_dirty, is_dirty, load_dirty
+    from state_db import open_state_db
+    from chunk_index import JSON_MIRROR, ChunkIndex, open_chunk_index
+    from ocr_cache import OCR_CACHE_ENABLED, OcrCache, cache_key, page_hash
+    from pdf_edits import (
+        PdfEditPlan, apply_pdf_edits, make_clip_edit, make_edit, merge_edit_stats, page_clip_y,
+        pdf_image_supported, summarize_edits,
+    )
+    from scan_image import decode_jpeg, embedded_jpeg
+    from page_ocr import (
+        as_bgr, build_ocr as _build_ocr, group_to_lines, ocr_image_dets as _ocr_image_dets, poly_bbox, render_page,
+    )
+    from heading_match import (
+        HeadingMatcher,
+        has_dot_heading,
+        is_pure_heading_token,
+        lcs_len,
+        prefix_match_count,
+        remove_diacritics_char_no_case_change,
+        split_heading_prefix,
+        tokenize_words,
+    )
 
 
 # ============================
@@ -47,6 +104,48 @@ WEAK_ALLOWED_MODES = {"prefix_line", "heading_left_title", "same_line", "merge_n
 
 # --- FORCE CUT WHEN HEADING EVIDENCE STRONG ---
 FORCE_CUT_ON_MODES = {"prefix_line"}   # bạn có thể thêm "heading_left_title" nếu muốn
+
+# --- BATCH OCR (render trước page0 của nhiều chunk, det/rec theo batch) ---
+OCR_BATCH_SIZE   = 8       # số ảnh / batch
+OCR_BATCH_MAX_MB = 768     # trần RAM ảnh render sẵn / batch (ảnh 260 DPI ~ 25MB)
+
+# --- RENDER ---
+# 1 = render thẳng ảnh xám (1 kênh, ~1/3 RAM), OCR tự đổi sang 3 kênh; PNG cắt cũng là ảnh xám
+RENDER_GRAY = os.getenv("SGK_RENDER_GRAY", "0") == "1"
+# top/bot sau khi cắt được encode PNG 1 lần rồi đưa thẳng vào PDF (insert_image(stream=)).
+# 1 = ghi thêm <stem>_cutline_top/bot.png vào DebugCutlines/ (xem lại bằng mắt)
+SAVE_SPLIT_PNG = os.getenv("SGK_SAVE_SPLIT_PNG", "0") == "1"
+# --- KIỂU CẮT ---
+# raster: thay trang bằng ảnh top/bot (như cũ)
+# clip  : giữ nguyên trang gốc (vector + text layer), chỉ đặt cropbox theo line cắt => PDF nhỏ, không encode ảnh.
+#         Trang bị xoay => tự quay về raster.
+CUT_MODE = os.getenv("SGK_CUT_MODE", "raster")
+# 1 = trang scan (cả trang là 1 ảnh JPEG): OCR + cắt thẳng trên ảnh JPEG nhúng (độ phân giải gốc, không render),
+#     top/bot ghi lại JPEG cùng quality ảnh gốc; ảnh gốc ngoài [SCAN_MIN_DPI, SCAN_MAX_DPI] => render như cũ
+SCAN_FAST_PATH = os.getenv("SGK_SCAN_FAST_PATH", "0") == "1"
+SCAN_MIN_DPI = 150   # thấp hơn => chữ nhỏ quá, render DPI cao OCR tốt hơn
+SCAN_MAX_DPI = 400   # cao hơn => ảnh quá nặng cho OCR
+# ảnh thay trang (cắt raster): "png" (lossless, như cũ) | "jpeg:Q" | "webp:Q" (Q = quality 1..100),
+# thêm ",gray" (lưu ảnh xám) / ",dpi=N" (hạ xuống tối đa N DPI), vd "jpeg:80,gray,dpi=200".
+# Theo book: file Output/<book>/image_codec.txt (1 dòng, cùng cú pháp) hoặc tham số image_codec
+IMAGE_CODEC = os.getenv("SGK_IMAGE_CODEC", "png")
+IMAGE_CODEC_FILE = "image_codec.txt"
+
+# --- THANG DPI (OCR DPI thấp trước, chỉ lên DPI khi match yếu; luôn cắt ở DPI) ---
+# SGK_DPI_LADDER="130" hoặc "130,200"; rỗng = chỉ OCR ở DPI như cũ
+DPI_LADDER = tuple(int(x) for x in os.getenv("SGK_DPI_LADDER", "").split(",") if x.strip())
+DPI_TRUSTED_MODES = {"prefix_line", "same_line"}   # mode khác (merge_next, heading_left_title...) => thử DPI kế
+
+# --- ROI OCR (det ảnh thu nhỏ -> rec chỉ vùng có thể là heading) ---
+ROI_OCR           = os.getenv("SGK_ROI_OCR", "0") == "1"
+ROI_DET_SCALE     = 0.5    # det trên ảnh 0.5x (260 -> 130 DPI)
+ROI_COL_TOL       = 0.06   # đầu dòng cách lề trái <= 6% chiều rộng trang = cột heading
+ROI_PREFIX_RATIO  = 3.0    # crop đầu dòng rộng 3 x chiều cao box (đủ "12.")
+ROI_BAND_LINES    = 3      # rec thêm 3 dòng dưới heading (giống look_ahead merge_next)
+
+# --- WORKER POOL (mỗi process 1 PaddleOCR, chunk cùng lesson chạy tuần tự trong 1 worker) ---
+OCR_WORKERS = int(os.getenv("SGK_OCR_WORKERS", "1"))   # 1 = chạy trong process hiện tại như cũ
+OCR_THREADS = int(os.getenv("SGK_OCR_THREADS", "2"))   # thread CPU / worker (OMP + cpu_threads)
 # ============================
 # JSON helpers
 # ============================
@@ -57,22 +156,6 @@ def _score(m: int, has_heading: bool, has_dot: bool) -> int:
     # heading_bonus=2, dot_bonus=1 (dot chỉ bonus, không bắt buộc)
     return m * 10 + (2 if has_heading else 0) + (1 if has_dot else 0)
 
-def _is_pure_heading_token(text: str, heading_num: int) -> Tuple[bool, bool]:
-    """
-    True nếu text chỉ là "1" hoặc "1." (có thể có spaces).
-    Return: (ok, has_dot)
-    """
-    t = (text or "").strip()
-
-    # loại "1)" kiểu câu hỏi
-    if re.match(rf"^\s*{heading_num}\s*\)\s*$", t):
-        return False, False
-
-    m = re.match(rf"^\s*{heading_num}\s*(\.)?\s*$", t)
-    if not m:
-        return False, False
-    return True, bool(m.group(1))
-
 def _v_overlap_ratio(a_y0: float, a_y1: float, b_y0: float, b_y1: float) -> float:
     inter = max(0.0, min(a_y1, b_y1) - max(a_y0, b_y0))
     denom = max(1.0, min(a_y1 - a_y0, b_y1 - b_y0))
@@ -81,23 +164,39 @@ def _v_overlap_ratio(a_y0: float, a_y1: float, b_y0: float, b_y1: float) -> floa
 def collect_heading_candidates(dets: List[Dict[str, Any]], heading_num: int) -> List[Dict[str, Any]]:
     out: List[Dict[str, Any]] = []
     for d in dets:
-        ok, has_dot = _is_pure_heading_token(d.get("text", ""), heading_num)
+        ok, has_dot = is_pure_heading_token(d.get("text", ""), heading_num)
         if ok:
             dd = dict(d)
             dd["has_dot"] = has_dot
             out.append(dd)
     return out
 
+def index_heading_candidates(heading_cands: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Sort heading candidates theo x1 (stable) 1 lần / trang => mỗi line chỉ bisect khoảng x1 hợp lệ.
+    """
+    cands = sorted(heading_cands, key=lambda h: float(h["x1"]))
+    return {"x1": [float(h["x1"]) for h in cands], "cands": cands}
+
 def find_heading_left_for_line(
     heading_cands: List[Dict[str, Any]],
     ln: Dict[str, Any],
     *,
     x_gap_max: float = 220.0,   # tuỳ trang, có thể tăng lên 300 nếu số "1." cách xa title
-    min_v_overlap: float = 0.25 # overlap theo trục y
+    min_v_overlap: float = 0.25, # overlap theo trục y
+    index: Optional[Dict[str, Any]] = None,
 ) -> Optional[Dict[str, Any]]:
     """
     Tìm heading (1/1.) nằm bên trái và gần line title.
+    index (index_heading_candidates): chỉ xét candidate có x1 trong [x0 - x_gap_max, x0] (nới 1px,
+    điều kiện gốc vẫn check lại bên dưới => kết quả y hệt quét hết).
     """
+    if index is not None:
+        lx0 = float(ln["x0"])
+        lo = bisect.bisect_left(index["x1"], lx0 - x_gap_max - 1.0)
+        hi = bisect.bisect_right(index["x1"], lx0 + 1.0)
+        heading_cands = index["cands"][lo:hi]
+
     best = None  # (key, cand)
     for h in heading_cands:
         # phải nằm bên trái line
@@ -120,10 +219,6 @@ def find_heading_left_for_line(
     return best[1] if best else None
 
 
-def _has_dot_heading(text: str, heading_num: int) -> bool:
-    t = (text or "").strip()
-    return bool(re.search(rf"^\s*{heading_num}\s*\.", t))
-
 def build_seq_from_line_items(items: List[Dict[str, Any]], heading_num: int) -> Tuple[Optional[List[str]], Optional[Dict[str, float]], bool]:
     """
     Trả về:
@@ -152,7 +247,7 @@ def build_seq_from_line_items(items: List[Dict[str, Any]], heading_num: int) ->
                     started = True
                     seq.append(hn)
                     hbbox = {"x0": float(it["x0"]), "y0": float(it["y0"]), "x1": float(it["x1"]), "y1": float(it["y1"])}
-                    has_dot = _has_dot_heading(it.get("text", ""), heading_num)
+                    has_dot = has_dot_heading(it.get("text", ""), heading_num)
 
                     # lấy initials của các token sau heading trong cùng item (nếu có)
                     for tok2 in toks[k + 1:]:
@@ -184,7 +279,10 @@ def try_merge_title_from_next_lines(
     hbbox: Dict[str, float],
     expected_letters: List[str],
     look_ahead: int = 3,
+    matcher: Optional[HeadingMatcher] = None,
 ) -> Tuple[int, List[str]]:
+    if matcher is None:
+        matcher = HeadingMatcher(0, expected_letters)
     best_m = 0
     best_obs: List[str] = []
 
@@ -203,8 +301,8 @@ def try_merge_title_from_next_lines(
         if abs(mid2 - hmid) > max(60.0, h_h * 2.5):
             continue
 
-        obs2 = extract_initials_no_case_change(ln2["text"])
-        m2 = robust_match_count(obs2, expected_letters)
+        obs2 = matcher.initials(ln2["text"])
+        m2 = matcher.match(obs2)
         if m2 > best_m:
             best_m = m2
             best_obs = obs2
@@ -228,6 +326,7 @@ def mark_chunk_processed(
     *,
     mark_extract: bool,
     mark_extract_heading: bool,
+    index: Optional[ChunkIndex] = None,
 ) -> None:
     # chỉ set extract_heading khi bạn muốn nó là "đã xử lý heading-force"
     if mark_extract_heading:
@@ -240,7 +339,24 @@ def mark_chunk_processed(
     if mark_extract:
         meta[EXTRACT_KEY] = True
 
-    write_json_atomic(chunk_json_path, meta)
+    if index is not None:
+        index.update_meta(
+            chunk_json_path.stem,
+            {k: meta[k] for k in (EXTRACT_KEY, EXTRACT_HEADING_KEY) if k in meta},
+            drop=[] if mark_extract_heading else [EXTRACT_HEADING_KEY],
+        )
+    if index is None or JSON_MIRROR:
+        write_json_atomic(chunk_json_path, meta)
+
+
+def save_cutline(out_cut_json: Path, payload: Dict[str, Any], index: Optional[ChunkIndex] = None) -> None:
+    """
+    Kết quả cutline: vào chunk index (nếu có) + file DebugCutlines/<stem>_cutline.json nếu JSON_MIRROR.
+    """
+    if index is not None:
+        index.put_cutline(out_cut_json.stem[: -len("_cutline")], payload)
+    if index is None or JSON_MIRROR:
+        write_json_atomic(out_cut_json, payload)
 
 
 # ============================
@@ -261,6 +377,105 @@ def imwrite_unicode(path: Path, img: np.ndarray) -> None:
         raise RuntimeError(f"cv2.imencode failed: {path} | shape={img.shape}")
     buf.tofile(str(path))
 
+def encode_image(img: np.ndarray, ext: str = ".png", params: Optional[List[int]] = None) -> Dict[str, Any]:
+    """
+    Encode 1 lần trong RAM => {"stream": bytes, "w", "h"}: đủ cho insert_image(stream=) + đặt rect,
+    không cần ghi file rồi decode lại. params: cờ cv2.imencode (vd [cv2.IMWRITE_JPEG_QUALITY, 85]).
+    """
+    if img is None or img.size == 0 or img.shape[0] == 0 or img.shape[1] == 0:
+        raise RuntimeError(f"Empty image, cannot encode | shape={None if img is None else img.shape}")
+    ok, buf = cv2.imencode(ext, img, params or [])
+    if not ok:
+        raise RuntimeError(f"cv2.imencode failed | shape={img.shape}")
+    return {"stream": buf.tobytes(), "w": int(img.shape[1]), "h": int(img.shape[0])}
+
+def parse_image_codec(spec: Optional[str]) -> Dict[str, Any]:
+    """
+    "png" | "jpeg:80" | "webp:75,gray,dpi=200" => {"codec", "quality", "gray", "max_dpi"}.
+    Sai cú pháp => ValueError (lỗi cấu hình: dừng trước khi sửa PDF nào).
+    """
+    codec: Dict[str, Any] = {"codec": "png", "quality": None, "gray": False, "max_dpi": 0}
+    parts = [p.strip().lower() for p in (spec or "").split(",") if p.strip()]
+    if not parts:
+        return codec
+    name, _, q = parts[0].partition(":")
+    name = "jpeg" if name == "jpg" else name
+    if name not in ("png", "jpeg", "webp"):
+        raise ValueError(f"image codec không hỗ trợ: {spec!r} (png | jpeg:Q | webp:Q)")
+    if name == "png" and q:
+        raise ValueError(f"png không có quality: {spec!r}")
+    codec["codec"] = name
+    if name != "png":
+        codec["quality"] = int(q) if q else 85
+        if not 1 <= codec["quality"] <= 100:
+            raise ValueError(f"quality phải trong 1..100: {spec!r}")
+    for p in parts[1:]:
+        if p == "gray":
+            codec["gray"] = True
+        elif p.startswith("dpi="):
+            codec["max_dpi"] = int(p[4:])
+        else:
+            raise ValueError(f"tuỳ chọn image codec lạ: {p!r} trong {spec!r}")
+    return codec
+
+def book_image_codec(book_dir: Path, spec: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Codec ảnh thay trang của 1 book: spec truyền vào > Output/<book>/image_codec.txt > IMAGE_CODEC (env).
+    webp mà PyMuPDF không đọc được => jpeg cùng quality (báo 1 lần / book).
+    """
+    if spec is None:
+        f = Path(book_dir) / IMAGE_CODEC_FILE
+        spec = f.read_text(encoding="utf-8").strip() if f.exists() else IMAGE_CODEC
+    codec = parse_image_codec(spec)
+    if codec["codec"] == "webp" and not pdf_image_supported(".webp"):
+        print("[WARN] PyMuPDF không nhận WebP => dùng JPEG")
+        codec["codec"] = "jpeg"
+    return codec
+
+def split_format(codec: Dict[str, Any], cut_dpi: float, scan: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    Cách encode top/bot của 1 chunk theo codec (parse_image_codec):
+    - trang scan + png => JPEG cùng quality ảnh gốc; jpeg/webp trên trang scan không vượt quality gốc
+    - webp mà PyMuPDF không đọc được => jpeg (book_image_codec đã báo)
+    - max_dpi < cut_dpi => scale < 1 (hạ DPI lúc encode, line cắt vẫn tính ở cut_dpi)
+    """
+    name, quality = codec["codec"], codec["quality"]
+    if scan is not None and name == "png":
+        name, quality = "jpeg", int(scan.get("quality") or 90)
+    elif scan is not None and scan.get("quality"):
+        quality = min(int(quality), int(scan["quality"]))
+    if name == "webp" and not pdf_image_supported(".webp"):
+        name = "jpeg"
+
+    ext, params = ".png", []
+    if name == "jpeg":
+        ext, params = ".jpg", [cv2.IMWRITE_JPEG_QUALITY, int(quality)]
+    elif name == "webp":
+        ext, params = ".webp", [cv2.IMWRITE_WEBP_QUALITY, int(quality)]
+    max_dpi = int(codec.get("max_dpi") or 0)
+    scale = float(max_dpi) / float(cut_dpi) if max_dpi and cut_dpi > max_dpi else 1.0
+    return {
+        "codec": name, "ext": ext, "params": params, "quality": quality if name != "png" else None,
+        "gray": bool(codec.get("gray")), "scale": scale, "dpi": round(float(cut_dpi) * scale, 2),
+    }
+
+def encode_split(part: np.ndarray, fmt: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    Encode 1 nửa ảnh đã cắt theo split_format (xám / hạ DPI trước khi encode); fmt=None => PNG như cũ.
+    """
+    if not fmt:
+        return encode_image(part)
+    if fmt["gray"] and part.ndim == 3:
+        part = cv2.cvtColor(part, cv2.COLOR_BGR2GRAY)
+    if fmt["scale"] < 1.0:
+        h, w = part.shape[:2]
+        size = (max(1, int(round(w * fmt["scale"]))), max(1, int(round(h * fmt["scale"]))))
+        part = cv2.resize(part, size, interpolation=cv2.INTER_AREA)
+    return encode_image(part, fmt["ext"], fmt["params"])
+
+def write_encoded(path: Path, enc: Dict[str, Any]) -> None:
+    Path(path).write_bytes(enc["stream"])
+
 def imread_unicode(path: Path) -> np.ndarray:
     data = np.fromfile(str(path), dtype=np.uint8)
     img = cv2.imdecode(data, cv2.IMREAD_COLOR)
@@ -272,205 +487,215 @@ def imread_unicode(path: Path) -> np.ndarray:
 # ============================
 # PDF -> image (page 0) (PyMuPDF only, gọn)
 # ============================
+def render_pdf_page_to_bgr(pdf_path: Path, page_index: int, dpi: int, gray: Optional[bool] = None) -> np.ndarray:
+    """
+    Render 1 trang -> BGR (H, W, 3) hoặc xám (H, W) nếu gray / RENDER_GRAY (page_ocr.render_page, qua render cache).
+    """
+    return render_page(pdf_path, page_index, dpi, RENDER_GRAY if gray is None else bool(gray))
+
 def render_pdf_page0_to_bgr(pdf_path: Path, dpi: int) -> np.ndarray:
-    # ưu tiên pypdfium2 (Kaggle-safe), fallback fitz nếu có
-    try:
-        import pypdfium2 as pdfium
-        pdf = pdfium.PdfDocument(str(pdf_path))
-        page = pdf.get_page(0)
-        scale = float(dpi) / 72.0
-        bitmap = page.render(scale=scale)
-        pil_img = bitmap.to_pil()  # RGB
-        rgb = np.array(pil_img, dtype=np.uint8)
-        bgr = cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR)
-        page.close()
-        pdf.close()
-        return bgr
-    except Exception:
-        pass
+    return render_pdf_page_to_bgr(pdf_path, 0, dpi)
 
-    # fallback PyMuPDF (local nếu bạn muốn)
-    import fitz
-    doc = fitz.open(str(pdf_path))
-    page = doc.load_page(0)
-    zoom = float(dpi) / 72.0
-    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
-    img = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
-    doc.close()
-    return cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
+def load_page0(pdf_path: Path, dpi: int) -> Tuple[np.ndarray, int, Optional[Dict[str, Any]]]:
+    """
+    Ảnh page0 để OCR: SCAN_FAST_PATH + trang scan => decode ảnh JPEG nhúng (DPI gốc), còn lại render ở dpi.
+    Return (img, img_dpi, scan); scan = info ảnh gốc (w, h, dpi, quality, gray) hoặc None nếu đã render.
+    """
+    if SCAN_FAST_PATH:
+        try:
+            scan = embedded_jpeg(pdf_path, 0)
+        except Exception:
+            scan = None
+        if scan is not None and SCAN_MIN_DPI <= scan["dpi"] <= SCAN_MAX_DPI:
+            img = decode_jpeg(scan.pop("stream"), gray=RENDER_GRAY)
+            return img, int(round(scan["dpi"])), scan
+    return render_pdf_page0_to_bgr(pdf_path, dpi=dpi), int(dpi), None
 
 # ============================
 # OCR helpers
 # ============================
+def ocr_image_dets(ocr: PaddleOCR, img_bgr: np.ndarray) -> List[Dict[str, Any]]:
+    """
+    OCR 1 ảnh -> list dets chuẩn hoá {x0,y0,x1,y1,text,score} (đã lọc MIN_SCORE), xem page_ocr.
+    """
+    return _ocr_image_dets(ocr, img_bgr, min_score=MIN_SCORE)
 
-def run_ocr_any(ocr: PaddleOCR, img_bgr: np.ndarray):
-    # PaddleOCR 2.x / 3.x đều có thể khác nhau; ưu tiên .ocr
-    if hasattr(ocr, "ocr"):
-        return ocr.ocr(img_bgr, cls=False)
-    # fallback nếu gặp bản chỉ có predict
-    return ocr.predict(
-        img_bgr,
-        use_textline_orientation=False,
-        use_doc_orientation_classify=False,
-        use_doc_unwarping=False,
-    )
-
-def iter_dets_paddleocr(res: Any) -> List[Dict[str, Any]]:
-    # Parse output từ ocr.ocr(img, cls=False): [ [ [poly, (text, score)], ... ] ]
-    if res is None:
-        return []
-    if not isinstance(res, list):
-        res = [res]
-    out: List[Dict[str, Any]] = []
-    for page in res:
-        if page is None or not isinstance(page, list):
-            continue
-        for det in page:
-            if not (isinstance(det, (list, tuple)) and len(det) >= 2):
-                continue
-            poly = det[0]
-            ts = det[1]
-            if not (isinstance(ts, (list, tuple)) and len(ts) >= 2):
-                continue
-            text = (ts[0] or "").strip()
-            score = float(ts[1]) if ts[1] is not None else 0.0
-            if not text:
-                continue
-            x0, y0, x1, y1 = poly_bbox(poly)
-            out.append({"x0": x0, "y0": y0, "x1": x1, "y1": y1, "text": text, "score": score})
-    return out
-
-def poly_bbox(poly: Any) -> Tuple[float, float, float, float]:
-    pts = np.array(poly, dtype=np.float32).reshape(-1, 2)
-    x0, y0 = float(np.min(pts[:, 0])), float(np.min(pts[:, 1]))
-    x1, y1 = float(np.max(pts[:, 0])), float(np.max(pts[:, 1]))
-    return x0, y0, x1, y1
-
-def _merge_res_dict(obj: Any) -> Optional[Dict[str, Any]]:
-    if obj is None:
+def _paddle_batch_parts(ocr: PaddleOCR):
+    """
+    (detector, recognizer, crop_fn, sorted_boxes, drop_score) của PaddleOCR 2.x, None nếu không có
+    (3.x / bản khác) => caller OCR từng ảnh.
+    """
+    det = getattr(ocr, "text_detector", None)
+    rec = getattr(ocr, "text_recognizer", None)
+    if det is None or rec is None:
         return None
-    if isinstance(obj, dict):
-        d = dict(obj)
-    elif hasattr(obj, "to_dict"):
-        try:
-            d = obj.to_dict()
-            if not isinstance(d, dict):
-                return None
-        except Exception:
-            return None
-    elif hasattr(obj, "res"):
-        d = obj.res
-        if not isinstance(d, dict):
-            return None
-    else:
+    try:
+        from tools.infer.predict_system import sorted_boxes
+        from tools.infer.utility import get_minarea_rect_crop, get_rotate_crop_image
+    except ImportError:
         return None
+    args = getattr(ocr, "args", None)
+    crop = get_minarea_rect_crop if getattr(args, "det_box_type", "quad") != "quad" else get_rotate_crop_image
+    return det, rec, crop, sorted_boxes, float(getattr(ocr, "drop_score", 0.0))
 
-    # paddlex/paddleocr sometimes nests "res"
-    cur = d
-    for _ in range(3):
-        inner = cur.get("res")
-        if isinstance(inner, dict):
-            for k, v in inner.items():
-                d.setdefault(k, v)
-            cur = inner
-        else:
-            break
-    return d
-
-def _get_any(d: Dict[str, Any], keys: List[str]) -> Any:
-    for k in keys:
-        if k in d and d[k] is not None:
-            return d[k]
-    return None
-
-def iter_dets_predict(res: Any) -> List[Dict[str, Any]]:
-    if res is None:
+def ocr_batch_dets(ocr: PaddleOCR, imgs: List[np.ndarray]) -> List[List[Dict[str, Any]]]:
+    """
+    OCR nhiều ảnh 1 lượt: detect từng ảnh, gom crop của CẢ batch cho recognizer chạy 1 lần
+    (recognizer tự chia rec_batch_num). Kết quả từng ảnh giống ocr_image_dets().
+    """
+    if not imgs:
         return []
-    if not isinstance(res, list):
-        res = [res]
-
-    out: List[Dict[str, Any]] = []
-    for page in res:
-        d = _merge_res_dict(page)
-        if not isinstance(d, dict):
-            continue
-
-        rec_polys = _get_any(d, ["rec_polys", "rec_boxes", "rec_points"])
-        dt_polys  = _get_any(d, ["dt_polys", "dt_boxes", "det_polys"])
-        texts     = _get_any(d, ["rec_texts", "rec_text", "texts"])
-        scores    = _get_any(d, ["rec_scores", "rec_score", "scores"])
-
-        if texts is None or scores is None:
-            continue
-
-        polys = None
-        if rec_polys is not None and len(rec_polys) == len(texts):
-            polys = rec_polys
-        elif dt_polys is not None and len(dt_polys) == len(texts):
-            polys = dt_polys
-        else:
-            continue
-
-        n = min(len(polys), len(texts), len(scores))
-        for poly, text, score in zip(polys[:n], texts[:n], scores[:n]):
+    parts = _paddle_batch_parts(ocr)
+    if parts is None:
+        return [ocr_image_dets(ocr, im) for im in imgs]
+    det, rec, crop, sorted_boxes, drop_score = parts
+
+    boxes_per_img: List[List[Any]] = []
+    crops: List[np.ndarray] = []
+    imgs = [as_bgr(im) for im in imgs]
+    for im in imgs:
+        dt_boxes, _ = det(im)
+        boxes = sorted_boxes(dt_boxes) if dt_boxes is not None and len(dt_boxes) else []
+        boxes_per_img.append(boxes)
+        for b in boxes:
+            crops.append(crop(im, np.array(b, dtype=np.float32)))
+
+    rec_res = rec(crops)[0] if crops else []
+
+    out: List[List[Dict[str, Any]]] = []
+    i = 0
+    for boxes in boxes_per_img:
+        dets: List[Dict[str, Any]] = []
+        for b in boxes:
+            text, score = rec_res[i]
+            i += 1
             text = (text or "").strip()
-            if not text:
+            if score < drop_score or not text or score < float(MIN_SCORE):
                 continue
-            x0, y0, x1, y1 = poly_bbox(poly)
-            out.append({"x0": x0, "y0": y0, "x1": x1, "y1": y1, "text": text, "score": float(score)})
+            x0, y0, x1, y1 = poly_bbox(b)
+            dets.append({"x0": x0, "y0": y0, "x1": x1, "y1": y1, "text": text, "score": float(score)})
+        out.append(dets)
     return out
 
-def group_to_lines(dets: List[Dict[str, Any]], y_tol: float) -> List[Dict[str, Any]]:
-    dets = sorted(dets, key=lambda d: (((d["y0"] + d["y1"]) * 0.5), d["x0"]))
-    groups: List[Dict[str, Any]] = []
+def _roi_prefix_hit(text: str, heading_num: int) -> bool:
+    t = (text or "").strip()
+    return bool(re.match(rf"^{heading_num}(?!\d)", t)) and not re.match(rf"^{heading_num}\s*\)", t)
 
-    for d in dets:
-        yc = 0.5 * (d["y0"] + d["y1"])
-        for g in groups:
-            if abs(yc - g["y_ref"]) <= y_tol:
-                g["items"].append(d)
-                g["y_ref"] = (g["y_ref"] * (len(g["items"]) - 1) + yc) / len(g["items"])
-                break
-        else:
-            groups.append({"y_ref": yc, "items": [d]})
+def ocr_roi_dets(
+    ocr: PaddleOCR, img_bgr: np.ndarray, heading_num: int,
+) -> Tuple[List[Dict[str, Any]], Optional[Dict[str, Any]]]:
+    """
+    OCR 2 pha cho 1 trang:
+      1) det (không rec) trên ảnh thu nhỏ ROI_DET_SCALE -> box dòng (scale về toạ độ ảnh gốc)
+      2) rec ở full DPI: crop ngắn đầu dòng thuộc cột trái -> dòng nào bắt đầu bằng "<heading_num>"
+         thì rec đủ box của dòng đó + ROI_BAND_LINES dòng kế.
+    Return (dets giống ocr_image_dets nhưng chỉ vùng heading, roi info để debug).
+    Không có det/rec riêng (PaddleOCR khác 2.x) hoặc không thấy dòng nào => OCR cả trang.
+    """
+    parts = _paddle_batch_parts(ocr)
+    if parts is None:
+        return ocr_image_dets(ocr, img_bgr), None
+    det, rec, crop, sorted_boxes, drop_score = parts
+
+    img_bgr = as_bgr(img_bgr)
+    h_img, w_img = img_bgr.shape[:2]
+    small = cv2.resize(img_bgr, None, fx=ROI_DET_SCALE, fy=ROI_DET_SCALE, interpolation=cv2.INTER_AREA)
+    dt_boxes, _ = det(small)
+    if dt_boxes is None or not len(dt_boxes):
+        return [], {"det_scale": ROI_DET_SCALE, "det_boxes": 0, "fallback": "no_det"}
+    boxes = [np.array(b, dtype=np.float32) / ROI_DET_SCALE for b in sorted_boxes(dt_boxes)]
+
+    # box rỗng text => gom dòng bằng group_to_lines như dets thật
+    raw = []
+    for k, b in enumerate(boxes):
+        x0, y0, x1, y1 = poly_bbox(b)
+        raw.append({"x0": x0, "y0": y0, "x1": x1, "y1": y1, "text": "", "score": 1.0, "k": k})
+    med_h = float(np.median([d["y1"] - d["y0"] for d in raw]))
+    lines = group_to_lines(raw, y_tol=max(10.0, med_h * 0.6))
+
+    # pha 2a: crop đầu dòng của cột trái (lề trái = đầu dòng nhỏ nhất)
+    left = min(ln["x0"] for ln in lines)
+    col_lines = [i for i, ln in enumerate(lines) if ln["x0"] <= left + ROI_COL_TOL * w_img]
+    prefix_crops = []
+    for i in col_lines:
+        d = lines[i]["items"][0]
+        bh = max(1.0, d["y1"] - d["y0"])
+        x0 = int(max(0, d["x0"] - 2))
+        x1 = int(min(w_img, d["x0"] + min(d["x1"] - d["x0"], ROI_PREFIX_RATIO * bh) + 2))
+        y0 = int(max(0, d["y0"] - 2))
+        y1 = int(min(h_img, d["y1"] + 2))
+        prefix_crops.append(img_bgr[y0:y1, x0:max(x1, x0 + 1)])
+    prefix_res = rec(prefix_crops)[0] if prefix_crops else []
+    hit_lines = [i for i, (text, _sc) in zip(col_lines, prefix_res) if _roi_prefix_hit(text, heading_num)]
+
+    roi: Dict[str, Any] = {
+        "det_scale": ROI_DET_SCALE,
+        "det_boxes": len(boxes),
+        "lines": len(lines),
+        "prefix_crops": len(prefix_crops),
+        "hit_lines": hit_lines,
+    }
+    if not hit_lines:
+        roi["fallback"] = "no_prefix_hit"
+        return ocr_image_dets(ocr, img_bgr), roi
+
+    # pha 2b: rec đủ box của dòng heading + band bên dưới
+    keep: List[int] = []
+    for i in hit_lines:
+        for ln in lines[i:i + 1 + ROI_BAND_LINES]:
+            keep.extend(it["k"] for it in ln["items"])
+    keep = sorted(set(keep))
+    rec_res = rec([crop(img_bgr, boxes[k]) for k in keep])[0]
+
+    dets: List[Dict[str, Any]] = []
+    for k, (text, score) in zip(keep, rec_res):
+        text = (text or "").strip()
+        if score < drop_score or not text or score < float(MIN_SCORE):
+            continue
+        x0, y0, x1, y1 = poly_bbox(boxes[k])
+        dets.append({"x0": x0, "y0": y0, "x1": x1, "y1": y1, "text": text, "score": float(score)})
 
-    lines: List[Dict[str, Any]] = []
-    for g in sorted(groups, key=lambda x: x["y_ref"]):
-        items = sorted(g["items"], key=lambda d: d["x0"])
-        x0 = min(it["x0"] for it in items)
-        x1 = max(it["x1"] for it in items)
-        y0 = min(it["y0"] for it in items)
-        y1 = max(it["y1"] for it in items)
-        text = " ".join(it["text"] for it in items)
-        lines.append({"items": items, "text": text, "x0": x0, "x1": x1, "y0": y0, "y1": y1})
-    return lines
+    roi["rec_boxes"] = len(keep)
+    roi["crops"] = [
+        {"x0": int(d["x0"]), "y0": int(d["y0"]), "x1": int(d["x1"]), "y1": int(d["y1"])}
+        for d in (raw[k] for k in keep)
+    ]
+    return dets, roi
+
+def ocr_engine_id() -> str:
+    try:
+        import paddleocr
+        return f"paddleocr-{getattr(paddleocr, '__version__', '?')}"
+    except Exception:
+        return "paddleocr-?"
+
+def ocr_params(heading_num: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Tham số làm dets thay đổi => nằm trong key cache.
+    """
+    params: Dict[str, Any] = {"lang": LANG, "det_no_resize": DET_NO_RESIZE, "min_score": MIN_SCORE, "roi": ROI_OCR}
+    if ROI_OCR:
+        params.update({
+            "heading_num": heading_num, "det_scale": ROI_DET_SCALE, "col_tol": ROI_COL_TOL,
+            "prefix_ratio": ROI_PREFIX_RATIO, "band_lines": ROI_BAND_LINES,
+        })
+    return params
+
+def ocr_cache_key(page_sha: str, dpi: int, heading_num: Optional[int] = None, source: str = "render") -> str:
+    # source="scan": dets trên ảnh JPEG gốc (SCAN_FAST_PATH) khác pixel với ảnh render cùng DPI
+    params = ocr_params(heading_num)
+    if source != "render":
+        params["source"] = source
+    return cache_key(page_sha, dpi, ocr_engine_id(), params)
 
 
 # ============================
-# Matching rules (giữ nguyên logic)
+# Matching rules (giữ nguyên logic; lõi so khớp initials ở heading_match.py)
 # ============================
 def extract_heading_num(heading: str) -> Optional[int]:
     m = re.search(r"(\d+)", heading or "")
     return int(m.group(1)) if m else None
 
-def remove_diacritics_char_no_case_change(ch: str) -> Optional[str]:
-    if not ch:
-        return None
-    if ch == "Đ":
-        return "D"
-    if ch == "đ":
-        return None
-    if (not ch.isalpha()) or (not ch.isupper()):
-        return None
-    base = unicodedata.normalize("NFD", ch)
-    base = "".join(c for c in base if unicodedata.category(c) != "Mn")
-    if len(base) != 1 or (not base.isalpha()) or (not base.isupper()):
-        return None
-    return base
-
-def tokenize_words(text: str) -> List[str]:
-    return re.findall(r"[0-9]+|[A-Za-zÀ-Ỵà-ỵĐđ]+", text or "")
-
 def build_expected_letters_from_title(title: str) -> List[str]:
     out: List[str] = []
     for w in re.split(r"\s+", (title or "").strip()):
@@ -488,281 +713,142 @@ def build_expected_letters_from_title(title: str) -> List[str]:
             out.append(base)
     return out
 
-def split_heading_prefix(raw_text: str, heading_num: int, require_dot: bool = False) -> Tuple[bool, str]:
-    t = (raw_text or "").strip()
-
-    # loại "1)" kiểu câu hỏi trắc nghiệm
-    if re.match(rf"^\s*{heading_num}\s*\)", t):
-        return False, ""
-
-    if require_dot:
-        # bắt buộc có dấu chấm sau số: "1. ...."
-        m = re.match(rf"^\s*{heading_num}\s*\.\s*(\S.+)$", t)
-        if m:
-            rem = m.group(1).strip()
-            if rem and not rem[0].isdigit():
-                return True, rem
-        return False, ""
-
-    # không bắt buộc dot (giữ tương thích)
-    m = re.match(rf"^\s*{heading_num}\s*\.?\s*(\S.+)$", t)
-    if m:
-        rem = m.group(1).strip()
-        if rem and not rem[0].isdigit():
-            return True, rem
-
-    return False, ""
-
-
-def extract_initials_no_case_change(text: str) -> List[str]:
-    initials: List[str] = []
-    for tok in tokenize_words(text):
-        if tok.isdigit():
-            continue
-        base = remove_diacritics_char_no_case_change(tok[0])
-        if base:
-            initials.append(base)
-    return initials
-
-def prefix_match_count(observed: List[str], expected: List[str]) -> int:
-    
-    n = min(len(observed), len(expected))
-    m = 0
-    for i in range(n):
-        if observed[i] == expected[i]:
-            m += 1
-        else:
-            break
-    return m
-
-def robust_match_count(observed: List[str], expected: List[str]) -> int:
-    """
-    Robust match:
-    - Prefix + skip chữ dư: xử lý case BTCL vs BTL (THỨC bị tách -> THỨ + C)
-    - Với title dài (>=6): dùng LCS nếu đủ cao (>= 80%) để chịu BOTH thiếu + dư (case lesson 11)
-    """
-
-    # 1) prefix
-    p = prefix_match_count(observed, expected)
-
-    # 2) skip chữ dư (giữ như bạn đang dùng)
-    anchor = 2 if len(expected) <= 4 else 3
-    if p < min(anchor, len(expected)):
-        r = p
-    else:
-        j = p
-        for ch in observed[p:]:
-            if j < len(expected) and ch == expected[j]:
-                j += 1
-        r = j
-
-    # 3) LCS fallback cho title dài (>=6): chịu cả thiếu + dư
-    if len(expected) >= 6:
-        # ceil(0.8*n) không cần import math
-        thresh = (8 * len(expected) + 9) // 10
-
-        # yêu cầu chữ đầu xuất hiện rất sớm (tránh match nhầm dòng)
-        begin_ok = (len(expected) == 0) or (expected[0] in observed[:3])
-
-        if begin_ok:
-            n, m = len(expected), len(observed)
-            dp = [0] * (m + 1)
-            for i in range(1, n + 1):
-                prev = 0
-                ei = expected[i - 1]
-                for j2 in range(1, m + 1):
-                    cur = dp[j2]
-                    if ei == observed[j2 - 1]:
-                        dp[j2] = prev + 1
-                    else:
-                        dp[j2] = dp[j2] if dp[j2] >= dp[j2 - 1] else dp[j2 - 1]
-                    prev = cur
-            lcs = dp[m]
-            if lcs >= thresh:
-                return lcs
-
-    return r
-
 # ============================
 # Debug draw + split
 # ============================
 
-def draw_debug(img: np.ndarray, line: Dict[str, Any], y_line: int, out_path: Path, label: str = "") -> None:
-    out = img.copy()
+def draw_debug(
+    img: np.ndarray, line: Dict[str, Any], y_line: int, out_path: Path, label: str = "", inplace: bool = False,
+) -> None:
+    """
+    inplace=True: vẽ thẳng lên img (caller không cần img nữa) => khỏi copy cả trang.
+    Ảnh read-only (render cache) vẫn copy. Ảnh xám vẽ bằng màu xám (không đổi sang BGR).
+    """
+    out = img if (inplace and img.flags.writeable) else img.copy()
     h, w = out.shape[:2]
     y = max(0, min(int(y_line), h - 1))
+    gray = out.ndim == 2
 
-    cv2.line(out, (0, y), (w - 1, y), (0, 0, 255), 3)
+    cv2.line(out, (0, y), (w - 1, y), 0 if gray else (0, 0, 255), 3)
     x0 = int(max(0, min(line["x0"], w - 1)))
     x1 = int(max(0, min(line["x1"], w - 1)))
     y0 = int(max(0, min(line["y0"], h - 1)))
     y1 = int(max(0, min(line["y1"], h - 1)))
-    cv2.rectangle(out, (x0, y0), (x1, y1), (0, 255, 0), 2)
+    cv2.rectangle(out, (x0, y0), (x1, y1), 128 if gray else (0, 255, 0), 2)
 
     if label:
         cv2.putText(out, label[:90], (20, max(30, y - 12)),
-                    cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 0, 0), 3, cv2.LINE_AA)
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.8, 0 if gray else (0, 0, 0), 3, cv2.LINE_AA)
         cv2.putText(out, label[:90], (20, max(30, y - 12)),
-                    cv2.FONT_HERSHEY_SIMPLEX, 0.8, (255, 255, 255), 1, cv2.LINE_AA)
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.8, 255 if gray else (255, 255, 255), 1, cv2.LINE_AA)
 
     imwrite_unicode(out_path, out)
     print("Saved:", out_path)
 
-def split_and_save_bot_only(img: np.ndarray, y_line: int, out_bot: Path) -> Dict[str, Any]:
+def split_image(
+    img: np.ndarray, y_line: int, with_top: bool = True, encode: bool = True, fmt: Optional[Dict[str, Any]] = None,
+) -> Tuple[Dict[str, Any], Optional[Dict[str, Any]], Optional[Dict[str, Any]]]:
+    """
+    Cắt img tại y_line (view, không copy) và encode top/bot trong RAM (fmt: split_format, None = PNG).
+    with_top=False: chỉ bot (heading_num=1, bot-only).
+    encode=False: chỉ tính info (cắt kiểu clip không cần ảnh).
+    Return (info, top, bot); top/bot = encode_image(...) hoặc None nếu rỗng / không encode.
+    """
     h, _ = img.shape[:2]
     y = int(round(y_line))
     y = max(0, min(y, h))
 
-    info = {"y_split": y, "bot_saved": False, "bot_h": 0}
+    if with_top:
+        info: Dict[str, Any] = {"y_split": y, "top_saved": False, "bot_saved": False, "top_h": 0, "bot_h": 0}
+    else:
+        info = {"y_split": y, "bot_saved": False, "bot_h": 0}
+    top = bot = None
 
-    if y == h:
-        # bot rỗng => không lưu
-        print("[WARN] y_line=h => BOT rỗng, không lưu.")
-        return info
+    if with_top and y > 0:
+        top = encode_split(img[:y], fmt) if encode else None
+        info.update({"top_saved": True, "top_h": y})
+    if y < h:
+        bot = encode_split(img[y:], fmt) if encode else None
+        info.update({"bot_saved": True, "bot_h": h - y})
 
-    bot = img[y:].copy()
-    if bot.size == 0 or bot.shape[0] == 0 or bot.shape[1] == 0:
-        print("[WARN] BOT rỗng, không lưu.")
-        return info
+    if with_top and y == 0:
+        print("[WARN] y_line=0 => TOP rỗng, chỉ lưu BOT.")
+    if y == h:
+        print("[WARN] y_line=h => BOT rỗng, " + ("chỉ lưu TOP." if with_top else "không lưu."))
+    return info, top, bot
 
-    imwrite_unicode(out_bot, bot)
-    info.update({"bot_saved": True, "bot_h": int(bot.shape[0])})
+def split_and_save_bot_only(img: np.ndarray, y_line: int, out_bot: Path) -> Dict[str, Any]:
+    info, _top, bot = split_image(img, y_line, with_top=False)
+    if bot is not None:
+        write_encoded(out_bot, bot)
     return info
 
+def _replace_or_queue(
+    pdf_path: Path,
+    image: "Path | Dict[str, Any] | None",
+    page_index: int,
+    make_backup: bool,
+    edits: Optional[PdfEditPlan],
+    clip: Optional[Tuple[float, str]] = None,
+) -> Dict[str, Optional[int]]:
+    # clip=(y_pt, "top"|"bottom") => đặt cropbox thay vì thay trang bằng ảnh
+    # return cỡ file {"before", "after"}; xếp hàng => after=None, runner điền sau khi ghi
+    edit = make_clip_edit(page_index, *clip) if clip is not None else make_edit(page_index, image)
+    size: Dict[str, Optional[int]] = {"before": int(Path(pdf_path).stat().st_size), "after": None}
+    if edits is None:
+        size["after"] = apply_pdf_edits(pdf_path, [edit], make_backup=make_backup)["size"]
+    else:
+        edits.add_edit(pdf_path, edit)
+    return size
+
 def update_pdf_page0_with_bot_only(
     cur_chunk_pdf: Path,
-    bot_png: Path,
+    bot_img: "Path | Dict[str, Any] | None",
     make_backup: bool = False,
+    edits: Optional[PdfEditPlan] = None,
+    clip_y: Optional[float] = None,
 ) -> Dict[str, Any]:
     result: Dict[str, Any] = {
         "cur_pdf_updated": False,
         "cur_pdf_path": str(cur_chunk_pdf.resolve()),
         "cur_first_page_index": 0,
         "mode": "bot_only_page0",
+        "cut_mode": "clip" if clip_y is not None else "raster",
+        "queued": edits is not None,
     }
 
-    replace_page_with_png_inplace(cur_chunk_pdf, bot_png, 0, make_backup=make_backup)
+    result["cur_pdf_bytes"] = _replace_or_queue(cur_chunk_pdf, bot_img, 0, make_backup, edits,
+                                                clip=(clip_y, "bottom") if clip_y is not None else None)
     result["cur_pdf_updated"] = True
     return result
 
 
 def split_and_save(img: np.ndarray, y_line: int, out_top: Path, out_bot: Path) -> Dict[str, Any]:
-    h, _ = img.shape[:2]
-    y = int(round(y_line))
-    y = max(0, min(y, h))
-
-    info = {"y_split": y, "top_saved": False, "bot_saved": False, "top_h": 0, "bot_h": 0}
-
-    if y == 0:
-        bot = img.copy()
-        imwrite_unicode(out_bot, bot)
-        info.update({"bot_saved": True, "bot_h": int(bot.shape[0])})
-        print("[WARN] y_line=0 => TOP rỗng, chỉ lưu BOT.")
-        return info
-
-    if y == h:
-        top = img.copy()
-        imwrite_unicode(out_top, top)
-        info.update({"top_saved": True, "top_h": int(top.shape[0])})
-        print("[WARN] y_line=h => BOT rỗng, chỉ lưu TOP.")
-        return info
-
-    top = img[:y].copy()
-    bot = img[y:].copy()
-    imwrite_unicode(out_top, top)
-    imwrite_unicode(out_bot, bot)
-
-    info.update({"top_saved": True, "bot_saved": True, "top_h": int(top.shape[0]), "bot_h": int(bot.shape[0])})
+    info, top, bot = split_image(img, y_line)
+    if top is not None:
+        write_encoded(out_top, top)
+    if bot is not None:
+        write_encoded(out_bot, bot)
     return info
 
 
 # ============================
 # PDF replace (inplace)
 # ============================
-def _img_wh(png_path: Path) -> Tuple[int, int]:
-    img = imread_unicode(png_path)
-    h, w = img.shape[:2]
-    return w, h
-
-def _rect_fit_on_page(page_rect, img_w: int, img_h: int, align: str = "top"):
-    pw, ph = page_rect.width, page_rect.height
-    s = min(pw / float(img_w), ph / float(img_h))
-    w = img_w * s
-    h = img_h * s
-
-    x0 = (pw - w) / 2.0
-    x1 = x0 + w
-
-    if align == "top":
-        y0, y1 = 0.0, h
-    elif align == "bottom":
-        y1, y0 = ph, ph - h
-    elif align == "center":
-        y0 = (ph - h) / 2.0
-        y1 = y0 + h
-    else:
-        raise ValueError("align phải là 'top' | 'bottom' | 'center'")
-
-    return type(page_rect)(x0, y0, x1, y1)
-
-def replace_page_with_png_inplace(
+def replace_page_with_image_inplace(
     pdf_path: Path,
-    png_path: Path,
+    image: "Path | Dict[str, Any]",
     page_index_to_replace: int,
     align: str = "top",
     crop_to_image: bool = True,
     make_backup: bool = False,
-) -> None:
-    try:
-        import fitz
-    except Exception as e:
-        raise RuntimeError("Thiếu PyMuPDF (fitz). Cài: pip install pymupdf") from e
-
-    if not pdf_path.exists():
-        raise FileNotFoundError(f"PDF not found: {pdf_path}")
-    if not png_path.exists():
-        raise FileNotFoundError(f"PNG not found: {png_path}")
-
-    src = fitz.open(str(pdf_path))
-    n = src.page_count
-    if not (0 <= page_index_to_replace < n):
-        src.close()
-        raise ValueError(f"page_index_to_replace không hợp lệ: {page_index_to_replace} / n={n}")
-
-    ref_rect = src[page_index_to_replace].rect
-    img_w, img_h = _img_wh(png_path)
-
-    out = fitz.open()
-    for i in range(n):
-        if i != page_index_to_replace:
-            out.insert_pdf(src, from_page=i, to_page=i)
-        else:
-            p = out.new_page(width=ref_rect.width, height=ref_rect.height)
-            img_rect = _rect_fit_on_page(p.rect, img_w, img_h, align=align)
-            p.insert_image(img_rect, filename=str(png_path))
-            if crop_to_image:
-                p.set_cropbox(img_rect)
-
-    if make_backup:
-        bak = pdf_path.with_suffix(pdf_path.suffix + ".bak")
-        if not bak.exists():
-            bak.write_bytes(pdf_path.read_bytes())
-
-    tmp_fd, tmp_name = tempfile.mkstemp(suffix=".pdf", dir=str(pdf_path.parent))
-    os.close(tmp_fd)
-    tmp_path = Path(tmp_name)
-
-    try:
-        out.save(str(tmp_path), garbage=4, deflate=True)
-        out.close()
-        src.close()
-        os.replace(str(tmp_path), str(pdf_path))
-    finally:
-        if tmp_path.exists():
-            try:
-                tmp_path.unlink()
-            except Exception:
-                pass
+) -> Dict[str, Any]:
+    """
+    Thay ngay 1 trang bằng ảnh (1 open/save). image: encode_image(...) hoặc Path tới file ảnh.
+    Nhiều trang / nhiều chunk => dùng PdfEditPlan (update_pdfs_for_content_head(edits=...)).
+    """
+    edit = make_edit(page_index_to_replace, image, align=align, crop_to_image=crop_to_image)
+    return apply_pdf_edits(pdf_path, [edit], make_backup=make_backup)
 
 def _prev_chunk_stem(cur_stem: str) -> Optional[str]:
     m = re.search(r"(.*_chunk_)(\d+)$", cur_stem)
@@ -777,11 +863,17 @@ def _prev_chunk_stem(cur_stem: str) -> Optional[str]:
 def update_pdfs_for_content_head(
     cur_chunk_pdf: Path,
     cur_chunk_stem: str,
-    top_png: Path,
-    bot_png: Path,
+    top_img: "Path | Dict[str, Any] | None",
+    bot_img: "Path | Dict[str, Any] | None",
     chunk_pdf_dir: Path,
     make_backup: bool = False,
+    edits: Optional[PdfEditPlan] = None,
+    clip_y: Optional[float] = None,
 ) -> Dict[str, Any]:
+    """
+    edits: có => chỉ xếp hàng vào plan (caller apply 1 lần / file), không => sửa PDF ngay như cũ.
+    clip_y (pt, page_clip_y): có => cắt bằng cropbox trên trang gốc, top_img/bot_img không dùng.
+    """
     import fitz
 
     result: Dict[str, Any] = {
@@ -791,10 +883,13 @@ def update_pdfs_for_content_head(
         "cur_pdf_path": str(cur_chunk_pdf.resolve()),
         "prev_last_page_index": None,
         "cur_first_page_index": 0,
+        "cut_mode": "clip" if clip_y is not None else "raster",
+        "queued": edits is not None,
     }
 
     # current: page 0
-    replace_page_with_png_inplace(cur_chunk_pdf, bot_png, 0, make_backup=make_backup)
+    result["cur_pdf_bytes"] = _replace_or_queue(cur_chunk_pdf, bot_img, 0, make_backup, edits,
+                                                clip=(clip_y, "bottom") if clip_y is not None else None)
     result["cur_pdf_updated"] = True
 
     # prev: last page (cấu trúc folder mới)
@@ -817,7 +912,10 @@ def update_pdfs_for_content_head(
                     d.close()
                     if n > 0:
                         last_idx = n - 1
-                        replace_page_with_png_inplace(prev_pdf, top_png, last_idx, make_backup=make_backup)
+                        result["prev_pdf_bytes"] = _replace_or_queue(
+                            prev_pdf, top_img, last_idx, make_backup, edits,
+                            clip=(clip_y, "top") if clip_y is not None else None,
+                        )
                         result["prev_pdf_updated"] = True
                         result["prev_pdf_path"] = str(prev_pdf.resolve())
                         result["prev_last_page_index"] = last_idx
@@ -825,61 +923,122 @@ def update_pdfs_for_content_head(
     return result
 
 
-# ============================
-# Process one chunk
-# ============================
-def process_one_chunk(
-    ocr: PaddleOCR,
-    chunk_json_path: Path,
-    chunk_pdf_path: Path,
-    out_dir: Path,
-) -> Optional[Dict[str, Any]]:
-    meta = read_json(chunk_json_path)
-
-    heading = str(meta.get("heading", "")).strip()
-    title = str(meta.get("title", "")).strip()
-
-    heading_num = extract_heading_num(heading)
-    if heading_num is None:
-        print("[SKIP] No heading_num:", chunk_json_path.name, "heading=", heading)
-        return None
-
-    is_content_head = bool(meta.get("content_head", False))
-    is_force_heading = (heading_num in FORCE_HEADING_NUMS)
+def size_report(
+    fmt: Optional[Dict[str, Any]],
+    top_img: Optional[Dict[str, Any]],
+    bot_img: Optional[Dict[str, Any]],
+    pdf_update: Dict[str, Any],
+) -> Dict[str, Any]:
+    """
+    Báo cáo cỡ cho cutline: ảnh thay trang (codec / quality / DPI + bytes top/bot; fmt=None => cắt clip, không ảnh)
+    và cỡ PDF trước/sau khi sửa. PDF đang xếp hàng (PdfEditPlan) => "after" do runner điền sau khi ghi
+    (= cỡ file sau lần ghi chứa edit này, có thể gồm cả edit của chunk khác cùng file).
+    """
+    image = None
+    if fmt is not None:
+        image = {k: fmt[k] for k in ("codec", "quality", "gray", "dpi")}
+        image["top_bytes"] = len(top_img["stream"]) if top_img else 0
+        image["bot_bytes"] = len(bot_img["stream"]) if bot_img else 0
+    pdf = {role: pdf_update[f"{role}_pdf_bytes"] for role in ("cur", "prev") if pdf_update.get(f"{role}_pdf_bytes")}
+    return {"image": image, "pdf": pdf}
+
+def dpi_ladder() -> List[int]:
+    """
+    DPI OCR tăng dần, luôn kết thúc ở DPI (DPI cắt).
+    """
+    return sorted({int(d) for d in DPI_LADDER if int(d) < DPI}) + [DPI]
 
-    # ✅ chỉ xử lý nếu content_head=True hoặc heading_num thuộc FORCE_HEADING_NUMS (vd: 1.)
-    if (not is_content_head) and (not is_force_heading):
-        return None
+def min_match_required(nexp: int) -> int:
+    # min_req "cứng" để gọi là chắc
+    if nexp <= 2:
+        return 1
+    if nexp == 3:
+        return 2
+    return min(MIN_MATCH_REQUIRED, nexp)
+
+def scale_line(ln: Dict[str, Any], s: float) -> Dict[str, Any]:
+    out = dict(ln)
+    for k in ("x0", "x1", "y0", "y1"):
+        out[k] = float(ln[k]) * s
+    out["items"] = [{**it, **{k: float(it[k]) * s for k in ("x0", "x1", "y0", "y1")}} for it in ln["items"]]
+    return out
 
-    expected_letters = build_expected_letters_from_title(title)
-    if not expected_letters:
-        print("[SKIP] No expected letters:", chunk_json_path.name, "title=", title)
-        return None
+def decide_cut(
+    matched: int,
+    obs: List[str],
+    best_mode: str,
+    expected_letters: List[str],
+    min_req: int,
+) -> Dict[str, Any]:
+    """
+    Quyết định cắt từ kết quả match (không cần ảnh):
+      cut=True, weak_cut=False       : match đủ min_req
+      cut=True, weak_cut=True        : match thấp nhưng LCS/coverage đạt (weak) hoặc mode mạnh (force)
+      cut=False                      : hard fail
+    """
+    out: Dict[str, Any] = {"cut": True, "weak_cut": False, "weak_reason": None, "lcs": None, "cov_obs": None, "cov_exp": None}
+    if matched >= min_req:
+        return out
 
-    img = render_pdf_page0_to_bgr(chunk_pdf_path, dpi=DPI)
+    nexp = len(expected_letters)
+    # ---- tính LCS để xem có phải OCR rụng chữ nhưng vẫn đúng line không ----
+    lcs = lcs_len(expected_letters, obs)
+    cov_obs = lcs / max(1, len(obs))
+    cov_exp = lcs / max(1, len(expected_letters))
+    out.update({"lcs": int(lcs), "cov_obs": float(cov_obs), "cov_exp": float(cov_exp)})
+
+    begin_ok = (nexp == 0) or (expected_letters[0] in obs[:3])
+    weak_min_lcs = 1 if nexp <= 2 else WEAK_MIN_LCS
+
+    allow_weak = (
+        ALLOW_WEAK_CUT
+        and (best_mode in WEAK_ALLOWED_MODES)
+        and begin_ok
+        and (lcs >= weak_min_lcs)
+        and (cov_exp >= WEAK_COV_EXP)
+        and (cov_obs >= WEAK_COV_OBS)
+        and (len(obs) >= WEAK_MIN_OBS or nexp <= 3)
+    )
 
-    res = run_ocr_any(ocr, img)
-    # nếu res là kiểu predict cũ thì dùng iter_dets_predict, còn ocr.ocr thì dùng iter_dets_paddleocr
-    if isinstance(res, list) and res and isinstance(res[0], list) and res and (len(res[0]) == 0 or isinstance(res[0][0], (list, tuple))):
-        dets_raw = iter_dets_paddleocr(res)
+    # allow_weak => weak_cut theo tiêu chí LCS/coverage
+    if allow_weak:
+        out.update({
+            "weak_cut": True,
+            "weak_reason": f"weak_cut_low_match_{matched}_{nexp}_lcs_{lcs}_covExp_{cov_exp:.2f}_covObs_{cov_obs:.2f}",
+        })
+    # force_cut => match thấp nhưng vẫn tin vì mode mạnh (prefix_line)
+    elif best_mode in FORCE_CUT_ON_MODES:
+        out.update({"weak_cut": True, "weak_reason": f"force_cut_mode_{best_mode}_low_match_{matched}_{nexp}"})
     else:
-        dets_raw = iter_dets_predict(res)
-
-    dets = [d for d in dets_raw if d["score"] >= float(MIN_SCORE)]
-
-    if not dets:
-        print("[FAIL] NO DETS:", chunk_json_path.name)
-        return None
+        out["cut"] = False
+    return out
 
+def find_best_line(
+    dets: List[Dict[str, Any]],
+    heading_num: int,
+    expected_letters: List[str],
+    *,
+    is_content_head: bool,
+    is_force_heading: bool,
+    matcher: Optional[HeadingMatcher] = None,
+) -> Optional[Tuple[int, int, Dict[str, Any], List[str], str]]:
+    """
+    Gom dets thành line, chấm từng line theo các mode
+    (prefix_line / title_only / heading_left_title / same_line / merge_next).
+    Return (score, matched, line, obs_letters, mode) tốt nhất, None nếu không line nào có candidate.
+    matcher: tạo 1 lần / chunk rồi truyền qua mọi DPI => initials + match của line đã gặp không tính lại.
+    """
+    if matcher is None:
+        matcher = HeadingMatcher(heading_num, expected_letters)
     hs = [(d["y1"] - d["y0"]) for d in dets]
     med_h = float(np.median(hs)) if hs else 20.0
     y_tol = max(10.0, med_h * 0.6)
     lines = group_to_lines(dets, y_tol=y_tol)
 
     heading_cands = collect_heading_candidates(dets, heading_num)
+    heading_index = index_heading_candidates(heading_cands)
 
     best = None  # (score, matched, ln, obs_letters, mode)
-    best_mode = "none"
 
     for i, ln in enumerate(lines):
         items = ln["items"]
@@ -887,17 +1046,17 @@ def process_one_chunk(
             continue
 
         # luôn tính title initials để dùng cho heading_left_title / scoring
-        obs_title = extract_initials_no_case_change(ln["text"])
-        matched_title = robust_match_count(obs_title, expected_letters)
+        obs_title = matcher.initials(ln["text"])
+        matched_title = matcher.match(obs_title)
 
         cand_list: List[Tuple[int, int, Dict[str, Any], List[str], str]] = []
 
         # ✅ prefix_line: line bắt đầu bằng "1." hoặc "1 " => có heading evidence mạnh
         has_pref, rem = split_heading_prefix(ln["text"], heading_num, require_dot=False)
         if has_pref:
-            obs_pref = extract_initials_no_case_change(rem)
-            matched_pref = robust_match_count(obs_pref, expected_letters)
-            has_dot_pref = _has_dot_heading(ln["text"], heading_num)
+            obs_pref = matcher.initials(rem)
+            matched_pref = matcher.match(obs_pref)
+            has_dot_pref = has_dot_heading(ln["text"], heading_num)
             sc_pref = _score(matched_pref, True, has_dot_pref)
             cand_list.append((sc_pref, matched_pref, ln, obs_pref, "prefix_line"))
 
@@ -909,7 +1068,7 @@ def process_one_chunk(
             cand_list.append((sc_title, matched_title, ln, obs_title, "title_only"))
 
         # 2) heading_left_title: heading bị OCR tách rời (1/1.) nằm bên trái title
-        h_left = find_heading_left_for_line(heading_cands, ln)
+        h_left = find_heading_left_for_line(heading_cands, ln, index=heading_index)
         if h_left is not None:
             sc_hleft = _score(matched_title, True, bool(h_left.get("has_dot", False)))
             cand_list.append((sc_hleft, matched_title, ln, obs_title, "heading_left_title"))
@@ -918,16 +1077,16 @@ def process_one_chunk(
         seq, hbbox, has_dot = build_seq_from_line_items(items, heading_num)
         if seq is not None and hbbox is not None:
             obs_same = seq[1:]
-            matched_same = robust_match_count(obs_same, expected_letters)
+            matched_same = matcher.match(obs_same)
             sc_same = _score(matched_same, True, has_dot)
             cand_list.append((sc_same, matched_same, ln, obs_same, "same_line"))
 
             # merge_next: title nằm line kế cận
             if matched_same < len(expected_letters):
-                m2, obs2 = try_merge_title_from_next_lines(lines, i, hbbox, expected_letters, look_ahead=3)
+                m2, obs2 = try_merge_title_from_next_lines(lines, i, hbbox, expected_letters, look_ahead=3, matcher=matcher)
 
                 # cho phép “ghép” phần chữ sau heading trong cùng item + title ở line kế
-                matched_merge_comb = robust_match_count(obs_same + obs2, expected_letters) if obs2 else m2
+                matched_merge_comb = matcher.match(obs_same + obs2) if obs2 else m2
 
                 if matched_merge_comb >= m2:
                     matched_merge = matched_merge_comb
@@ -949,12 +1108,134 @@ def process_one_chunk(
 
         if best is None or sc > best[0]:
             best = (sc, matched, ln_best, obs_best, mode_best)
-            best_mode = mode_best
 
         # stop sớm nếu match full (dù mode nào)
         if matched >= len(expected_letters):
             break
 
+    return best
+
+
+# ============================
+# Process one chunk
+# ============================
+def process_one_chunk(
+    ocr: PaddleOCR,
+    chunk_json_path: Path,
+    chunk_pdf_path: Path,
+    out_dir: Path,
+    meta: Optional[Dict[str, Any]] = None,
+    index: Optional[ChunkIndex] = None,
+    img: Optional[np.ndarray] = None,
+    dets: Optional[List[Dict[str, Any]]] = None,
+    write_cutline: bool = True,
+    img_dpi: Optional[int] = None,
+    dpi_stats: Optional[Dict[str, Dict[str, int]]] = None,
+    ocr_cache: Optional[OcrCache] = None,
+    page_sha: Optional[str] = None,
+    edits: Optional[PdfEditPlan] = None,
+    scan: Optional[Dict[str, Any]] = None,
+    image_codec: Optional[Dict[str, Any]] = None,
+) -> Optional[Dict[str, Any]]:
+    """
+    meta: truyền sẵn (đọc từ chunk index) thì khỏi đọc chunk_json_path.
+    index: có thì cutline ghi vào index (json rời chỉ khi JSON_MIRROR).
+    img/dets: page0 đã render + OCR sẵn (batch) thì khỏi render/OCR lại.
+    write_cutline=False: chỉ return payload (worker process, parent tự save_cutline).
+    img_dpi: DPI của img truyền vào (mặc định DPI). dpi_stats: cộng dồn {dpi: {tried, hit}} theo thang DPI.
+    ocr_cache: có thì đọc/ghi dets theo (page hash, dpi, engine, tham số det); page_sha tính sẵn thì truyền vào.
+    edits: có => thay trang PDF chỉ xếp hàng vào plan, caller apply (1 open/save / file).
+    scan: img là ảnh JPEG nhúng (load_page0, SCAN_FAST_PATH) => OCR + cắt luôn ở DPI gốc, top/bot ghi JPEG.
+    image_codec: parse_image_codec / book_image_codec (mặc định IMAGE_CODEC) => cách encode ảnh thay trang.
+    """
+    if meta is None:
+        meta = read_json(chunk_json_path)
+
+    heading = str(meta.get("heading", "")).strip()
+    title = str(meta.get("title", "")).strip()
+
+    heading_num = extract_heading_num(heading)
+    if heading_num is None:
+        print("[SKIP] No heading_num:", chunk_json_path.name, "heading=", heading)
+        return None
+
+    is_content_head = bool(meta.get("content_head", False))
+    is_force_heading = (heading_num in FORCE_HEADING_NUMS)
+
+    # ✅ chỉ xử lý nếu content_head=True hoặc heading_num thuộc FORCE_HEADING_NUMS (vd: 1.)
+    if (not is_content_head) and (not is_force_heading):
+        return None
+
+    expected_letters = build_expected_letters_from_title(title)
+    if not expected_letters:
+        print("[SKIP] No expected letters:", chunk_json_path.name, "title=", title)
+        return None
+
+    nexp = len(expected_letters)
+    min_req = min_match_required(nexp)
+    matcher = HeadingMatcher(heading_num, expected_letters)
+
+    # ---- thang DPI: OCR ở DPI thấp trước, chỉ render + OCR lại DPI cao hơn khi match yếu ----
+    ladder = dpi_ladder()
+    if img is None and SCAN_FAST_PATH:
+        img, img_dpi, scan = load_page0(chunk_pdf_path, ladder[0])
+    if img is not None:
+        img_dpi = int(img_dpi or DPI)
+        # trang scan: ảnh gốc là tất cả pixel đang có => không leo thang, không render lại
+        ladder = [img_dpi] if scan is not None else [img_dpi] + [d for d in ladder if d > img_dpi]
+    cut_dpi = ladder[0] if scan is not None else DPI
+    source = "scan" if scan is not None else "render"
+
+    if ocr_cache is not None and page_sha is None:
+        page_sha = page_hash(chunk_pdf_path)
+
+    roi: Optional[Dict[str, Any]] = None
+    best = None  # (score, matched, ln, obs_letters, mode)
+    dpi_tries: List[Dict[str, Any]] = []
+    det_dpi = ladder[0]
+    img_at = ladder[0] if img is not None else None   # DPI của img hiện có
+    for k, det_dpi in enumerate(ladder):
+        if k > 0:
+            dets = None
+        key = ocr_cache_key(page_sha, det_dpi, heading_num, source) if ocr_cache is not None else None
+        if dets is None and key:
+            entry = ocr_cache.get_entry(key)
+            if entry is not None and isinstance(entry.get("dets"), list):
+                dets, roi = entry["dets"], entry.get("roi")
+        if dets is None:
+            if img_at != det_dpi:
+                img, img_at = render_pdf_page0_to_bgr(chunk_pdf_path, dpi=det_dpi), det_dpi
+            if ROI_OCR:
+                dets, roi = ocr_roi_dets(ocr, img, heading_num)
+            else:
+                dets = ocr_image_dets(ocr, img)
+            if key:
+                ocr_cache.put(key, dets, {"dpi": int(det_dpi), "engine": ocr_engine_id(), "roi": roi, "source": source})
+
+        best = find_best_line(
+            dets, heading_num, expected_letters,
+            is_content_head=is_content_head, is_force_heading=is_force_heading, matcher=matcher,
+        ) if dets else None
+        hit = best is not None and best[1] >= min_req and best[4] in DPI_TRUSTED_MODES
+        dpi_tries.append({
+            "dpi": int(det_dpi),
+            "dets": len(dets or []),
+            "matched": int(best[1]) if best else 0,
+            "mode": best[4] if best else "none",
+            "hit": bool(hit),
+            "cache_key": key,   # dets ở Output/<book>/ocr_cache/ => replay không cần OCR
+        })
+        if dpi_stats is not None:
+            st = dpi_stats.setdefault(str(det_dpi), {"tried": 0, "hit": 0})
+            st["tried"] += 1
+            st["hit"] += int(hit)
+        if hit:
+            break
+
+    if not dets:
+        print("[FAIL] NO DETS:", chunk_json_path.name)
+        return None
+
     if best is None:
         print("[FAIL] No line matched:", chunk_json_path.name)
         return None
@@ -966,106 +1247,70 @@ def process_one_chunk(
         print(f"[FAIL] content_head nhưng không có heading evidence => skip cut: {chunk_json_path.name}")
         return None
 
-    nexp = len(expected_letters)
-    # min_req "cứng" để gọi là chắc
-    if nexp <= 2:
-        min_req = 1
-    elif nexp == 3:
-        min_req = 2
-    else:
-        min_req = min(MIN_MATCH_REQUIRED, nexp)
-
-    weak_cut = False
-    weak_reason = None
-
-    if matched < min_req:
-        # ---- tính LCS để xem có phải OCR rụng chữ nhưng vẫn đúng line không ----
-        def _lcs_len(a, b):
-            n, m = len(a), len(b)
-            dp = [0] * (m + 1)
-            for i in range(1, n + 1):
-                prev = 0
-                ai = a[i - 1]
-                for j in range(1, m + 1):
-                    cur = dp[j]
-                    if ai == b[j - 1]:
-                        dp[j] = prev + 1
-                    else:
-                        dp[j] = dp[j] if dp[j] >= dp[j - 1] else dp[j - 1]
-                    prev = cur
-            return dp[m]
-
-        lcs = _lcs_len(expected_letters, obs)
-        cov_obs = lcs / max(1, len(obs))
-        cov_exp = lcs / max(1, len(expected_letters))
-
-        begin_ok = (nexp == 0) or (expected_letters[0] in obs[:3])
-        weak_min_lcs = 1 if nexp <= 2 else WEAK_MIN_LCS
-
-        allow_weak = (
-            ALLOW_WEAK_CUT
-            and (best_mode in WEAK_ALLOWED_MODES)
-            and begin_ok
-            and (lcs >= weak_min_lcs)
-            and (cov_exp >= WEAK_COV_EXP)
-            and (cov_obs >= WEAK_COV_OBS)
-            and (len(obs) >= WEAK_MIN_OBS or nexp <= 3)
-        )
-
-        force_cut = (best_mode in FORCE_CUT_ON_MODES)
-
-        if (not allow_weak) and (not force_cut):
-            # HARD FAIL như cũ
-            y_line = int(round(ln["y0"] - OFFSET))
-            y_line = max(0, min(y_line, img.shape[0] - 1))
-
-            stem = chunk_json_path.stem
-            out_dir.mkdir(parents=True, exist_ok=True)
+    # match ở DPI thấp => cắt trên ảnh DPI (y_line / bbox scale theo DPI, OFFSET tính ở DPI)
+    # trang scan: cut_dpi = DPI gốc = det_dpi => cắt thẳng trên ảnh đã OCR
+    if det_dpi != cut_dpi:
+        ln = scale_line(ln, float(cut_dpi) / float(det_dpi))
+    if img_at != cut_dpi:
+        img = render_pdf_page0_to_bgr(chunk_pdf_path, dpi=cut_dpi)
+    scan_info = None
+    if scan is not None:
+        scan_info = {"w": scan["w"], "h": scan["h"], "dpi": round(float(scan["dpi"]), 2),
+                     "quality": scan.get("quality"), "gray": scan.get("gray")}
+
+    cut = decide_cut(matched, obs, best_mode, expected_letters, min_req)
+    weak_cut = cut["weak_cut"]
+    weak_reason = cut["weak_reason"]
+
+    if not cut["cut"]:
+        lcs, cov_obs, cov_exp = cut["lcs"], cut["cov_obs"], cut["cov_exp"]
+        # HARD FAIL như cũ
+        y_line = int(round(ln["y0"] - OFFSET))
+        y_line = max(0, min(y_line, img.shape[0] - 1))
+
+        stem = chunk_json_path.stem
+        out_dir.mkdir(parents=True, exist_ok=True)
+
+        out_debug_png = out_dir / f"{stem}_cutline.png"
+        out_cut_json  = out_dir / f"{stem}_cutline.json"
+
+        label = f"{heading} | {best_mode} | match {matched}/{len(expected_letters)} | obs={''.join(obs[:12])}"
+        draw_debug(img, ln, y_line, out_debug_png, label=label, inplace=True)
+
+        payload = {
+            "failed": True,
+            "fail_reason": f"low_match_{matched}_{len(expected_letters)}",
+            "chunk_json": str(chunk_json_path.resolve()),
+            "chunk_pdf": str(chunk_pdf_path.resolve()),
+            "heading": heading,
+            "heading_num": int(heading_num),
+            "title": title,
+            "expected_letters": expected_letters,
+            "matched_prefix": int(matched),
+            "observed_initials": obs,
+            "best_mode": best_mode,
+            "line_bbox": {"x0": ln["x0"], "y0": ln["y0"], "x1": ln["x1"], "y1": ln["y1"]},
+            "y_line": int(y_line),
+            "dpi": int(cut_dpi),
+            "offset_px": int(OFFSET),
+            "image_size": {"w": int(img.shape[1]), "h": int(img.shape[0])},
+            "debug_png": str(out_debug_png),
+            "lcs": int(lcs),
+            "cov_obs": float(cov_obs),
+            "cov_exp": float(cov_exp),
+            "roi": roi,
+            "detect_dpi": int(det_dpi),
+            "dpi_tries": dpi_tries,
+            "source": source,
+            "scan": scan_info,
+        }
+        save_cutline(out_cut_json, payload, index=index)
+
+        print(f"[FAIL] Low match {matched}/{len(expected_letters)} => saved debug:", out_debug_png)
+        return None
 
-            out_debug_png = out_dir / f"{stem}_cutline.png"
-            out_cut_json  = out_dir / f"{stem}_cutline.json"
-
-            label = f"{heading} | {best_mode} | match {matched}/{len(expected_letters)} | obs={''.join(obs[:12])}"
-            draw_debug(img, ln, y_line, out_debug_png, label=label)
-
-            payload = {
-                "failed": True,
-                "fail_reason": f"low_match_{matched}_{len(expected_letters)}",
-                "chunk_json": str(chunk_json_path.resolve()),
-                "chunk_pdf": str(chunk_pdf_path.resolve()),
-                "heading": heading,
-                "heading_num": int(heading_num),
-                "title": title,
-                "expected_letters": expected_letters,
-                "matched_prefix": int(matched),
-                "observed_initials": obs,
-                "best_mode": best_mode,
-                "line_bbox": {"x0": ln["x0"], "y0": ln["y0"], "x1": ln["x1"], "y1": ln["y1"]},
-                "y_line": int(y_line),
-                "dpi": int(DPI),
-                "offset_px": int(OFFSET),
-                "image_size": {"w": int(img.shape[1]), "h": int(img.shape[0])},
-                "debug_png": str(out_debug_png),
-                "lcs": int(lcs),
-                "cov_obs": float(cov_obs),
-                "cov_exp": float(cov_exp),
-            }
-            write_json_atomic(out_cut_json, payload)
-
-            print(f"[FAIL] Low match {matched}/{len(expected_letters)} => saved debug:", out_debug_png)
-            return None
-
-        # allow_weak => weak_cut theo tiêu chí LCS/coverage
-        if allow_weak:
-            weak_cut = True
-            weak_reason = f"weak_cut_low_match_{matched}_{nexp}_lcs_{lcs}_covExp_{cov_exp:.2f}_covObs_{cov_obs:.2f}"
-            print("[WARN]", weak_reason, "=> still cutting:", chunk_json_path.name)
-
-        # force_cut => match thấp nhưng vẫn tin vì mode mạnh (prefix_line)
-        elif force_cut:
-            weak_cut = True
-            weak_reason = f"force_cut_mode_{best_mode}_low_match_{matched}_{nexp}"
-            print("[WARN]", weak_reason, "=> still cutting + updating:", chunk_json_path.name)
+    if weak_cut:
+        print("[WARN]", weak_reason, "=> still cutting:", chunk_json_path.name)
 
     y_line = int(round(ln["y0"] - OFFSET))
     y_line = max(0, min(y_line, img.shape[0] - 1))
@@ -1075,17 +1320,30 @@ def process_one_chunk(
 
     out_debug_png = out_dir / f"{stem}_cutline.png"
     out_cut_json  = out_dir / f"{stem}_cutline.json"
-    out_top_png   = out_dir / f"{stem}_cutline_top.png"
-    out_bot_png   = out_dir / f"{stem}_cutline_bot.png"
+    # codec ảnh thay trang (trang scan: mặc định JPEG cùng quality ảnh gốc, xem split_format)
+    fmt = split_format(image_codec or parse_image_codec(IMAGE_CODEC), cut_dpi, scan)
+    out_top_png   = out_dir / f"{stem}_cutline_top{fmt['ext']}"
+    out_bot_png   = out_dir / f"{stem}_cutline_bot{fmt['ext']}"
 
     label = f"{heading} | {best_mode} | match {matched}/{len(expected_letters)} | obs={''.join(obs[:12])}"
-
-    draw_debug(img, ln, y_line, out_debug_png, label=label)
     pdf_update_allowed = (not PDF_UPDATE_DISABLED)
 
+    # CUT_MODE=clip: line cắt (px ở DPI) -> pt trên trang gốc; trang xoay / lỗi => raster
+    clip_y: Optional[float] = None
+    if CUT_MODE == "clip":
+        try:
+            clip_y = page_clip_y(chunk_pdf_path, 0, y_line, img.shape[0])
+        except Exception as e:
+            print("[WARN] clip cut unavailable => raster:", chunk_json_path.name, repr(e))
+    encode = clip_y is None or SAVE_SPLIT_PNG
+
     # ✅ nếu content_head=True => giữ y nguyên (top+bot + update prev/current)
     if is_content_head:
-        split_info = split_and_save(img, y_line, out_top_png, out_bot_png)
+        split_info, top_img, bot_img = split_image(img, y_line, encode=encode, fmt=fmt)
+        if SAVE_SPLIT_PNG:
+            for enc, p in ((top_img, out_top_png), (bot_img, out_bot_png)):
+                if enc is not None:
+                    write_encoded(p, enc)
 
         pdf_update: Dict[str, Any] = {"skipped": True, "reason": "disabled or not available", "split_info": split_info}
 
@@ -1093,10 +1351,12 @@ def process_one_chunk(
             pdf_update = update_pdfs_for_content_head(
                 cur_chunk_pdf=chunk_pdf_path,
                 cur_chunk_stem=stem,
-                top_png=out_top_png,
-                bot_png=out_bot_png,
+                top_img=top_img,
+                bot_img=bot_img,
                 chunk_pdf_dir=chunk_pdf_path.parent,
                 make_backup=MAKE_PDF_BACKUP,
+                edits=edits,
+                clip_y=clip_y,
             )
         else:
             reason = "DISABLE_PDF_UPDATE=1" if PDF_UPDATE_DISABLED else "split_missing"
@@ -1104,21 +1364,28 @@ def process_one_chunk(
 
     # ✅ nếu content_head=False nhưng heading_num=1 => bot-only + replace page[0] của chính pdf
     else:
-        # chỉ lưu bot
-        split_info = split_and_save_bot_only(img, y_line, out_bot_png)
+        # chỉ cần bot
+        split_info, top_img, bot_img = split_image(img, y_line, with_top=False, encode=encode, fmt=fmt)
+        if SAVE_SPLIT_PNG and bot_img is not None:
+            write_encoded(out_bot_png, bot_img)
 
         pdf_update: Dict[str, Any] = {"skipped": True, "reason": "disabled or not available", "split_info": split_info}
 
         if pdf_update_allowed and split_info.get("bot_saved"):
             pdf_update = update_pdf_page0_with_bot_only(
                 cur_chunk_pdf=chunk_pdf_path,
-                bot_png=out_bot_png,
+                bot_img=bot_img,
                 make_backup=MAKE_PDF_BACKUP,
+                edits=edits,
+                clip_y=clip_y,
             )
         else:
             reason = "weak_cut" if weak_cut else "DISABLE_PDF_UPDATE=1"
             pdf_update = {"skipped": True, "reason": reason, "split_info": split_info}
 
+    # vẽ debug sau khi đã lưu top/bot => vẽ thẳng lên img, không copy cả trang
+    draw_debug(img, ln, y_line, out_debug_png, label=label, inplace=True)
+
     prefix_hits = prefix_match_count(obs, expected_letters)
     payload = {
         "chunk_json": str(chunk_json_path.resolve()),
@@ -1131,10 +1398,13 @@ def process_one_chunk(
         "observed_initials": obs,
         "line_bbox": {"x0": ln["x0"], "y0": ln["y0"], "x1": ln["x1"], "y1": ln["y1"]},
         "y_line": int(y_line),
-        "dpi": int(DPI),
+        "dpi": int(cut_dpi),
         "offset_px": int(OFFSET),
         "image_size": {"w": int(img.shape[1]), "h": int(img.shape[0])},
+        "colorspace": "gray" if img.ndim == 2 else "bgr",
         "split_info": split_info,
+        "cut_mode": "clip" if clip_y is not None else "raster",
+        "clip_y_pt": (round(clip_y, 3) if clip_y is not None else None),
         "pdf_update": pdf_update,
         "mode": "content_head" if is_content_head else "heading_bot_only",
         "best_mode": best_mode,  # ✅ mode thật sự: title_only / heading_left_title / same_line / merge_next / prefix_line
@@ -1149,59 +1419,303 @@ def process_one_chunk(
         "soft_fail": bool(weak_cut),
         "soft_fail_reason": weak_reason,
         "force_cut": bool(best_mode in FORCE_CUT_ON_MODES),
+        "roi": roi,   # ROI_OCR: box đã rec (debug, toạ độ ở detect_dpi), None = OCR cả trang
+        "detect_dpi": int(det_dpi),   # DPI tìm ra line (line_bbox / y_line đã scale về DPI)
+        "dpi_tries": dpi_tries,
+        "source": source,   # "scan" = OCR + cắt trên ảnh JPEG nhúng (dpi = DPI gốc), "render" = như cũ
+        "scan": scan_info,
+        "size_report": size_report(fmt if clip_y is None else None, top_img, bot_img, pdf_update),
     }
-    write_json_atomic(out_cut_json, payload)
+    if write_cutline:
+        save_cutline(out_cut_json, payload, index=index)
     return payload
 
 
 # ============================
 # Main
 # ============================
-def build_ocr() -> PaddleOCR:
-    common = dict(
-        lang=LANG,
-        use_textline_orientation=False,
-        use_doc_orientation_classify=False,
-        use_doc_unwarping=False,
-    )
-    if DET_NO_RESIZE:
+def build_ocr(cpu_threads: Optional[int] = None) -> PaddleOCR:
+    return _build_ocr(lang=LANG, cpu_threads=cpu_threads, det_no_resize=DET_NO_RESIZE)
+
+def _needs_ocr(meta: Dict[str, Any]) -> bool:
+    """
+    Giống các check đầu process_one_chunk: chunk nào thật sự cần render + OCR page0.
+    """
+    heading_num = extract_heading_num(str(meta.get("heading", "")).strip())
+    if heading_num is None:
+        return False
+    if not (bool(meta.get("content_head", False)) or heading_num in FORCE_HEADING_NUMS):
+        return False
+    return bool(build_expected_letters_from_title(str(meta.get("title", "")).strip()))
+
+def iter_render_batches(jobs: List[Dict[str, Any]]):
+    """
+    Render page0 trước cho nhiều job (ở bậc đầu của thang DPI; trang scan => ảnh JPEG gốc, xem load_page0),
+    cắt batch theo OCR_BATCH_SIZE / OCR_BATCH_MAX_MB.
+    yield [(job, img | None, err | None, img_dpi, scan | None), ...]
+    """
+    dpi0 = dpi_ladder()[0]
+    batch: List[Tuple[Dict[str, Any], Optional[np.ndarray], Optional[Exception], int, Optional[Dict[str, Any]]]] = []
+    used_mb = 0.0
+    for job in jobs:
+        img, err, img_dpi, scan = None, None, dpi0, None
+        if _needs_ocr(job["meta"]):
+            try:
+                img, img_dpi, scan = load_page0(job["pdf_path"], dpi0)
+            except Exception as e:
+                err = e
+        mb = (img.nbytes / (1024 * 1024)) if img is not None else 0.0
+        if batch and (len(batch) >= OCR_BATCH_SIZE or used_mb + mb > OCR_BATCH_MAX_MB):
+            yield batch
+            batch, used_mb = [], 0.0
+        batch.append((job, img, err, img_dpi, scan))
+        used_mb += mb
+    if batch:
+        yield batch
+
+def run_jobs_batched(
+    ocr: PaddleOCR,
+    jobs: List[Dict[str, Any]],
+    index: Optional[ChunkIndex] = None,
+    write_cutline: bool = True,
+    dpi_stats: Optional[Dict[str, Dict[str, int]]] = None,
+    ocr_cache: Optional[OcrCache] = None,
+    edit_stats: Optional[Dict[str, Any]] = None,
+    image_codec: Optional[Dict[str, Any]] = None,
+):
+    """
+    Chạy process_one_chunk cho list job theo batch OCR (đúng thứ tự job).
+    ocr_cache: chunk đã có dets trong cache thì không OCR lại.
+    Thay trang PDF gom theo lesson (PdfEditPlan): hết lesson / vượt PDF_EDIT_MAX_MB mới ghi,
+    mỗi PDF 1 open/save; kết quả của chunk (và cutline, kèm cỡ PDF sau khi ghi) chỉ ra sau khi PDF của nó đã ghi xong.
+    edit_stats: cộng dồn số file / trang / bytes đã ghi. image_codec: codec ảnh thay trang của book.
+    yield (job, payload | None, err | None, sec)
+    """
+    edits = PdfEditPlan()
+    pending: List[Tuple[Dict[str, Any], Optional[Dict[str, Any]], Optional[Exception], float]] = []
+
+    def flush():
+        t0 = time.perf_counter()
+        res = edits.apply(make_backup=MAKE_PDF_BACKUP)
+        if edit_stats is not None:
+            merge_edit_stats(edit_stats, summarize_edits(res))
+        share = (time.perf_counter() - t0) / max(1, len(pending))
+        for job, payload, err, sec in pending:
+            if payload is not None:
+                upd = payload.get("pdf_update") or {}
+                for role in ("cur", "prev"):
+                    r = res.get(upd.get(f"{role}_pdf_path") or "")
+                    if r and upd.get(f"{role}_pdf_bytes") and "size" in r:
+                        upd[f"{role}_pdf_bytes"]["after"] = int(r["size"])
+                bad = [res[p]["error"] for p in (upd.get("cur_pdf_path"), upd.get("prev_pdf_path")) if p in res and res[p].get("error")]
+                if write_cutline:
+                    save_cutline(job["out_dir"] / f"{job['jp'].stem}_cutline.json", payload, index=index)
+                if bad:
+                    payload, err = None, RuntimeError(f"pdf_update_failed: {bad[0]}")
+            yield job, payload, err, sec + share
+        pending.clear()
+
+    for batch in iter_render_batches(jobs):
+        t0 = time.perf_counter()
+        shas: Dict[int, Optional[str]] = {}
+        dets_of: Dict[int, Any] = {}
+        ready = []
+        keys: Dict[int, str] = {}
+        for k, (job, img, err, img_dpi, scan) in enumerate(batch):
+            if img is None or err is not None:
+                continue
+            if ocr_cache is not None:
+                try:
+                    shas[k] = page_hash(job["pdf_path"])
+                except Exception:
+                    shas[k] = None
+            # ROI_OCR: mỗi chunk tự det/rec vùng heading (+ cache) trong process_one_chunk
+            if ROI_OCR:
+                continue
+            if shas.get(k):
+                keys[k] = ocr_cache_key(shas[k], img_dpi, source="scan" if scan is not None else "render")
+                cached = ocr_cache.get(keys[k])
+                if cached is not None:
+                    dets_of[k] = cached
+                    continue
+            ready.append((k, img))
         try:
-            return PaddleOCR(**{**common, "text_det_limit_type": "max", "text_det_limit_side_len": 4096})
+            dets_list = ocr_batch_dets(ocr, [img for _k, img in ready])
         except Exception:
-            return PaddleOCR(**{**common, "det_limit_type": "max", "det_limit_side_len": 4096})
-    return PaddleOCR(**common)
-
-def run_postprocess_for_book(book_dir: str | Path) -> Dict[str, Any]:
+            dets_list = [None] * len(ready)   # batch lỗi => từng chunk tự OCR lại
+        for (k, _img), d in zip(ready, dets_list):
+            dets_of[k] = d
+            if d is not None and k in keys:
+                _job, _img, _err, img_dpi, scan = batch[k]
+                ocr_cache.put(keys[k], d, {
+                    "dpi": int(img_dpi), "engine": ocr_engine_id(), "roi": None,
+                    "source": "scan" if scan is not None else "render",
+                })
+        ocr_sec = (time.perf_counter() - t0) / max(1, len(batch))
+
+        for k, (job, img, err, img_dpi, scan) in enumerate(batch):
+            if pending and (pending[-1][0]["lesson_stem"] != job["lesson_stem"] or edits.over_limit()):
+                yield from flush()
+            t1 = time.perf_counter()
+            if err is not None:
+                pending.append((job, None, err, 0.0))
+                continue
+            try:
+                payload = process_one_chunk(
+                    ocr, job["jp"], job["pdf_path"], job["out_dir"],
+                    meta=job["meta"], index=index, img=img, dets=dets_of.get(k), write_cutline=False,
+                    img_dpi=img_dpi, dpi_stats=dpi_stats, ocr_cache=ocr_cache, page_sha=shas.get(k), edits=edits,
+                    scan=scan, image_codec=image_codec,
+                )
+                pending.append((job, payload, None, ocr_sec + time.perf_counter() - t1))
+            except Exception as e:
+                pending.append((job, None, e, ocr_sec + time.perf_counter() - t1))
+    yield from flush()
+
+_worker_ocr: Optional[PaddleOCR] = None
+
+def _pool_init(threads: int) -> None:
+    global _worker_ocr
+    _worker_ocr = build_ocr(cpu_threads=threads)
+
+def _pool_run_lesson(
+    jobs: List[Dict[str, Any]], ocr_cache: Optional[OcrCache] = None, image_codec: Optional[Dict[str, Any]] = None,
+) -> Tuple[List[Tuple[int, Optional[Dict[str, Any]], Optional[str], float]], Dict[str, Dict[str, int]], Dict[str, Any]]:
+    """
+    Worker: chạy tuần tự các chunk của 1 lesson (update_pdfs_for_content_head sửa trang cuối chunk trước).
+    Không đụng index / state db / meta: return (kết quả, dpi_stats, edit_stats) để parent ghi.
+    """
+    out = []
+    stats: Dict[str, Dict[str, int]] = {}
+    edit_stats: Dict[str, Any] = {}
+    for job, payload, err, sec in run_jobs_batched(
+        _worker_ocr, jobs, index=None, write_cutline=False, dpi_stats=stats, ocr_cache=ocr_cache,
+        edit_stats=edit_stats, image_codec=image_codec,
+    ):
+        out.append((job["i"], payload, (repr(err) if err is not None else None), sec))
+    return out, stats, edit_stats
+
+def merge_dpi_stats(dst: Dict[str, Dict[str, int]], src: Dict[str, Dict[str, int]]) -> None:
+    for dpi, st in src.items():
+        cur = dst.setdefault(dpi, {"tried": 0, "hit": 0})
+        cur["tried"] += int(st.get("tried", 0))
+        cur["hit"] += int(st.get("hit", 0))
+
+def run_jobs_pool(
+    jobs: List[Dict[str, Any]],
+    index: Optional[ChunkIndex],
+    workers: int,
+    threads: int,
+    dpi_stats: Optional[Dict[str, Dict[str, int]]] = None,
+    ocr_cache: Optional[OcrCache] = None,
+    edit_stats: Optional[Dict[str, Any]] = None,
+    image_codec: Optional[Dict[str, Any]] = None,
+):
+    """
+    Chia job theo lesson cho `workers` process (spawn), mỗi process build 1 PaddleOCR (threads thread).
+    Cutline được ghi ở parent (index + json rời). yield giống run_jobs_batched.
+    """
+    by_lesson: Dict[str, List[Dict[str, Any]]] = {}
+    for i, job in enumerate(jobs):
+        by_lesson.setdefault(job["lesson_stem"], []).append({**job, "i": i})
+
+    # process con đọc env lúc import (OMP_NUM_THREADS...) => set trước khi spawn
+    env_keys = ("OMP_NUM_THREADS", "VECLIB_MAXIMUM_THREADS", "MKL_NUM_THREADS")
+    env_old = {k: os.environ.get(k) for k in env_keys}
+    for k in env_keys:
+        os.environ[k] = str(threads)
+    try:
+        with ProcessPoolExecutor(
+            max_workers=min(workers, len(by_lesson)),
+            mp_context=mp.get_context("spawn"),
+            initializer=_pool_init,
+            initargs=(threads,),
+        ) as pool:
+            futs = {pool.submit(_pool_run_lesson, lj, ocr_cache, image_codec): lj for lj in by_lesson.values()}
+            for fut in as_completed(futs):
+                try:
+                    results, stats, edits = fut.result()
+                except Exception as e:   # worker chết (OOM...) => cả lesson fail, lần sau chạy lại
+                    for job in futs[fut]:
+                        yield jobs[job["i"]], None, e, 0.0
+                    continue
+                if dpi_stats is not None:
+                    merge_dpi_stats(dpi_stats, stats)
+                if edit_stats is not None:
+                    merge_edit_stats(edit_stats, edits)
+                for i, payload, err, sec in results:
+                    job = jobs[i]
+                    if payload is not None:
+                        save_cutline(job["out_dir"] / f"{job['jp'].stem}_cutline.json", payload, index=index)
+                    yield job, payload, (RuntimeError(err) if err else None), sec
+    finally:
+        for k, v in env_old.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
+
+def run_postprocess_for_book(
+    book_dir: str | Path,
+    reset_debug_dir: bool = False,
+    workers: Optional[int] = None,
+    threads: Optional[int] = None,
+    image_codec: Optional[str] = None,
+) -> Dict[str, Any]:
     """
     book_dir: Output/<book_stem>
-    Đọc meta ở: Output/<book_stem>/Chunk/<lesson_stem>/chunk_XX/*.json  (trừ *.keywords.json)
-    PDF nằm cạnh json: jp.with_suffix(".pdf")
+    Đọc meta từ chunk index (Output/<book_stem>/chunk_index.sqlite, 1 query cho cả book);
+    book cũ chỉ có json rời thì index tự import lần đầu.
+    PDF: Output/<book_stem>/Chunk/<lesson_stem>/chunk_XX/<stem>.pdf
     Debug lưu per-chunk: .../chunk_XX/DebugCutlines/
+    reset_debug_dir=True: xoá DebugCutlines cũ của chunk trước khi xử lý (Kaggle)
+    OCR chạy theo batch (OCR_BATCH_SIZE ảnh page0 / lượt, tối đa OCR_BATCH_MAX_MB RAM).
+    workers > 1: pool process (OCR_WORKERS / OCR_THREADS mặc định), mỗi lesson 1 job tuần tự.
+    image_codec: codec ảnh thay trang ("jpeg:80,gray,dpi=200"...), None => image_codec.txt của book / IMAGE_CODEC.
     """
+    workers = max(1, int(workers if workers is not None else OCR_WORKERS))
+    cpu_threads = threads   # 1 process: chỉ set cpu_threads khi được truyền rõ
+    threads = max(1, int(threads if threads is not None else OCR_THREADS))
     book_dir = Path(book_dir)
     chunk_root = book_dir / "Chunk"
+    codec = book_image_codec(book_dir, image_codec)
 
-    json_files = sorted([p for p in chunk_root.rglob("*.json") if not p.name.endswith(".keywords.json")])
-    if not json_files:
-        raise RuntimeError(f"Không thấy chunk meta json trong: {chunk_root}")
+    index = open_chunk_index(book_dir)
+    rows = index.chunks()
+    if not rows:
+        raise RuntimeError(f"Không thấy chunk nào trong index / meta json: {chunk_root}")
 
     print("ChunkRoot:", chunk_root)
     print("DebugDir :", "per-chunk => each chunk_XX/DebugCutlines/")
-    print("Total meta json:", len(json_files))
+    print("Total chunks:", len(rows))
+
+    # lesson đổi range: chưa chunk lại => bỏ qua; đã chunk lại => xử lý lại
+    dirty = load_dirty(book_dir)
+    dirty_failed: set = set()
 
-    ocr = build_ocr()
+    # state db: chunk đã xong / không cần xử lý => skip luôn, khỏi đọc meta json
+    db = open_state_db(book_dir)
+    finished = db.keys_with_status("chunk", "postprocess", "done") | db.keys_with_status("chunk", "postprocess", "skipped")
 
     ok_count = skip_count = fail_count = 0
     last_debug_dir: Optional[Path] = None
 
-    for jp in json_files:
-        try:
-            meta = read_json(jp)
-        except Exception:
-            print("[FAIL] JSON parse:", jp)
-            fail_count += 1
+    # ---- 1) chọn chunk cần xử lý (không render gì) ----
+    jobs: List[Dict[str, Any]] = []
+    for row in rows:
+        pdf_path = index.chunk_pdf(row)
+        jp = pdf_path.with_suffix(".json")   # chỉ để đặt tên / log (có thể không tồn tại)
+        lesson_stem = row["lesson_stem"]
+        if is_dirty(dirty, lesson_stem, "chunk"):
+            skip_count += 1
+            continue
+        force_lesson = is_dirty(dirty, lesson_stem, "postprocess")
+        if (not FORCE_REPROCESS) and (not force_lesson) and jp.stem in finished:
+            skip_count += 1
             continue
 
+        meta = row["meta"]
+
         heading = str(meta.get("heading", "")).strip()
         heading_num = extract_heading_num(heading)
 
@@ -1210,42 +1724,101 @@ def run_postprocess_for_book(book_dir: str | Path) -> Dict[str, Any]:
 
         if (not is_content_head) and (not is_force_heading):
             skip_count += 1
+            db.record("chunk", jp.stem, "postprocess", "skipped")
             continue
 
-        pdf_path = jp.with_suffix(".pdf")
         if not pdf_path.exists():
             print("[FAIL] Missing chunk pdf:", pdf_path)
             fail_count += 1
+            dirty_failed.add(lesson_stem)
+            db.record("chunk", jp.stem, "postprocess", "failed", error="missing_chunk_pdf")
             continue
 
         already_done = (is_content_head and bool(meta.get(EXTRACT_KEY, False))) or (
             (not is_content_head) and bool(meta.get(EXTRACT_HEADING_KEY, False))
         )
-        if (not FORCE_REPROCESS) and already_done:
+        if (not FORCE_REPROCESS) and (not force_lesson) and already_done:
             skip_count += 1
+            db.record("chunk", jp.stem, "postprocess", "done")   # book cũ: flag trong meta -> db
             continue
 
-        try:
-            out_dir = jp.parent / "DebugCutlines"   # ✅ per-chunk
-            last_debug_dir = out_dir
-
-            payload = process_one_chunk(ocr, jp, pdf_path, out_dir)
-            if payload is None:
-                skip_count += 1
-            else:
-                ok_count += 1
-                mark_extract = is_content_head
-                mark_extract_heading = (not is_content_head) and (heading_num in FORCE_HEADING_NUMS)
-                mark_chunk_processed(jp, meta, mark_extract=mark_extract, mark_extract_heading=mark_extract_heading)
-
-        except Exception as e:
-            print("[FAIL]", jp, "=>", e)
+        out_dir = jp.parent / "DebugCutlines"   # ✅ per-chunk
+        if reset_debug_dir:
+            shutil.rmtree(out_dir, ignore_errors=True)   # ✅ xoá debug cũ của chunk này
+            out_dir.mkdir(parents=True, exist_ok=True)
+        last_debug_dir = out_dir
+
+        jobs.append({
+            "jp": jp, "pdf_path": pdf_path, "out_dir": out_dir, "meta": meta, "lesson_stem": lesson_stem,
+            "is_content_head": is_content_head, "heading_num": heading_num,
+        })
+
+    print("To process:", len(jobs), "| batch:", OCR_BATCH_SIZE, "imgs /", OCR_BATCH_MAX_MB, "MB",
+          "| workers:", workers, "x", threads, "threads")
+    print("Image codec:", codec)
+
+    # ---- 2) render + OCR theo batch, matching/cắt từng chunk như cũ ----
+    dpi_stats: Dict[str, Dict[str, int]] = {}
+    edit_stats: Dict[str, Any] = {}
+    image_stats: Dict[str, int] = {"images": 0, "bytes": 0}
+    ocr_cache = OcrCache(book_dir) if OCR_CACHE_ENABLED else None
+    if workers > 1 and jobs:
+        results = run_jobs_pool(
+            jobs, index, workers, threads, dpi_stats=dpi_stats, ocr_cache=ocr_cache, edit_stats=edit_stats,
+            image_codec=codec,
+        )
+    else:
+        results = run_jobs_batched(
+            build_ocr(cpu_threads=cpu_threads) if jobs else None, jobs, index=index,
+            dpi_stats=dpi_stats, ocr_cache=ocr_cache, edit_stats=edit_stats, image_codec=codec,
+        )
+    for job, payload, err, sec in results:
+        jp = job["jp"]
+        if err is not None:
+            print("[FAIL]", jp, "=>", repr(err))
             fail_count += 1
+            dirty_failed.add(job["lesson_stem"])
+            db.record("chunk", jp.stem, "postprocess", "failed", error=repr(err))
+        elif payload is None:
+            skip_count += 1
+            # chưa cắt được (match thấp / không có dets) => lần sau thử lại
+            db.record("chunk", jp.stem, "postprocess", "failed", sec=sec, error="no_cut")
+        else:
+            ok_count += 1
+            img_rep = (payload.get("size_report") or {}).get("image") or {}
+            for k in ("top_bytes", "bot_bytes"):
+                if img_rep.get(k):
+                    image_stats["images"] += 1
+                    image_stats["bytes"] += int(img_rep[k])
+            mark_extract = job["is_content_head"]
+            mark_extract_heading = (not job["is_content_head"]) and (job["heading_num"] in FORCE_HEADING_NUMS)
+            mark_chunk_processed(
+                jp, job["meta"], mark_extract=mark_extract, mark_extract_heading=mark_extract_heading, index=index,
+            )
+            db.record(
+                "chunk", jp.stem, "postprocess", "done",
+                outputs=[str(job["pdf_path"]), str(job["out_dir"] / f"{jp.stem}_cutline.json")],
+                sec=sec,
+            )
+
+    for lesson_stem in dirty:
+        if is_dirty(dirty, lesson_stem, "postprocess") and not is_dirty(dirty, lesson_stem, "chunk") and lesson_stem not in dirty_failed:
+            clear_dirty(book_dir, lesson_stem, "postprocess")
 
     print("\n=== POSTPROCESS SUMMARY ===")
     print("OK  :", ok_count)
     print("SKIP:", skip_count)
     print("FAIL:", fail_count)
+    for dpi in sorted(dpi_stats, key=int):
+        st = dpi_stats[dpi]
+        st["hit_rate"] = round(st["hit"] / st["tried"], 3) if st["tried"] else 0.0
+        print(f"DPI {dpi}: hit {st['hit']}/{st['tried']} ({st['hit_rate']:.0%})")
+    if edit_stats.get("files"):
+        print(f"PDF edits: {edit_stats['pages']} page(s) in {edit_stats['files']} file(s) "
+              f"({edit_stats['incremental']} incremental), {edit_stats['bytes_written'] / (1024 * 1024):.1f} MB written, "
+              f"{edit_stats['sec']:.1f}s" + (f", {edit_stats['failed']} failed" if edit_stats["failed"] else ""))
+    if image_stats["images"]:
+        print(f"Replacement images: {image_stats['images']}, {image_stats['bytes'] / (1024 * 1024):.1f} MB")
 
     return {
         "ok": ok_count,
@@ -1253,4 +1826,93 @@ def run_postprocess_for_book(book_dir: str | Path) -> Dict[str, Any]:
         "fail": fail_count,
         "debug_dir": "per-chunk: each chunk_XX/DebugCutlines/",
         "debug_example": (str(last_debug_dir) if last_debug_dir else None),
-    }
\ No newline at end of file
+        "dpi_stats": dpi_stats,   # {dpi: {tried, hit, hit_rate}} để chỉnh DPI_LADDER
+        "pdf_edits": edit_stats,  # {files, pages, incremental, bytes_written, sec, failed}
+        "image_codec": codec,
+        "images": image_stats,    # {images, bytes}: ảnh thay trang đã encode (chi tiết từng chunk ở size_report)
+    }
+
+def replay_chunk(meta: Dict[str, Any], cutline: Dict[str, Any], ocr_cache: OcrCache) -> Dict[str, Any]:
+    """
+    Chạy lại matching + quyết định cắt từ dets trong cache (theo dpi_tries của cutline lần trước),
+    với CONFIG hiện tại. Không render, không OCR, không sửa PDF.
+    """
+    heading_num = extract_heading_num(str(meta.get("heading", "")).strip())
+    expected_letters = build_expected_letters_from_title(str(meta.get("title", "")).strip())
+    is_content_head = bool(meta.get("content_head", False))
+    is_force_heading = heading_num in FORCE_HEADING_NUMS
+    min_req = min_match_required(len(expected_letters))
+    matcher = HeadingMatcher(heading_num, expected_letters)
+
+    tries = [t for t in (cutline.get("dpi_tries") or []) if t.get("cache_key")]
+    # trang scan (SCAN_FAST_PATH): cắt ở DPI gốc, không có thang DPI
+    scan = cutline.get("source") == "scan"
+    cut_dpi = int(cutline.get("dpi") or DPI) if scan else DPI
+    best, det_dpi, needs_ocr = None, None, False
+    for k, t in enumerate(tries):
+        dets = ocr_cache.get(t["cache_key"])
+        if dets is None:
+            return {"status": "no_cache"}
+        det_dpi = int(t["dpi"])
+        best = find_best_line(
+            dets, heading_num, expected_letters,
+            is_content_head=is_content_head, is_force_heading=is_force_heading, matcher=matcher,
+        ) if dets else None
+        if best is not None and best[1] >= min_req and best[4] in DPI_TRUSTED_MODES:
+            break
+        # lần trước dừng ở DPI này nhưng CONFIG mới muốn lên DPI kế => chưa có dets
+        needs_ocr = (k == len(tries) - 1) and det_dpi != DPI and not scan
+    if det_dpi is None:
+        return {"status": "no_cache"}
+    if best is None:
+        return {"status": "fail", "reason": "no_line", "detect_dpi": det_dpi, "needs_ocr": needs_ocr}
+
+    _sc, matched, ln, obs, best_mode = best
+    if is_content_head and best_mode not in {"same_line", "merge_next", "heading_left_title", "prefix_line"}:
+        return {"status": "fail", "reason": "no_heading_evidence", "mode": best_mode, "detect_dpi": det_dpi}
+
+    cut = decide_cut(matched, obs, best_mode, expected_letters, min_req)
+    y_line = int(round(float(ln["y0"]) * float(cut_dpi) / float(det_dpi) - OFFSET))
+    return {
+        "status": ("weak_cut" if cut["weak_cut"] else "cut") if cut["cut"] else "fail",
+        "reason": cut["weak_reason"] if cut["cut"] else f"low_match_{matched}_{len(expected_letters)}",
+        "mode": best_mode,
+        "matched": int(matched),
+        "y_line": max(0, y_line),
+        "detect_dpi": det_dpi,
+        "needs_ocr": needs_ocr,
+    }
+
+def replay_postprocess_for_book(book_dir: str | Path) -> Dict[str, Any]:
+    """
+    --replay: chỉnh WEAK_COV_EXP / MIN_MATCH_REQUIRED / FORCE_CUT_ON_MODES... rồi xem quyết định cắt
+    đổi thế nào trên mọi chunk đã OCR (dets trong Output/<book>/ocr_cache/), không build OCR engine.
+    Ghi Output/<book>/replay_report.json.
+    """
+    book_dir = Path(book_dir)
+    index = open_chunk_index(book_dir)
+    ocr_cache = OcrCache(book_dir)
+
+    counts: Dict[str, int] = {}
+    changed: List[Dict[str, Any]] = []
+    for row in index.chunks():
+        cutline = row.get("cutline")
+        if not cutline:
+            continue
+        res = replay_chunk(row["meta"], cutline, ocr_cache)
+        counts[res["status"]] = counts.get(res["status"], 0) + 1
+        if res["status"] == "no_cache":
+            continue
+        prev = "fail" if cutline.get("failed") else ("weak_cut" if cutline.get("weak_cut") else "cut")
+        prev_y = cutline.get("y_line")
+        if res["status"] != prev or (res.get("y_line") is not None and res.get("y_line") != prev_y):
+            changed.append({"stem": row["stem"], "before": {"status": prev, "mode": cutline.get("best_mode"), "y_line": prev_y}, "after": res})
+
+    report = {"counts": counts, "changed": changed}
+    write_json_atomic(book_dir / "replay_report.json", report)
+
+    print("\n=== REPLAY SUMMARY ===")
+    for k in sorted(counts):
+        print(f"{k:9}:", counts[k])
+    print("changed  :", len(changed), "->", book_dir / "replay_report.json")
+    return report
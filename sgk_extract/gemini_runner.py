@@ -52,7 +52,13 @@ def extract_structure_from_pdf(
     """
     Rotate keys: thử key1 -> fail quota/rate -> thử key2 -> ...
     Thành công thì return dict.
+    Mỗi lần gọi giữ 1 suất của key_manager.slot() => tổng request đồng thời <= số key.
     """
+    with key_manager.slot():
+        return _extract_with_rotation(key_manager, pdf_path, prompt, model)
+
+
+def _extract_with_rotation(key_manager, pdf_path: str, prompt: str, model: str) -> dict:
     keys = key_manager.keys
     n = len(keys)
     start_idx = key_manager.get_start_index_and_advance()
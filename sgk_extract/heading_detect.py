@@ -0,0 +1,170 @@
+# sgk_extract/heading_detect.py
+from __future__ import annotations
+
+import re
+import threading
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from .heading_match import extract_initials_no_case_change, split_heading_prefix, tokenize_words
+from .page_ocr import build_ocr, dets_to_lines, fold_text, ocr_image_dets, render_page
+
+
+# ============================
+# CONFIG
+# ============================
+HEAD_OCR_DPI = 110            # đủ đọc "1. TIÊU ĐỀ IN HOA", nhẹ hơn nhiều so với DPI cắt (260)
+HEAD_MIN_CONFIDENCE = 0.6     # thấp hơn => gọi Gemini
+HEADER_MARGIN = 0.07          # dòng nằm trong 7% trên cùng = header trang, không tính là nội dung
+FOOTER_MARGIN = 0.06          # 6% dưới cùng = footer / số trang
+MAX_HEADING_NUM = 20
+MIN_TITLE_LETTERS = 2
+TITLE_MERGE_GAP = 1.6         # tiêu đề xuống dòng: khoảng cách <= 1.6 x chiều cao dòng
+
+# giống prompt chunk: không phải mục chính
+_EXCLUDE_WORDS = (
+    "nhiem vu", "cau hoi", "bai tap", "luyen tap", "van dung", "huong dan", "buoc",
+    "nhay", "chon", "mo ", "thuc hien", "hay ", "em hay",
+)
+_NUM_PREFIX = re.compile(r"^\s*(\d{1,2})\s*\.")
+
+_ocr = None
+_ocr_lock = threading.Lock()   # PaddleOCR không an toàn khi nhiều thread gọi cùng lúc
+
+
+def _is_upper_title(text: str) -> bool:
+    letters = [c for c in text if c.isalpha()]
+    if len(letters) < MIN_TITLE_LETTERS:
+        return False
+    return all(c.isupper() for c in letters)
+
+
+def _is_excluded(title: str) -> bool:
+    t = fold_text(title) + " "
+    return any(t.startswith(w) for w in _EXCLUDE_WORDS)
+
+
+def _heading_candidates(lines: List[Dict[str, Any]], page_h: float) -> List[Dict[str, Any]]:
+    """
+    Dòng dạng "<n>. TIÊU ĐỀ IN HOA" trên 1 trang (bỏ header/footer).
+    Tiêu đề xuống dòng (dòng kế cũng IN HOA, sát bên dưới) được nối lại.
+    """
+    out: List[Dict[str, Any]] = []
+    for i, ln in enumerate(lines):
+        if ln["y0"] < page_h * HEADER_MARGIN or ln["y1"] > page_h * (1.0 - FOOTER_MARGIN):
+            continue
+        m = _NUM_PREFIX.match(ln["text"])
+        if not m:
+            continue
+        num = int(m.group(1))
+        if not (1 <= num <= MAX_HEADING_NUM):
+            continue
+        ok, rem = split_heading_prefix(ln["text"], num, require_dot=True)
+        if not ok or not _is_upper_title(rem) or _is_excluded(rem):
+            continue
+
+        title = rem
+        h = max(1.0, ln["y1"] - ln["y0"])
+        last = ln
+        for nxt in lines[i + 1:i + 3]:
+            if nxt["y0"] - last["y1"] > h * TITLE_MERGE_GAP:
+                break
+            if _NUM_PREFIX.match(nxt["text"]) or not _is_upper_title(nxt["text"]):
+                break
+            title = f"{title} {nxt['text'].strip()}"
+            last = nxt
+
+        # mọi từ đều phải bắt đầu bằng chữ IN HOA (OCR lẫn chữ thường => không tin)
+        words = [w for w in tokenize_words(title) if not w.isdigit()]
+        initials = extract_initials_no_case_change(title)
+        scores = [float(it.get("score", 1.0)) for it in ln["items"]]
+        out.append({
+            "num": num,
+            "title": title.strip(),
+            "y0": float(ln["y0"]),
+            "upper_ratio": (len(initials) / len(words)) if words else 0.0,
+            "ocr_score": (sum(scores) / len(scores)) if scores else 0.0,
+            "content_above": any(
+                o["y1"] <= ln["y0"] and o["y0"] >= page_h * HEADER_MARGIN for o in lines[:i]
+            ),
+        })
+    return out
+
+
+def build_list_chunk(
+    page_candidates: List[List[Dict[str, Any]]],
+) -> Tuple[List[Dict[str, Dict[str, Any]]], float]:
+    """
+    page_candidates[p] = candidates trang p (0-based), đã sort theo y.
+    Chọn dãy 1., 2., 3., ... theo thứ tự xuất hiện (lần đầu gặp số kế tiếp).
+    Return (list_chunk cùng schema Gemini, confidence 0..1).
+    """
+    chosen: List[Tuple[int, Dict[str, Any]]] = []
+    seen = 0
+    for p, cands in enumerate(page_candidates):
+        for c in cands:
+            seen += 1
+            if c["num"] == len(chosen) + 1:
+                chosen.append((p, c))
+
+    if not chosen:
+        return [], 0.0
+
+    list_chunk: List[Dict[str, Dict[str, Any]]] = []
+    for k, (p, c) in enumerate(chosen, start=1):
+        list_chunk.append({f"chunk_{k:02d}": {
+            "start": p + 1,
+            "content_head": bool(c["content_above"]) and k > 1,
+            "heading": f"{c['num']}.",
+            "title": c["title"],
+        }})
+
+    # độ tin cậy: OCR chắc + tiêu đề IN HOA sạch + ít dòng "<n>." lạc dãy
+    quality = sum(min(c["ocr_score"], c["upper_ratio"]) for _p, c in chosen) / len(chosen)
+    stray = (seen - len(chosen)) / seen
+    confidence = quality * (1.0 - 0.5 * stray)
+    return list_chunk, round(float(confidence), 3)
+
+
+def _get_ocr():
+    global _ocr
+    if _ocr is None:
+        _ocr = build_ocr()
+    return _ocr
+
+
+def detect_lesson_headings(
+    lesson_pdf: str | Path,
+    dpi: int = HEAD_OCR_DPI,
+    source: Optional[Tuple[str, int, int]] = None,
+) -> Optional[Dict[str, Any]]:
+    """
+    OCR mọi trang lesson ở DPI thấp, tìm mục chính "<n>. TIÊU ĐỀ IN HOA".
+    source=(book_pdf, start, end) (1-based): render thẳng từ PDF gốc, không cần PDF lesson (lesson lazy).
+    Return {"list_chunk": [...], "confidence": float, "source": "local"}
+    hoặc None nếu máy không có paddleocr/pypdfium2.
+    """
+    try:
+        import pypdfium2 as pdfium
+        with _ocr_lock:
+            _get_ocr()
+    except Exception:
+        return None
+
+    if source is not None:
+        src_pdf, pages = Path(source[0]), range(source[1] - 1, source[2])
+    else:
+        src_pdf = Path(lesson_pdf)
+        pdf = pdfium.PdfDocument(str(src_pdf))
+        pages = range(len(pdf))
+        pdf.close()
+
+    page_candidates: List[List[Dict[str, Any]]] = []
+    for i in pages:
+        bgr = render_page(src_pdf, i, dpi)   # render cache => chạy lại không render lại
+        with _ocr_lock:
+            dets = ocr_image_dets(_get_ocr(), bgr)
+        page_candidates.append(_heading_candidates(dets_to_lines(dets), float(bgr.shape[0])) if dets else [])
+
+    list_chunk, confidence = build_list_chunk(page_candidates)
+    return {"list_chunk": list_chunk, "confidence": confidence, "source": "local"}
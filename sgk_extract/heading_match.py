@@ -0,0 +1,207 @@
+# sgk_extract/heading_match.py
+from __future__ import annotations
+
+import re
+import unicodedata
+from functools import lru_cache
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# Lõi so khớp chữ cái đầu (initials) của title với dòng OCR.
+# Quy tắc giữ y hệt bản cũ trong chunk_postprocess; chỉ đổi cách tính:
+#   - regex theo heading_num compile 1 lần (lru_cache)
+#   - LCS bit-parallel trên int Python (mask theo chữ cái) thay cho DP O(n*m)
+#   - HeadingMatcher: cache initials theo text + kết quả match theo chuỗi initials trong 1 chunk
+
+_TOKEN_RE = re.compile(r"[0-9]+|[A-Za-zÀ-Ỵà-ỵĐđ]+")
+
+
+@lru_cache(maxsize=4096)
+def remove_diacritics_char_no_case_change(ch: str) -> Optional[str]:
+    if not ch:
+        return None
+    if ch == "Đ":
+        return "D"
+    if ch == "đ":
+        return None
+    if (not ch.isalpha()) or (not ch.isupper()):
+        return None
+    base = unicodedata.normalize("NFD", ch)
+    base = "".join(c for c in base if unicodedata.category(c) != "Mn")
+    if len(base) != 1 or (not base.isalpha()) or (not base.isupper()):
+        return None
+    return base
+
+
+def tokenize_words(text: str) -> List[str]:
+    return _TOKEN_RE.findall(text or "")
+
+
+def extract_initials_no_case_change(text: str) -> List[str]:
+    initials: List[str] = []
+    for tok in tokenize_words(text):
+        if tok.isdigit():
+            continue
+        base = remove_diacritics_char_no_case_change(tok[0])
+        if base:
+            initials.append(base)
+    return initials
+
+
+# ============================
+# Regex theo heading_num
+# ============================
+@lru_cache(maxsize=64)
+def heading_patterns(heading_num: int) -> Dict[str, "re.Pattern[str]"]:
+    n = heading_num
+    return {
+        "paren": re.compile(rf"^\s*{n}\s*\)"),             # "1)" kiểu câu hỏi trắc nghiệm
+        "paren_only": re.compile(rf"^\s*{n}\s*\)\s*$"),
+        "pure": re.compile(rf"^\s*{n}\s*(\.)?\s*$"),       # token chỉ là "1" / "1."
+        "dot": re.compile(rf"^\s*{n}\s*\."),
+        "prefix_dot": re.compile(rf"^\s*{n}\s*\.\s*(\S.+)$"),
+        "prefix": re.compile(rf"^\s*{n}\s*\.?\s*(\S.+)$"),
+    }
+
+
+def is_pure_heading_token(text: str, heading_num: int) -> Tuple[bool, bool]:
+    """
+    True nếu text chỉ là "1" hoặc "1." (có thể có spaces).
+    Return: (ok, has_dot)
+    """
+    t = (text or "").strip()
+    pat = heading_patterns(heading_num)
+    if pat["paren_only"].match(t):
+        return False, False
+    m = pat["pure"].match(t)
+    if not m:
+        return False, False
+    return True, bool(m.group(1))
+
+
+def has_dot_heading(text: str, heading_num: int) -> bool:
+    return bool(heading_patterns(heading_num)["dot"].match((text or "").strip()))
+
+
+def split_heading_prefix(raw_text: str, heading_num: int, require_dot: bool = False) -> Tuple[bool, str]:
+    t = (raw_text or "").strip()
+    pat = heading_patterns(heading_num)
+
+    if pat["paren"].match(t):
+        return False, ""
+
+    # require_dot: bắt buộc "1. ...."; không thì dấu chấm tuỳ ý (giữ tương thích)
+    m = pat["prefix_dot" if require_dot else "prefix"].match(t)
+    if m:
+        rem = m.group(1).strip()
+        if rem and not rem[0].isdigit():
+            return True, rem
+    return False, ""
+
+
+# ============================
+# Match initials
+# ============================
+def letter_masks(a: Sequence[str]) -> Dict[str, int]:
+    masks: Dict[str, int] = {}
+    for i, ch in enumerate(a):
+        masks[ch] = masks.get(ch, 0) | (1 << i)
+    return masks
+
+
+def _lcs_masks(masks: Dict[str, int], n: int, b: Sequence[str]) -> int:
+    # Allison-Dix / Hyyrö: bit 0 của v = vị trí của a đã "dùng" cho LCS
+    full = (1 << n) - 1
+    v = full
+    for ch in b:
+        u = v & masks.get(ch, 0)
+        if u:
+            v = ((v + u) | (v - u)) & full
+    return n - bin(v).count("1")
+
+
+def lcs_len(a: Sequence[str], b: Sequence[str]) -> int:
+    if not a or not b:
+        return 0
+    return _lcs_masks(letter_masks(a), len(a), b)
+
+
+def prefix_match_count(observed: Sequence[str], expected: Sequence[str]) -> int:
+    n = min(len(observed), len(expected))
+    m = 0
+    for i in range(n):
+        if observed[i] == expected[i]:
+            m += 1
+        else:
+            break
+    return m
+
+
+def _robust(observed: Sequence[str], expected: Sequence[str], masks: Optional[Dict[str, int]]) -> int:
+    nexp = len(expected)
+
+    # 1) prefix
+    p = prefix_match_count(observed, expected)
+
+    # 2) skip chữ dư: BTCL vs BTL (THỨC bị tách -> THỨ + C)
+    anchor = 2 if nexp <= 4 else 3
+    if p < min(anchor, nexp):
+        r = p
+    else:
+        j = p
+        for ch in observed[p:]:
+            if j < nexp and ch == expected[j]:
+                j += 1
+        r = j
+
+    # 3) LCS cho title dài (>=6), chữ đầu phải xuất hiện sớm; đạt ceil(0.8*n) thì dùng
+    if nexp >= 6 and expected[0] in observed[:3]:
+        lcs = _lcs_masks(masks if masks is not None else letter_masks(expected), nexp, observed)
+        if lcs >= (8 * nexp + 9) // 10:
+            return lcs
+
+    return r
+
+
+def robust_match_count(observed: List[str], expected: List[str]) -> int:
+    """
+    Robust match:
+    - Prefix + skip chữ dư: xử lý case BTCL vs BTL (THỨC bị tách -> THỨ + C)
+    - Với title dài (>=6): dùng LCS nếu đủ cao (>= 80%) để chịu BOTH thiếu + dư (case lesson 11)
+    """
+    return _robust(observed, expected, None)
+
+
+class HeadingMatcher:
+    """
+    Mọi thứ cố định trong 1 chunk (heading_num + expected initials): regex, mask LCS,
+    cache initials theo text dòng và số match theo chuỗi initials.
+    Dùng lại qua mọi DPI của ladder và mọi mode của 1 dòng (title / prefix / same / merge_next).
+    """
+
+    def __init__(self, heading_num: int, expected: Sequence[str]):
+        self.heading_num = heading_num
+        self.expected = list(expected)
+        self.patterns = heading_patterns(heading_num)
+        self._masks = letter_masks(self.expected)
+        self._initials: Dict[str, List[str]] = {}
+        self._matches: Dict[Tuple[str, ...], int] = {}
+
+    def initials(self, text: str) -> List[str]:
+        obs = self._initials.get(text)
+        if obs is None:
+            obs = extract_initials_no_case_change(text)
+            self._initials[text] = obs
+        return obs
+
+    def match(self, observed: Sequence[str]) -> int:
+        key = tuple(observed)
+        m = self._matches.get(key)
+        if m is None:
+            m = _robust(key, self.expected, self._masks)
+            self._matches[key] = m
+        return m
+
+    def lcs(self, observed: Sequence[str]) -> int:
+        if not self.expected or not observed:
+            return 0
+        return _lcs_masks(self._masks, len(self.expected), observed)
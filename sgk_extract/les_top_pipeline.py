@@ -4,22 +4,25 @@ from __future__ import annotations
 import os
 import tempfile
 from pathlib import Path
-from typing import Any, Dict
+from typing import Any, Dict, List, Optional
 
 from pypdf import PdfReader, PdfWriter
 
+from .manifest_validate import save_validation_report, validate_manifest
+from .pdf_meta import get_page_count
 from .pdf_output import prepare_workspace, save_manifest, split_from_manifest
 from .prompts import build_topic_lesson_prompt
 from .gemini_runner import extract_structure_from_pdf
+from .toc_detect import make_toc_preview
 
 
-def _make_preview_first_pages(src_pdf: str, first_n_pages: int = 20) -> str:
+def _make_preview_first_pages(src_pdf: str, first_n_pages: int = 20, reader: Optional[PdfReader] = None) -> str:
     """
     Tạo 1 PDF tạm chỉ gồm first_n_pages trang đầu để Gemini đọc mục lục.
     File này chỉ dùng để upload, xong có thể xoá.
     """
-    reader = PdfReader(src_pdf)
-    n_total = len(reader.pages)
+    reader = reader or PdfReader(src_pdf)
+    n_total = get_page_count(src_pdf)
     n = min(max(1, first_n_pages), n_total)
 
     writer = PdfWriter()
@@ -35,22 +38,51 @@ def _make_preview_first_pages(src_pdf: str, first_n_pages: int = 20) -> str:
     return tmp_path
 
 
-def run_extract_save_split(key_manager, pdf_path: str, model: str = "gemini-2.5-flash"):
-    # ✅ tổng số trang của PDF gốc
-    total_pages_full = len(PdfReader(str(pdf_path)).pages)
+def _preview_note(page_map: List[int], total_pages_full: int) -> str:
+    """
+    Note đầu prompt: cho Gemini biết trang preview <-> trang PDF gốc.
+    page_map rỗng => preview 20 trang đầu (trang preview i = trang gốc i).
+    """
+    if not page_map:
+        return (
+            "QUAN TRỌNG:\n"
+            "- File PDF bạn đang xem chỉ là BẢN XEM TRƯỚC (preview) gồm 20 trang đầu để đọc MỤC LỤC.\n"
+            f"- Nhưng start/end bạn trả về phải là SỐ TRANG PDF của FILE GỐC (1-based), tổng số trang = {total_pages_full}.\n"
+            f"- start/end phải nằm trong [1, {total_pages_full}].\n\n"
+        )
 
-    # ✅ prompt gốc + thêm note để Gemini biết nó đang xem preview
-    base_prompt = build_topic_lesson_prompt()
-    prompt = (
+    mapping = "\n".join(f"  + trang preview {i + 1} = trang PDF gốc {p}" for i, p in enumerate(page_map))
+    return (
         "QUAN TRỌNG:\n"
-        "- File PDF bạn đang xem chỉ là BẢN XEM TRƯỚC (preview) gồm 20 trang đầu để đọc MỤC LỤC.\n"
-        f"- Nhưng start/end bạn trả về phải là SỐ TRANG PDF của FILE GỐC (1-based), tổng số trang = {total_pages_full}.\n"
+        f"- File PDF bạn đang xem chỉ là BẢN XEM TRƯỚC (preview) gồm {len(page_map)} trang lấy từ FILE GỐC:\n"
+        f"{mapping}\n"
+        "- Các trang đầu là MỤC LỤC. Trang CUỐI là trang nội dung mẫu: dùng số trang IN ở chân trang của nó\n"
+        "  và số trang PDF gốc ở trên để tính offset = pdf_page - printed_page.\n"
+        f"- start/end bạn trả về phải là SỐ TRANG PDF của FILE GỐC (1-based), tổng số trang = {total_pages_full}.\n"
         f"- start/end phải nằm trong [1, {total_pages_full}].\n\n"
-        + base_prompt
     )
 
-    # ✅ tạo preview 20 trang
-    preview_pdf = _make_preview_first_pages(pdf_path, first_n_pages=20)
+
+def run_extract_save_split(
+    key_manager,
+    pdf_path: str,
+    model: str = "gemini-2.5-flash",
+    strict_manifest: bool = True,
+    lazy_lessons: bool = False,
+):
+    # ✅ tổng số trang của PDF gốc (cache, không parse lại)
+    total_pages_full = get_page_count(pdf_path)
+    reader = PdfReader(str(pdf_path))   # 1 reader dùng chung cho dò mục lục + preview
+
+    # ✅ preview = trang mục lục (đầu/cuối sách) + 1 trang mẫu chân trang; fallback 20 trang đầu
+    toc = make_toc_preview(str(pdf_path), reader=reader)
+    if toc is not None:
+        preview_pdf, page_map = toc
+    else:
+        preview_pdf, page_map = _make_preview_first_pages(pdf_path, first_n_pages=20, reader=reader), []
+
+    # ✅ prompt gốc + thêm note để Gemini biết nó đang xem preview
+    prompt = _preview_note(page_map, total_pages_full) + build_topic_lesson_prompt()
 
     try:
         # 1) Gemini đọc preview -> trả dict ranges theo PDF gốc
@@ -72,10 +104,23 @@ def run_extract_save_split(key_manager, pdf_path: str, model: str = "gemini-2.5-
     base_dir = ws["base_dir"]
     pdf_stem = Path(pdf_path).stem
 
-    # 3) Lưu JSON manifest
+    # 3) ✅ Validate + sửa ranges TRƯỚC khi cắt (overlap, gap, vượt trang, topic không chứa lesson...)
+    data, report = validate_manifest(data, total_pages_full)
+    report_path = save_validation_report(base_dir, pdf_stem, report)
+    if report["repairs"]:
+        print(f"[Manifest] auto-repaired {len(report['repairs'])} issue(s) -> {report_path}")
+
+    # 4) Lưu JSON manifest (đã sửa)
     json_path = save_manifest(base_dir, pdf_stem, data)
 
-    # 4) ✅ Cắt từ PDF GỐC (đầy đủ trang)
-    split_result = split_from_manifest(pdf_path, data, base_dir)
+    if not report["ok"]:
+        msg = f"Manifest còn {len(report['errors'])} lỗi không tự sửa được, xem: {report_path}"
+        if strict_manifest:
+            raise RuntimeError(msg)
+        print("[WARN]", msg)
+
+    # 5) ✅ Cắt từ PDF GỐC (đầy đủ trang)
+    # lazy_lessons: lesson PDF chỉ tạo khi chunk stage cần upload (chunk cắt thẳng từ PDF gốc)
+    split_result = split_from_manifest(pdf_path, data, base_dir, lazy_lessons=lazy_lessons)
 
     return data, str(json_path), split_result
\ No newline at end of file
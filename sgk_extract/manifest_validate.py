@@ -0,0 +1,338 @@
+# sgk_extract/manifest_validate.py
+from __future__ import annotations
+
+import copy
+import json
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+# ============================
+# Core: check ranges (1 pass, vectorized)
+# ============================
+def check_ranges(
+    starts: np.ndarray,
+    ends: np.ndarray,
+    total_pages: int,
+    touch: Optional[np.ndarray] = None,
+) -> Dict[str, np.ndarray]:
+    """
+    starts/ends: 1-based inclusive, theo thứ tự item.
+    touch[i] = True nghĩa là item i được phép dùng chung trang với item i-1
+    (chunk content_head: end của chunk trước = start của chunk này).
+    Return mask theo từng lỗi:
+      - per-item (len n):    bad_order, out_of_bounds
+      - per-pair (len n-1):  non_monotonic, overlap, gap   (pair k = item k vs item k+1)
+    """
+    s = np.asarray(starts, dtype=np.int64)
+    e = np.asarray(ends, dtype=np.int64)
+    n = s.shape[0]
+    if touch is None:
+        touch = np.zeros(n, dtype=bool)
+    t = np.asarray(touch, dtype=bool)
+
+    prev_e = e[:-1]
+    next_s = s[1:]
+    allowed_last = np.where(t[1:], prev_e, prev_e + 1)   # next_s tối thiểu hợp lệ
+
+    return {
+        "bad_order": s > e,
+        "out_of_bounds": (s < 1) | (e < 1) | (s > total_pages) | (e > total_pages),
+        "non_monotonic": next_s < s[:-1],
+        "overlap": (next_s < allowed_last) & (next_s >= s[:-1]),
+        "gap": next_s > prev_e + 1,
+    }
+
+
+def check_containment(
+    inner_s: np.ndarray,
+    inner_e: np.ndarray,
+    outer_s: np.ndarray,
+    outer_e: np.ndarray,
+) -> np.ndarray:
+    """
+    Mask (len inner): item inner nào KHÔNG nằm gọn trong bất kỳ outer nào.
+    (lesson phải nằm trong 1 topic)
+    """
+    if inner_s.size == 0 or outer_s.size == 0:
+        return np.zeros(inner_s.shape[0], dtype=bool)
+    inside = (outer_s[None, :] <= inner_s[:, None]) & (inner_e[:, None] <= outer_e[None, :])
+    return ~inside.any(axis=1)
+
+
+def _issues_from_masks(names: List[str], masks: Dict[str, np.ndarray]) -> List[Dict[str, Any]]:
+    out: List[Dict[str, Any]] = []
+    for kind in ("bad_order", "out_of_bounds"):
+        for i in np.flatnonzero(masks[kind]):
+            out.append({"type": kind, "items": [names[i]]})
+    for kind in ("non_monotonic", "overlap", "gap"):
+        for k in np.flatnonzero(masks[kind]):
+            out.append({"type": kind, "items": [names[k], names[k + 1]]})
+    return out
+
+
+# ============================
+# Repair
+# ============================
+def _as_int(v: Any) -> Optional[int]:
+    if isinstance(v, bool):
+        return None
+    if isinstance(v, int):
+        return v
+    if isinstance(v, float) and v.is_integer():
+        return int(v)
+    if isinstance(v, str) and v.strip().isdigit():
+        return int(v.strip())
+    return None
+
+
+def _start_order(starts: List[int]) -> List[int]:
+    # sort ổn định theo start (giữ thứ tự gốc khi trùng start)
+    return sorted(range(len(starts)), key=lambda i: (starts[i], i))
+
+
+def repair_ranges(
+    names: List[str],
+    starts: List[int],
+    ends: List[int],
+    total_pages: int,
+    touch: Optional[List[bool]] = None,
+    fill_gaps: bool = True,
+    max_ends: Optional[List[int]] = None,
+) -> Tuple[List[int], List[int], List[str], List[Dict[str, Any]]]:
+    """
+    Sửa lỗi hay gặp:
+      - sort theo start (non_monotonic)
+      - clamp vào [1, total_pages] (chỉ item lấn một phần ra ngoài)
+      - overlap / gap: end = next.start - 1 (hoặc = next.start nếu touch)
+      - item cuối: end không vượt total_pages
+    max_ends[i] (theo thứ tự input): lấp gap không kéo end của item i quá mốc này
+    (lesson không được lấn sang topic sau); phần gap còn lại để check_ranges báo.
+    Return (starts, ends, names, repairs). Item không sửa được (start > end sau khi sửa,
+    hoặc nằm hẳn ngoài [1, total_pages]) vẫn giữ nguyên để check_ranges flag.
+    """
+    n = len(names)
+    t = list(touch) if touch is not None else [False] * n
+    repairs: List[Dict[str, Any]] = []
+
+    order = _start_order(starts)
+    if order != list(range(n)):
+        repairs.append({"type": "sorted_by_start", "order": [names[i] for i in order]})
+    s = np.array([starts[i] for i in order], dtype=np.int64)
+    e = np.array([ends[i] for i in order], dtype=np.int64)
+    t = [t[i] for i in order]
+    nm = [names[i] for i in order]
+    lim = np.array([max_ends[i] for i in order], dtype=np.int64) if max_ends is not None else None
+
+    # item nằm hẳn ngoài sách: clamp sẽ thành [total, total] giả => để nguyên cho check_ranges báo lỗi
+    inside = np.flatnonzero((s <= total_pages) & (e >= 1))
+    si, ei = s[inside], e[inside]
+    s_cl = np.clip(si, 1, max(1, total_pages))
+    e_cl = np.clip(ei, 1, max(1, total_pages))
+    for k in np.flatnonzero((s_cl != si) | (e_cl != ei)):
+        i = inside[k]
+        repairs.append({"type": "clamped", "item": nm[i], "from": [int(si[k]), int(ei[k])], "to": [int(s_cl[k]), int(e_cl[k])]})
+    si, ei = s_cl, e_cl
+
+    if inside.size > 1:
+        ti = np.asarray(t, dtype=np.int64)[inside]
+        target = si[1:] - 1 + ti[1:]   # end mong muốn của item trước
+        if lim is not None:
+            # chỉ chặn khi nới end ra (lấp gap); co end lại (overlap) thì luôn được
+            grow = target > ei[:-1]
+            target = np.where(grow, np.minimum(target, np.maximum(lim[inside][:-1], ei[:-1])), target)
+        wrong = ei[:-1] != target
+        if not fill_gaps:
+            wrong &= ei[:-1] > target
+        # chỉ sửa khi kết quả vẫn hợp lệ (end >= start)
+        fixable = wrong & (target >= si[:-1])
+        for k in np.flatnonzero(fixable):
+            repairs.append({"type": "end_to_next_start", "item": nm[inside[k]], "from": int(ei[k]), "to": int(target[k])})
+        ei[:-1] = np.where(fixable, target, ei[:-1])
+    s[inside], e[inside] = si, ei
+
+    return [int(x) for x in s], [int(x) for x in e], nm, repairs
+
+
+# ============================
+# Manifest (list_topic / list_lesson)
+# ============================
+def _extract_entries(raw_list: Any, kind: str, malformed: List[Dict[str, Any]]) -> List[Tuple[str, Dict[str, Any]]]:
+    entries: List[Tuple[str, Dict[str, Any]]] = []
+    if not isinstance(raw_list, list):
+        return entries
+    for pos, item in enumerate(raw_list):
+        if not isinstance(item, dict) or len(item) != 1:
+            malformed.append({"type": "malformed", "kind": kind, "index": pos, "reason": "không phải {name: {...}}"})
+            continue
+        name, rng = next(iter(item.items()))
+        if not isinstance(rng, dict):
+            malformed.append({"type": "malformed", "kind": kind, "index": pos, "item": str(name), "reason": "range không phải dict"})
+            continue
+        s, e = _as_int(rng.get("start")), _as_int(rng.get("end"))
+        if s is None or e is None:
+            malformed.append({"type": "malformed", "kind": kind, "index": pos, "item": str(name), "reason": "start/end không phải số"})
+            continue
+        entries.append((str(name), {**rng, "start": s, "end": e}))
+    return entries
+
+
+def validate_manifest(data: Dict[str, Any], total_pages: int, repair: bool = True) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """
+    Kiểm tra + sửa manifest Gemini trả về TRƯỚC khi cắt PDF.
+    Return (data_fixed, report):
+      report = {"ok": bool, "errors": [...], "warnings": [...], "repairs": [...]}
+      errors   = lỗi còn lại sau khi sửa (không nên cắt): không có lesson, lesson nằm ngoài topic, ...
+      warnings = malformed bị bỏ qua, gap giữa 2 topic (trang mở đầu chủ đề), ...
+    """
+    fixed = copy.deepcopy(data) if isinstance(data, dict) else {}
+    report: Dict[str, Any] = {"total_pages": int(total_pages), "errors": [], "warnings": [], "repairs": []}
+    spans: Dict[str, Tuple[np.ndarray, np.ndarray, List[str]]] = {}
+
+    # range topic thô (clamp vào sách) => mốc chặn khi lấp gap lesson + xét gap giữa 2 topic
+    raw_topics = sorted(
+        (max(1, r["start"]), min(total_pages, r["end"]))
+        for _n, r in _extract_entries(fixed.get("list_topic"), "topic", [])
+        if r["start"] <= total_pages and r["end"] >= 1
+    )
+
+    def _topic_of(page: int) -> int:
+        for k, (t0, t1) in enumerate(raw_topics):
+            if t0 <= page <= t1:
+                return k
+        return -1
+
+    for kind, key in (("lesson", "list_lesson"), ("topic", "list_topic")):
+        malformed: List[Dict[str, Any]] = []
+        entries = _extract_entries(fixed.get(key), kind, malformed)
+        report["warnings"].extend(malformed)
+        if not entries:
+            if kind == "lesson":
+                report["errors"].append({"type": "no_lessons", "kind": kind, "items": []})
+            spans[kind] = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), [])
+            continue
+
+        names = [n for n, _ in entries]
+        starts = [r["start"] for _, r in entries]
+        ends = [r["end"] for _, r in entries]
+
+        # trùng tên => stage sau (state, thư mục lesson) ghi đè lẫn nhau, không tự sửa được
+        seen: Dict[str, int] = {}
+        for n in names:
+            seen[n] = seen.get(n, 0) + 1
+        for n, cnt in seen.items():
+            if cnt > 1:
+                report["errors"].append({"type": "duplicate_name", "kind": kind, "items": [n], "count": cnt})
+
+        if repair:
+            # topic cuối không được ăn sang phụ lục: end <= end của lesson cuối
+            # (chỉ tính lesson đã clamp vào sách; lesson nằm hẳn ngoài sách đã bị báo lỗi)
+            if kind == "topic":
+                ls_, le_, _ = spans["lesson"]
+                in_book = (ls_ <= total_pages) & (le_ >= 1)
+                last_lesson_end = int(min(le_[in_book].max(), total_pages)) if in_book.any() else 0
+                i_last = int(np.argmax(starts))
+                if ends[i_last] > last_lesson_end >= starts[i_last]:
+                    report["repairs"].append({"type": "topic_clamped_to_last_lesson", "kind": kind, "item": names[i_last],
+                                              "from": ends[i_last], "to": last_lesson_end})
+                    ends[i_last] = last_lesson_end
+
+            max_ends = None
+            if kind == "lesson" and raw_topics:
+                max_ends = [raw_topics[k][1] if k >= 0 else total_pages for k in map(_topic_of, starts)]
+            order = _start_order(starts)
+            starts, ends, names, reps = repair_ranges(
+                names, starts, ends, total_pages, fill_gaps=(kind == "lesson"), max_ends=max_ends,
+            )
+            for r in reps:
+                r["kind"] = kind
+            report["repairs"].extend(reps)
+
+            # ghép theo vị trí (không theo tên) để item trùng tên không mất nhau
+            fixed[key] = [
+                {n: {**entries[i][1], "start": s, "end": e}}
+                for i, n, s, e in zip(order, names, starts, ends)
+            ]
+
+        s_arr = np.asarray(starts, dtype=np.int64)
+        e_arr = np.asarray(ends, dtype=np.int64)
+        masks = check_ranges(s_arr, e_arr, total_pages)
+        if kind == "lesson" and raw_topics and s_arr.size > 1:
+            # lesson hở trang ở chỗ sang topic mới = trang mở đầu chủ đề, không thuộc lesson nào
+            cross = np.array([_topic_of(int(e_arr[k])) != _topic_of(int(s_arr[k + 1])) for k in range(s_arr.size - 1)])
+            for k in np.flatnonzero(masks["gap"] & cross):
+                report["warnings"].append({"type": "gap", "kind": kind, "items": [names[k], names[k + 1]], "between_topics": True})
+            masks["gap"] = masks["gap"] & ~cross
+        for iss in _issues_from_masks(names, masks):
+            iss["kind"] = kind
+            # topic được phép có khoảng trống (trang ôn tập/phụ lục giữa các chủ đề)
+            if kind == "topic" and iss["type"] == "gap":
+                report["warnings"].append(iss)
+            else:
+                report["errors"].append(iss)
+        spans[kind] = (s_arr, e_arr, names)
+
+    ls, le, lnames = spans["lesson"]
+    ts, te, _tnames = spans["topic"]
+    if ts.size:
+        for i in np.flatnonzero(check_containment(ls, le, ts, te)):
+            report["errors"].append({"type": "not_contained", "kind": "lesson", "items": [lnames[i]]})
+
+    report["ok"] = not report["errors"]
+    return fixed, report
+
+
+# ============================
+# Chunk list (_compute_chunks_from_start_head)
+# ============================
+def validate_chunk_list(
+    list_chunk: List[Dict[str, Dict[str, Any]]],
+    total_pages: int,
+) -> Dict[str, Any]:
+    """
+    Chunk list phải phủ kín [1, total_pages]: chunk đầu start=1, chunk cuối end=total_pages,
+    liền nhau (content_head => dùng chung 1 trang với chunk trước).
+    """
+    report: Dict[str, Any] = {"total_pages": int(total_pages), "errors": [], "warnings": [], "repairs": []}
+    entries = _extract_entries(list_chunk, "chunk", report["warnings"])
+    if not entries:
+        report["ok"] = not report["warnings"]
+        return report
+
+    names = [n for n, _ in entries]
+    s = np.asarray([r["start"] for _, r in entries], dtype=np.int64)
+    e = np.asarray([r["end"] for _, r in entries], dtype=np.int64)
+    touch = np.asarray([bool(r.get("content_head")) for _, r in entries], dtype=bool)
+
+    report["errors"].extend(_issues_from_masks(names, check_ranges(s, e, total_pages, touch=touch)))
+    if s[0] != 1:
+        report["errors"].append({"type": "not_covering_start", "items": [names[0]]})
+    if e[-1] != total_pages:
+        report["errors"].append({"type": "not_covering_end", "items": [names[-1]]})
+
+    report["ok"] = not report["errors"]
+    return report
+
+
+def repair_start_head(items: List[Tuple[int, bool, str, str]]) -> Tuple[List[Tuple[int, bool, str, str]], List[Dict[str, Any]]]:
+    """
+    Input đã sort theo start (từ _flatten_start_head).
+    2 mục chính cùng trang mà mục sau content_head=False => end của mục trước = start - 1 < start
+    (chunk chồng trang). Mục sau chắc chắn có nội dung mục trước ở phía trên => ép content_head=True.
+    """
+    out: List[Tuple[int, bool, str, str]] = []
+    repairs: List[Dict[str, Any]] = []
+    for s, ch, heading, title in items:
+        if out and s == out[-1][0] and not ch:
+            repairs.append({"type": "content_head_forced", "start": s, "heading": heading})
+            ch = True
+        out.append((s, ch, heading, title))
+    return out, repairs
+
+
+def save_validation_report(base_dir: Path, pdf_stem: str, report: Dict[str, Any]) -> Path:
+    out_path = base_dir / f"{pdf_stem}.validation.json"
+    out_path.write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+    return out_path
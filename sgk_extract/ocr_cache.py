@@ -0,0 +1,112 @@
+# sgk_extract/ocr_cache.py
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import re
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+# Output/<book>/ocr_cache/<key[:2]>/<key>.json : dets đã chuẩn hoá của 1 trang
+CACHE_DIR = "ocr_cache"
+
+# SGK_OCR_CACHE=0 => không đọc/ghi cache (luôn OCR)
+OCR_CACHE_ENABLED = os.getenv("SGK_OCR_CACHE", "1") == "1"
+
+
+_REF_RE = re.compile(rb"(\d+) 0 R\b")
+
+
+def _xref_digest(doc: Any, xref: int, memo: Dict[int, bytes], stack: set) -> bytes:
+    """
+    Digest kiểu Merkle của 1 object: source object (ref đã thay bằng digest của object được trỏ)
+    + raw stream nếu có. Không phụ thuộc số xref => cùng nội dung ở 2 file cho cùng digest.
+    """
+    if xref in memo:
+        return memo[xref]
+    if xref in stack:
+        return b"cycle"
+    stack.add(xref)
+    src = (doc.xref_object(xref, compressed=True) or "").encode("latin-1", "replace")
+    h = hashlib.sha1(_REF_RE.sub(lambda m: _xref_digest(doc, int(m.group(1)), memo, stack).hex().encode("ascii"), src))
+    if doc.xref_is_stream(xref):
+        h.update(doc.xref_stream_raw(xref) or b"")
+    stack.discard(xref)
+    memo[xref] = h.digest()
+    return memo[xref]
+
+
+def page_hash(pdf_path: str | Path, page_index: int = 0) -> str:
+    """
+    Hash nội dung 1 trang: content stream + toàn bộ /Resources (đệ quy: Form XObject, font, ảnh...)
+    + rect / rotation. Không render => rẻ; trang bị thay (sau khi cắt) => hash khác.
+    """
+    import fitz
+
+    h = hashlib.sha1()
+    doc = fitz.open(str(pdf_path))
+    try:
+        page = doc.load_page(page_index)
+        h.update(page.read_contents())
+        h.update(repr((tuple(page.rect), page.rotation)).encode("ascii"))
+        # /Resources có thể thừa kế từ node /Pages cha
+        xref, (kind, val) = page.xref, doc.xref_get_key(page.xref, "Resources")
+        while kind == "null":
+            pkind, pval = doc.xref_get_key(xref, "Parent")
+            if pkind != "xref":
+                break
+            xref = int(pval.split()[0])
+            kind, val = doc.xref_get_key(xref, "Resources")
+        memo: Dict[int, bytes] = {}
+        res = (val if kind != "null" else "").encode("latin-1", "replace")
+        h.update(_REF_RE.sub(lambda m: _xref_digest(doc, int(m.group(1)), memo, set()).hex().encode("ascii"), res))
+    finally:
+        doc.close()
+    return h.hexdigest()
+
+
+def cache_key(page_sha: str, dpi: int, engine: str, params: Dict[str, Any]) -> str:
+    raw = json.dumps(
+        {"page": page_sha, "dpi": int(dpi), "engine": engine, "params": params},
+        ensure_ascii=False, sort_keys=True,
+    ).encode("utf-8")
+    return hashlib.sha1(raw).hexdigest()
+
+
+class OcrCache:
+    """
+    Cache dets OCR trên đĩa (1 file json / trang / DPI / engine / tham số det).
+    Ghi atomic => nhiều process worker ghi cùng lúc vẫn an toàn.
+    """
+
+    def __init__(self, book_dir: str | Path):
+        self.root = Path(book_dir) / CACHE_DIR
+
+    def _path(self, key: str) -> Path:
+        return self.root / key[:2] / f"{key}.json"
+
+    def get(self, key: str) -> Optional[List[Dict[str, Any]]]:
+        p = self._path(key)
+        if not p.exists():
+            return None
+        try:
+            data = json.loads(p.read_text(encoding="utf-8"))
+        except Exception:
+            return None
+        dets = data.get("dets")
+        return dets if isinstance(dets, list) else None
+
+    def get_entry(self, key: str) -> Optional[Dict[str, Any]]:
+        p = self._path(key)
+        try:
+            return json.loads(p.read_text(encoding="utf-8"))
+        except Exception:
+            return None
+
+    def put(self, key: str, dets: List[Dict[str, Any]], info: Optional[Dict[str, Any]] = None) -> None:
+        p = self._path(key)
+        p.parent.mkdir(parents=True, exist_ok=True)
+        tmp = p.with_suffix(f".{os.getpid()}.tmp")
+        tmp.write_text(json.dumps({**(info or {}), "dets": dets}, ensure_ascii=False), encoding="utf-8")
+        os.replace(str(tmp), str(p))
@@ -0,0 +1,317 @@
+# sgk_extract/page_ocr.py
+from __future__ import annotations
+
+import unicodedata
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+# chạy được cả trong package (local) lẫn file rời (Kaggle: sys.path -> sgk_extract/)
+try:
+    from .ocr_cache import page_hash
+    from .render_cache import get_render_cache, render_key
+except ImportError:
+    from ocr_cache import page_hash
+    from render_cache import get_render_cache, render_key
+
+# Render trang + OCR -> dets -> dòng, dùng chung cho postprocess, dò mục lục (toc_detect) và dò mục chính
+# (heading_detect). Không import PaddleOCR / cv2 ở top-level: stage manifest / chunk chỉ tốn khi thật sự OCR.
+
+
+def fold_text(text: str) -> str:
+    """
+    Bỏ dấu + lower: "Mục lục" -> "muc luc", "Đ" -> "d".
+    """
+    t = (text or "").replace("Đ", "D").replace("đ", "d")
+    t = unicodedata.normalize("NFD", t)
+    t = "".join(c for c in t if unicodedata.category(c) != "Mn")
+    return t.lower()
+
+
+# ============================
+# PDF -> image
+# ============================
+def render_page(pdf_path: Path, page_index: int, dpi: int, gray: bool = False) -> np.ndarray:
+    """
+    Render 1 trang -> BGR (H, W, 3) hoặc xám (H, W), qua render cache (.npy mmap, read-only) nếu bật.
+    Key = (file, hash nội dung trang, page_index, dpi, colorspace) => trang bị thay sau khi cắt tự miss.
+    """
+    rc = get_render_cache()
+    key = None
+    if rc is not None:
+        try:
+            key = render_key(
+                page_hash(pdf_path, page_index), page_index, dpi, "gray" if gray else "bgr",
+                source=str(Path(pdf_path).resolve()),
+            )
+        except Exception:
+            key = None
+        if key:
+            arr = rc.get(key)
+            if arr is not None:
+                return arr
+    img = _render_page_array(pdf_path, page_index, dpi, gray)
+    if key:
+        try:
+            rc.put(key, img)
+        except OSError:
+            pass   # hết đĩa / quyền ghi => chỉ mất cache
+    return img
+
+
+def _render_page_array(pdf_path: Path, page_index: int, dpi: int, gray: bool = False) -> np.ndarray:
+    # ưu tiên pypdfium2 (Kaggle-safe), fallback fitz nếu có
+    try:
+        import pypdfium2 as pdfium
+        pdf = pdfium.PdfDocument(str(pdf_path))
+        page = pdf.get_page(page_index)
+        scale = float(dpi) / 72.0
+        # pdfium render sẵn BGR (hoặc L), buffer packed do ctypes cấp
+        # => to_numpy() là view, không qua PIL / cvtColor (array giữ buffer sống sau khi close)
+        bitmap = page.render(scale=scale, grayscale=gray)
+        img = bitmap.to_numpy()
+        page.close()
+        pdf.close()
+        return img
+    except Exception:
+        pass
+
+    # fallback PyMuPDF (local nếu bạn muốn)
+    import fitz
+    doc = fitz.open(str(pdf_path))
+    page = doc.load_page(page_index)
+    zoom = float(dpi) / 72.0
+    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=(fitz.csGRAY if gray else fitz.csRGB), alpha=False)
+    doc.close()
+    if gray:
+        return np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width)
+    img = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
+    return np.ascontiguousarray(img[:, :, ::-1])   # RGB -> BGR
+
+
+def as_bgr(img: np.ndarray) -> np.ndarray:
+    """
+    OCR cần 3 kênh: ảnh xám (RENDER_GRAY) đổi sang BGR ngay trước khi OCR.
+    """
+    return np.repeat(img[:, :, None], 3, axis=2) if img.ndim == 2 else img
+
+
+# ============================
+# OCR
+# ============================
+def build_ocr(lang: str = "vi", cpu_threads: Optional[int] = None, det_no_resize: bool = True) -> Any:
+    """
+    PaddleOCR (import lúc gọi). det_no_resize: det ở kích thước thật (tới 4096px), không thu nhỏ về 960.
+    """
+    from paddleocr import PaddleOCR
+
+    common = dict(
+        lang=lang,
+        use_textline_orientation=False,
+        use_doc_orientation_classify=False,
+        use_doc_unwarping=False,
+    )
+    if cpu_threads:
+        common["cpu_threads"] = int(cpu_threads)
+    if det_no_resize:
+        try:
+            return PaddleOCR(**{**common, "text_det_limit_type": "max", "text_det_limit_side_len": 4096})
+        except Exception:
+            return PaddleOCR(**{**common, "det_limit_type": "max", "det_limit_side_len": 4096})
+    return PaddleOCR(**common)
+
+
+def run_ocr_any(ocr: Any, img_bgr: np.ndarray):
+    # PaddleOCR 2.x / 3.x đều có thể khác nhau; ưu tiên .ocr
+    if hasattr(ocr, "ocr"):
+        return ocr.ocr(img_bgr, cls=False)
+    # fallback nếu gặp bản chỉ có predict
+    return ocr.predict(
+        img_bgr,
+        use_textline_orientation=False,
+        use_doc_orientation_classify=False,
+        use_doc_unwarping=False,
+    )
+
+
+def iter_dets_paddleocr(res: Any) -> List[Dict[str, Any]]:
+    # Parse output từ ocr.ocr(img, cls=False): [ [ [poly, (text, score)], ... ] ]
+    if res is None:
+        return []
+    if not isinstance(res, list):
+        res = [res]
+    out: List[Dict[str, Any]] = []
+    for page in res:
+        if page is None or not isinstance(page, list):
+            continue
+        for det in page:
+            if not (isinstance(det, (list, tuple)) and len(det) >= 2):
+                continue
+            poly = det[0]
+            ts = det[1]
+            if not (isinstance(ts, (list, tuple)) and len(ts) >= 2):
+                continue
+            text = (ts[0] or "").strip()
+            score = float(ts[1]) if ts[1] is not None else 0.0
+            if not text:
+                continue
+            x0, y0, x1, y1 = poly_bbox(poly)
+            out.append({"x0": x0, "y0": y0, "x1": x1, "y1": y1, "text": text, "score": score})
+    return out
+
+
+def poly_bbox(poly: Any) -> Tuple[float, float, float, float]:
+    pts = np.array(poly, dtype=np.float32).reshape(-1, 2)
+    x0, y0 = float(np.min(pts[:, 0])), float(np.min(pts[:, 1]))
+    x1, y1 = float(np.max(pts[:, 0])), float(np.max(pts[:, 1]))
+    return x0, y0, x1, y1
+
+
+def _merge_res_dict(obj: Any) -> Optional[Dict[str, Any]]:
+    if obj is None:
+        return None
+    if isinstance(obj, dict):
+        d = dict(obj)
+    elif hasattr(obj, "to_dict"):
+        try:
+            d = obj.to_dict()
+            if not isinstance(d, dict):
+                return None
+        except Exception:
+            return None
+    elif hasattr(obj, "res"):
+        d = obj.res
+        if not isinstance(d, dict):
+            return None
+    else:
+        return None
+
+    # paddlex/paddleocr sometimes nests "res"
+    cur = d
+    for _ in range(3):
+        inner = cur.get("res")
+        if isinstance(inner, dict):
+            for k, v in inner.items():
+                d.setdefault(k, v)
+            cur = inner
+        else:
+            break
+    return d
+
+
+def _get_any(d: Dict[str, Any], keys: List[str]) -> Any:
+    for k in keys:
+        if k in d and d[k] is not None:
+            return d[k]
+    return None
+
+
+def iter_dets_predict(res: Any) -> List[Dict[str, Any]]:
+    if res is None:
+        return []
+    if not isinstance(res, list):
+        res = [res]
+
+    out: List[Dict[str, Any]] = []
+    for page in res:
+        d = _merge_res_dict(page)
+        if not isinstance(d, dict):
+            continue
+
+        rec_polys = _get_any(d, ["rec_polys", "rec_boxes", "rec_points"])
+        dt_polys  = _get_any(d, ["dt_polys", "dt_boxes", "det_polys"])
+        texts     = _get_any(d, ["rec_texts", "rec_text", "texts"])
+        scores    = _get_any(d, ["rec_scores", "rec_score", "scores"])
+
+        if texts is None or scores is None:
+            continue
+
+        polys = None
+        if rec_polys is not None and len(rec_polys) == len(texts):
+            polys = rec_polys
+        elif dt_polys is not None and len(dt_polys) == len(texts):
+            polys = dt_polys
+        else:
+            continue
+
+        n = min(len(polys), len(texts), len(scores))
+        for poly, text, score in zip(polys[:n], texts[:n], scores[:n]):
+            text = (text or "").strip()
+            if not text:
+                continue
+            x0, y0, x1, y1 = poly_bbox(poly)
+            out.append({"x0": x0, "y0": y0, "x1": x1, "y1": y1, "text": text, "score": float(score)})
+    return out
+
+
+def ocr_image_dets(ocr: Any, img_bgr: np.ndarray, min_score: float = 0.0) -> List[Dict[str, Any]]:
+    """
+    OCR 1 ảnh -> list dets chuẩn hoá {x0,y0,x1,y1,text,score} (đã lọc min_score).
+    """
+    res = run_ocr_any(ocr, as_bgr(img_bgr))
+    # nếu res là kiểu predict cũ thì dùng iter_dets_predict, còn ocr.ocr thì dùng iter_dets_paddleocr
+    if isinstance(res, list) and res and isinstance(res[0], list) and res and (len(res[0]) == 0 or isinstance(res[0][0], (list, tuple))):
+        dets_raw = iter_dets_paddleocr(res)
+    else:
+        dets_raw = iter_dets_predict(res)
+
+    return [d for d in dets_raw if d["score"] >= float(min_score)]
+
+
+# ============================
+# dets -> line
+# ============================
+def group_to_lines(dets: List[Dict[str, Any]], y_tol: float) -> List[Dict[str, Any]]:
+    """
+    Gom dets thành line: duyệt theo y tâm tăng dần, det vào group đầu tiên (thứ tự tạo) có |yc - y_ref| <= y_tol.
+    Chỉ giữ "cửa sổ" group còn nhận được det: y_ref là trung bình các yc đã duyệt (<= yc hiện tại) và chỉ đổi
+    khi group nhận det => group có yc - y_ref > y_tol thì mọi det sau cũng không vào được, bỏ luôn.
+    Kết quả y hệt cách quét mọi group (O(n * số line) -> ~O(n log n)).
+    """
+    n = len(dets)
+    if n == 0:
+        return []
+    y0 = np.fromiter((d["y0"] for d in dets), dtype=np.float64, count=n)
+    y1 = np.fromiter((d["y1"] for d in dets), dtype=np.float64, count=n)
+    x0 = np.fromiter((d["x0"] for d in dets), dtype=np.float64, count=n)
+    ycs = ((y0 + y1) * 0.5).tolist()
+    order = np.lexsort((x0, np.asarray(ycs))).tolist()   # stable như sorted(key=(yc, x0))
+
+    groups: List[Dict[str, Any]] = []
+    active: List[Dict[str, Any]] = []
+    for i in order:
+        d = dets[i]
+        yc = ycs[i]
+        if active and yc - active[0]["y_ref"] > y_tol:
+            active = [g for g in active if not (yc - g["y_ref"] > y_tol)]
+        for g in active:
+            if abs(yc - g["y_ref"]) <= y_tol:
+                g["items"].append(d)
+                g["y_ref"] = (g["y_ref"] * (len(g["items"]) - 1) + yc) / len(g["items"])
+                break
+        else:
+            g = {"y_ref": yc, "items": [d]}
+            groups.append(g)
+            active.append(g)
+
+    lines: List[Dict[str, Any]] = []
+    for g in sorted(groups, key=lambda x: x["y_ref"]):
+        items = sorted(g["items"], key=lambda d: d["x0"])
+        x0 = min(it["x0"] for it in items)
+        x1 = max(it["x1"] for it in items)
+        y0 = min(it["y0"] for it in items)
+        y1 = max(it["y1"] for it in items)
+        text = " ".join(it["text"] for it in items)
+        lines.append({"items": items, "text": text, "x0": x0, "x1": x1, "y0": y0, "y1": y1})
+    return lines
+
+
+def dets_to_lines(dets: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    group_to_lines với y_tol theo chiều cao box trung vị (0.6x, tối thiểu 4px).
+    """
+    if not dets:
+        return []
+    hs = [(d["y1"] - d["y0"]) for d in dets]
+    return group_to_lines(dets, y_tol=max(4.0, float(np.median(hs)) * 0.6))
@@ -0,0 +1,317 @@
+# sgk_extract/pdf_edits.py
+from __future__ import annotations
+
+import os
+import tempfile
+import time
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+# Thay trang PDF bằng ảnh: gom mọi edit của 1 file rồi mở + lưu đúng 1 lần.
+# 0 (mặc định) = ghi lại cả file (garbage=4) => bỏ hẳn ảnh / object của trang cũ, file gọn nhất;
+# 1 = lưu incremental (chỉ append, nhanh hơn) khi PDF cho phép, nhưng trang cũ vẫn nằm trong file
+PDF_SAVE_INCREMENTAL = os.getenv("SGK_PDF_INCREMENTAL", "0") == "1"
+# trần bytes ảnh đang chờ ghi; vượt => caller nên flush sớm
+PDF_EDIT_MAX_MB = int(os.getenv("SGK_PDF_EDIT_MAX_MB", "512"))
+# cắt kiểu clip (cropbox): xoá luôn text layer nằm ngoài vùng giữ lại => keyword không đọc nhầm nội dung chunk kề
+CLIP_DROP_HIDDEN_TEXT = os.getenv("SGK_CLIP_DROP_TEXT", "1") == "1"
+
+
+def _png_wh(data: bytes) -> Optional[Tuple[int, int]]:
+    # IHDR nằm ngay sau chữ ký PNG: width, height (big-endian) ở byte 16..24
+    if len(data) >= 24 and data[:8] == b"\x89PNG\r\n\x1a\n":
+        return int.from_bytes(data[16:20], "big"), int.from_bytes(data[20:24], "big")
+    return None
+
+
+def load_encoded(path: Path) -> Dict[str, Any]:
+    """
+    Ảnh đã có trên đĩa => bytes + kích thước (PNG đọc từ header, định dạng khác mới decode).
+    """
+    data = Path(path).read_bytes()
+    wh = _png_wh(data)
+    if wh is None:
+        img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+        if img is None:
+            raise FileNotFoundError(f"Cannot read image: {path}")
+        wh = (int(img.shape[1]), int(img.shape[0]))
+    return {"stream": data, "w": wh[0], "h": wh[1]}
+
+
+@lru_cache(maxsize=None)
+def pdf_image_supported(ext: str) -> bool:
+    """
+    PyMuPDF đang cài có nhận ảnh định dạng ext qua insert_image(stream=) không (thử 1 lần / process;
+    vd WebP tuỳ bản MuPDF).
+    """
+    import fitz
+
+    ok, buf = cv2.imencode(ext, np.full((8, 8, 3), 255, dtype=np.uint8))
+    if not ok:
+        return False
+    doc = fitz.open()
+    try:
+        doc.new_page().insert_image(fitz.Rect(0, 0, 8, 8), stream=buf.tobytes())
+        return True
+    except Exception:
+        return False
+    finally:
+        doc.close()
+
+
+def rect_fit_on_page(page_rect, img_w: int, img_h: int, align: str = "top"):
+    pw, ph = page_rect.width, page_rect.height
+    s = min(pw / float(img_w), ph / float(img_h))
+    w = img_w * s
+    h = img_h * s
+
+    x0 = (pw - w) / 2.0
+    x1 = x0 + w
+
+    if align == "top":
+        y0, y1 = 0.0, h
+    elif align == "bottom":
+        y1, y0 = ph, ph - h
+    elif align == "center":
+        y0 = (ph - h) / 2.0
+        y1 = y0 + h
+    else:
+        raise ValueError("align phải là 'top' | 'bottom' | 'center'")
+
+    return type(page_rect)(x0, y0, x1, y1)
+
+
+def make_edit(
+    page_index: int, image: "Path | Dict[str, Any]", align: str = "top", crop_to_image: bool = True,
+) -> Dict[str, Any]:
+    """
+    image: {"stream", "w", "h"} (encode trong RAM) hoặc Path tới file ảnh.
+    """
+    if not isinstance(image, dict):
+        if not Path(image).exists():
+            raise FileNotFoundError(f"PNG not found: {image}")
+        image = load_encoded(Path(image))
+    return {"page": int(page_index), "image": image, "align": align, "crop_to_image": crop_to_image}
+
+
+def page_clip_y(pdf_path: Path, page_index: int, y_px: float, img_h: int) -> Optional[float]:
+    """
+    y_px trên ảnh render (cả cropbox, cao img_h px) -> y theo pt trong hệ toạ độ cropbox/mediabox của fitz
+    (scale = chiều cao cropbox / img_h, tức ~72/DPI). None nếu trang bị xoay (caller quay về cắt raster).
+    """
+    import fitz
+
+    doc = fitz.open(str(pdf_path))
+    try:
+        page = doc.load_page(page_index)
+        if page.rotation % 360 != 0:
+            return None
+        cb = page.cropbox
+        return float(cb.y0) + float(y_px) * float(cb.height) / float(img_h)
+    finally:
+        doc.close()
+
+
+def make_clip_edit(page_index: int, y: float, keep: str) -> Dict[str, Any]:
+    """
+    Cắt bằng cropbox, không raster: keep="top" giữ phần trên y, "bottom" giữ phần dưới (y: page_clip_y).
+    Nhiều clip trên cùng 1 trang (cùng 1 lần apply) => giao nhau (chunk 1 trang giữ đúng dải giữa 2 heading).
+    """
+    if keep not in ("top", "bottom"):
+        raise ValueError("keep phải là 'top' | 'bottom'")
+    return {"page": int(page_index), "clip": {"y": float(y), "keep": keep}}
+
+
+def _clip_rect(cb, mb, clip: Dict[str, Any]):
+    import fitz
+
+    y, keep = clip["y"], clip["keep"]
+    new = fitz.Rect(cb.x0, max(cb.y0, y), cb.x1, cb.y1) if keep == "bottom" else fitz.Rect(cb.x0, cb.y0, cb.x1, min(cb.y1, y))
+    if new.height < 1.0:
+        # chunk 1 trang, 2 line cắt chéo nhau => như raster: clip sau thắng (tính lại từ mediabox)
+        print(f"[WARN] clip: vùng giữ lại rỗng => chỉ dùng line cắt sau (y={y:.1f}, keep={keep})")
+        new = fitz.Rect(mb.x0, max(mb.y0, y), mb.x1, mb.y1) if keep == "bottom" else fitz.Rect(mb.x0, mb.y0, mb.x1, min(mb.y1, y))
+        if new.height < 1.0:
+            raise ValueError(f"clip rỗng: y={y:.1f} keep={keep} mediabox={tuple(mb)}")
+    return new
+
+
+def _clip_page(doc, i: int, clips: List[Dict[str, Any]]) -> None:
+    """
+    Gộp mọi clip của trang thành 1 cropbox rồi đặt 1 lần (text ẩn chỉ bị xoá theo vùng cuối cùng).
+    """
+    import fitz
+
+    page = doc[i]
+    cb, mb = page.cropbox, page.mediabox
+    new = cb
+    for c in clips:
+        new = _clip_rect(new, mb, c)
+    if not cb.contains(new):
+        page.set_cropbox(mb)   # fallback ở trên có thể vượt cropbox cũ
+        cb = page.cropbox
+
+    if CLIP_DROP_HIDDEN_TEXT:
+        # toạ độ page (gốc = góc trên cropbox hiện tại); chừa 1pt để không ăn vào dòng heading sát line cắt
+        r = page.rect
+        for hidden in (fitz.Rect(r.x0, r.y0, r.x1, new.y0 - cb.y0 - 1.0), fitz.Rect(r.x0, new.y1 - cb.y0 + 1.0, r.x1, r.y1)):
+            if not hidden.is_empty and page.get_text("words", clip=hidden):
+                page.add_redact_annot(hidden)
+        if page.first_annot is not None:
+            try:
+                page.apply_redactions(images=fitz.PDF_REDACT_IMAGE_NONE, graphics=fitz.PDF_REDACT_LINE_ART_NONE)
+            except (TypeError, AttributeError):   # PyMuPDF cũ: chưa có graphics=
+                page.apply_redactions(images=fitz.PDF_REDACT_IMAGE_NONE)
+    page.set_cropbox(new)
+
+
+def _replace_page(doc, i: int, edit: Dict[str, Any]) -> None:
+    ref_rect = doc[i].rect
+    doc.delete_page(i)
+    p = doc.new_page(pno=i, width=ref_rect.width, height=ref_rect.height)
+    image = edit["image"]
+    img_rect = rect_fit_on_page(p.rect, int(image["w"]), int(image["h"]), align=edit["align"])
+    p.insert_image(img_rect, stream=image["stream"])
+    if edit["crop_to_image"]:
+        p.set_cropbox(img_rect)
+
+
+def apply_pdf_edits(pdf_path: Path, edits: List[Dict[str, Any]], make_backup: bool = False) -> Dict[str, Any]:
+    """
+    Áp mọi edit (make_edit / make_clip_edit) lên 1 PDF: mở 1 lần, lưu 1 lần.
+    2 edit ảnh cùng trang => edit sau thắng (y như thay tuần tự); clip áp lần lượt (giao nhau).
+    Không trộn ảnh + clip trên cùng 1 trang (toạ độ clip là của trang gốc).
+    Return {"pages", "bytes_written", "incremental", "size"}.
+    """
+    try:
+        import fitz
+    except Exception as e:
+        raise RuntimeError("Thiếu PyMuPDF (fitz). Cài: pip install pymupdf") from e
+
+    pdf_path = Path(pdf_path)
+    if not pdf_path.exists():
+        raise FileNotFoundError(f"PDF not found: {pdf_path}")
+
+    size0 = pdf_path.stat().st_size
+    doc = fitz.open(str(pdf_path))
+    try:
+        n = doc.page_count
+        final: Dict[int, Dict[str, Any]] = {}   # trang -> edit ảnh cuối cùng
+        for e in edits:
+            if not (0 <= e["page"] < n):
+                raise ValueError(f"page_index_to_replace không hợp lệ: {e['page']} / n={n}")
+            if "clip" not in e:
+                final[e["page"]] = e
+        clips: Dict[int, List[Dict[str, Any]]] = {}
+        for e in edits:
+            if "clip" in e:
+                clips.setdefault(e["page"], []).append(e["clip"])
+            elif final[e["page"]] is e:
+                _replace_page(doc, e["page"], e)
+        for i, cl in clips.items():
+            _clip_page(doc, i, cl)
+        pages = set(final) | set(clips)
+
+        if make_backup:
+            bak = pdf_path.with_suffix(pdf_path.suffix + ".bak")
+            if not bak.exists():
+                bak.write_bytes(pdf_path.read_bytes())
+
+        incremental = PDF_SAVE_INCREMENTAL and bool(doc.can_save_incrementally())
+        if incremental:
+            doc.save(str(pdf_path), incremental=True, encryption=fitz.PDF_ENCRYPT_KEEP, deflate=True)
+            doc.close()
+        else:
+            tmp_fd, tmp_name = tempfile.mkstemp(suffix=".pdf", dir=str(pdf_path.parent))
+            os.close(tmp_fd)
+            tmp_path = Path(tmp_name)
+            try:
+                doc.save(str(tmp_path), garbage=4, deflate=True)
+                doc.close()
+                os.replace(str(tmp_path), str(pdf_path))
+            finally:
+                if tmp_path.exists():
+                    try:
+                        tmp_path.unlink()
+                    except Exception:
+                        pass
+    finally:
+        if not doc.is_closed:
+            doc.close()
+
+    size = pdf_path.stat().st_size
+    return {
+        "pages": sorted(pages),
+        "bytes_written": int(size - size0 if incremental else size),
+        "incremental": incremental,
+        "size": int(size),
+    }
+
+
+class PdfEditPlan:
+    """
+    Hàng đợi thay trang theo file PDF (giữ thứ tự add). apply() => mỗi file 1 lần open/save.
+    Không thread-safe: mỗi runner (process) giữ 1 plan riêng.
+    """
+
+    def __init__(self):
+        self._edits: Dict[str, List[Dict[str, Any]]] = {}
+        self._bytes = 0
+
+    def __len__(self) -> int:
+        return sum(len(v) for v in self._edits.values())
+
+    def add(
+        self, pdf_path: Path, page_index: int, image: "Path | Dict[str, Any]",
+        align: str = "top", crop_to_image: bool = True,
+    ) -> None:
+        self.add_edit(pdf_path, make_edit(page_index, image, align=align, crop_to_image=crop_to_image))
+
+    def add_edit(self, pdf_path: Path, edit: Dict[str, Any]) -> None:
+        self._edits.setdefault(str(Path(pdf_path).resolve()), []).append(edit)
+        if "image" in edit:
+            self._bytes += len(edit["image"]["stream"])
+
+    def over_limit(self) -> bool:
+        return self._bytes > PDF_EDIT_MAX_MB * 1024 * 1024
+
+    def apply(self, make_backup: bool = False) -> Dict[str, Dict[str, Any]]:
+        """
+        Ghi hết edit đang chờ rồi xoá hàng đợi. Lỗi 1 file không chặn file khác:
+        return {pdf_path(resolve): {"pages", "bytes_written", "incremental", "size", "sec"} | {"error"}}.
+        """
+        edits, self._edits, self._bytes = self._edits, {}, 0
+        results: Dict[str, Dict[str, Any]] = {}
+        for pdf, lst in edits.items():
+            t0 = time.perf_counter()
+            try:
+                res = apply_pdf_edits(Path(pdf), lst, make_backup=make_backup)
+            except Exception as e:
+                res = {"error": repr(e), "pages": [], "bytes_written": 0}
+            res["sec"] = round(time.perf_counter() - t0, 3)
+            results[pdf] = res
+        return results
+
+
+def summarize_edits(results: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Kết quả PdfEditPlan.apply() => {files, failed, pages, incremental, bytes_written, sec}.
+    """
+    out: Dict[str, Any] = {"files": 0, "failed": 0, "pages": 0, "incremental": 0, "bytes_written": 0, "sec": 0.0}
+    for res in results.values():
+        out["files"] += 1
+        out["failed"] += 1 if res.get("error") else 0
+        out["pages"] += len(res.get("pages") or [])
+        out["incremental"] += 1 if res.get("incremental") else 0
+        out["bytes_written"] += int(res.get("bytes_written") or 0)
+        out["sec"] += float(res.get("sec") or 0.0)
+    return out
+
+
+def merge_edit_stats(dst: Dict[str, Any], src: Dict[str, Any]) -> None:
+    for k, v in src.items():
+        dst[k] = dst.get(k, 0) + v
@@ -0,0 +1,320 @@
+# sgk_extract/pdf_meta.py
+from __future__ import annotations
+
+import atexit
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+# Index lưu chung cho mọi stage (giống Output/.gemini_key_index), đổi chỗ bằng SGK_PDF_META_INDEX
+# file này nằm ở: <root>/sgk_extract/pdf_meta.py
+INDEX_FILE = Path(
+    os.getenv("SGK_PDF_META_INDEX")
+    or Path(__file__).resolve().parents[1] / "Output" / ".pdf_meta_index.json"
+)
+SAMPLE_PAGES = 3   # số trang mẫu để đoán has_text_layer / image_only
+LOCK_STALE_SEC = 60.0   # file lock cũ hơn => process giữ lock đã chết, xoá
+
+_lock = threading.Lock()
+_index: Optional[Dict[str, Dict[str, Any]]] = None
+_dirty_keys: Set[str] = set()
+
+
+def _read_disk() -> Dict[str, Dict[str, Any]]:
+    try:
+        data = json.loads(INDEX_FILE.read_text(encoding="utf-8"))
+        return data if isinstance(data, dict) else {}
+    except Exception:
+        return {}
+
+
+def _load_index() -> Dict[str, Dict[str, Any]]:
+    global _index
+    if _index is None:
+        _index = _read_disk()
+    return _index
+
+
+@contextmanager
+def _file_lock(timeout: float = 10.0):
+    """
+    Lock liên process bằng file .lock (O_EXCL) => nhiều process flush cùng lúc không ghi đè nhau.
+    Hết timeout thì vẫn ghi (mất tối đa vài entry cache, không sai dữ liệu).
+    """
+    lock_path = INDEX_FILE.with_suffix(INDEX_FILE.suffix + ".lock")
+    deadline = time.monotonic() + timeout
+    fd = None
+    while fd is None:
+        try:
+            fd = os.open(str(lock_path), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                if time.time() - lock_path.stat().st_mtime > LOCK_STALE_SEC:
+                    lock_path.unlink()
+                    continue
+            except FileNotFoundError:
+                continue
+            if time.monotonic() > deadline:
+                break
+            time.sleep(0.05)
+    try:
+        yield
+    finally:
+        if fd is not None:
+            os.close(fd)
+            try:
+                lock_path.unlink()
+            except FileNotFoundError:
+                pass
+
+
+def _is_fresh(path: str, entry: Any) -> bool:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return False
+    return isinstance(entry, dict) and entry.get("size") == st.st_size and entry.get("mtime_ns") == st.st_mtime_ns
+
+
+def flush_index() -> None:
+    """
+    Ghi index xuống đĩa (gọi tự động lúc thoát process).
+    Đọc lại file dưới file lock, chỉ đè các entry process này đã đổi (process khác ghi gì vẫn giữ),
+    bỏ entry của file đã xoá / đã đổi (size, mtime).
+    """
+    global _index
+    with _lock:
+        if not _dirty_keys or _index is None:
+            return
+        INDEX_FILE.parent.mkdir(parents=True, exist_ok=True)
+        with _file_lock():
+            merged = _read_disk()
+            for k in _dirty_keys:
+                if k in _index:
+                    merged[k] = _index[k]
+            merged = {k: v for k, v in merged.items() if _is_fresh(k, v)}
+            tmp = INDEX_FILE.with_suffix(INDEX_FILE.suffix + f".{os.getpid()}.tmp")
+            tmp.write_text(json.dumps(merged, ensure_ascii=False), encoding="utf-8")
+            os.replace(str(tmp), str(INDEX_FILE))
+        _index = merged
+        _dirty_keys.clear()
+
+
+atexit.register(flush_index)
+
+
+def _file_key(pdf_path: str | Path) -> tuple[str, int, int]:
+    p = Path(pdf_path).resolve()
+    st = p.stat()
+    return str(p), int(st.st_size), int(st.st_mtime_ns)
+
+
+def _entry(path: str, size: int, mtime: int) -> Optional[Dict[str, Any]]:
+    # gọi trong _lock
+    hit = _load_index().get(path)
+    if hit and hit.get("size") == size and hit.get("mtime_ns") == mtime:
+        return hit
+    return None
+
+
+def _update(path: str, size: int, mtime: int, **fields: Any) -> None:
+    """
+    Gộp field vào entry hiện có (cùng size + mtime), khác => entry mới.
+    """
+    with _lock:
+        cur = _entry(path, size, mtime) or {"size": size, "mtime_ns": mtime}
+        cur.update(fields)
+        _load_index()[path] = cur
+        _dirty_keys.add(path)
+
+
+def _sample_indices(n: int) -> List[int]:
+    if n <= SAMPLE_PAGES:
+        return list(range(n))
+    return sorted({0, n // 2, n - 1})
+
+
+# ============================
+# Probe (pypdfium2, fallback pypdf)
+# ============================
+def _count_pages(pdf_path: str) -> int:
+    try:
+        import pypdfium2 as pdfium
+
+        pdf = pdfium.PdfDocument(pdf_path)
+        try:
+            return len(pdf)
+        finally:
+            pdf.close()
+    except ImportError:
+        from pypdf import PdfReader
+
+        return len(PdfReader(pdf_path).pages)
+
+
+def _text_flags_pdfium(pdf: Any, indices: Iterable[int]) -> Dict[str, bool]:
+    out: Dict[str, bool] = {}
+    for i in indices:
+        page = pdf.get_page(i)
+        try:
+            tp = page.get_textpage()
+            out[str(i)] = tp.count_chars() > 0
+            tp.close()
+        finally:
+            page.close()
+    return out
+
+
+def _text_flags_pypdf(reader: Any, indices: Iterable[int]) -> Dict[str, bool]:
+    out: Dict[str, bool] = {}
+    for i in indices:
+        try:
+            out[str(i)] = bool((reader.pages[i].extract_text() or "").strip())
+        except Exception:
+            out[str(i)] = False
+    return out
+
+
+def _probe_pdfium(pdf_path: str) -> Dict[str, Any]:
+    import pypdfium2 as pdfium
+    import pypdfium2.raw as pdfium_c
+
+    pdf = pdfium.PdfDocument(pdf_path)
+    try:
+        n = len(pdf)
+        sizes = [list(pdf.get_page_size(i)) for i in range(n)]
+        sample = _sample_indices(n)
+        text_flags = _text_flags_pdfium(pdf, sample)
+        image_only = n > 0
+        for i in sample:
+            page = pdf.get_page(i)
+            try:
+                types = [obj.type for obj in page.get_objects(max_depth=1)]
+                if not types or any(t != pdfium_c.FPDF_PAGEOBJ_IMAGE for t in types):
+                    image_only = False
+            finally:
+                page.close()
+    finally:
+        pdf.close()
+    return {
+        "page_count": n,
+        "page_sizes": sizes,
+        "has_text_layer": any(text_flags.values()),
+        "text_pages": text_flags,
+        "image_only": image_only,
+    }
+
+
+def _probe_pypdf(pdf_path: str) -> Dict[str, Any]:
+    from pypdf import PdfReader
+
+    reader = PdfReader(pdf_path)
+    n = len(reader.pages)
+    sizes = [[float(pg.mediabox.width), float(pg.mediabox.height)] for pg in reader.pages]
+    sample = _sample_indices(n)
+    text_flags = _text_flags_pypdf(reader, sample)
+    image_only = n > 0
+    for i in sample:
+        pg = reader.pages[i]
+        res = pg.get("/Resources") or {}
+        res = res.get_object() if hasattr(res, "get_object") else res
+        xobjs = res.get("/XObject") if isinstance(res, dict) else None
+        xobjs = xobjs.get_object() if hasattr(xobjs, "get_object") else xobjs
+        subtypes = [x.get_object().get("/Subtype") for x in (xobjs or {}).values()]
+        if "/Font" in res or not subtypes or any(st != "/Image" for st in subtypes):
+            image_only = False
+    return {
+        "page_count": n,
+        "page_sizes": sizes,
+        "has_text_layer": any(text_flags.values()),
+        "text_pages": text_flags,
+        "image_only": image_only,
+    }
+
+
+# ============================
+# API
+# ============================
+def get_pdf_meta(pdf_path: str | Path) -> Dict[str, Any]:
+    """
+    Meta của PDF, cache theo (path, size, mtime):
+      {"page_count", "page_sizes": [[w,h] pt], "has_text_layer", "image_only"}
+    has_text_layer / image_only đoán từ SAMPLE_PAGES trang; cần biết đúng trang nào có chữ => pages_with_text.
+    Ưu tiên pypdfium2 (nhanh), fallback pypdf.
+    """
+    path, size, mtime = _file_key(pdf_path)
+    with _lock:
+        hit = _entry(path, size, mtime)
+        if hit and "page_sizes" in hit:
+            return dict(hit)
+
+    try:
+        meta = _probe_pdfium(path)
+    except Exception:
+        meta = _probe_pypdf(path)
+
+    with _lock:
+        old = _entry(path, size, mtime) or {}
+    flags = old.get("text_pages") if isinstance(old.get("text_pages"), dict) else {}
+    meta["text_pages"] = {**flags, **meta["text_pages"]}
+    _update(path, size, mtime, **meta)
+    return {**meta, "size": size, "mtime_ns": mtime}
+
+
+def pages_with_text(pdf_path: str | Path, indices: Iterable[int]) -> Set[int]:
+    """
+    Trang nào (trong indices, 0-based) có text layer. Chỉ đọc các trang chưa có trong cache.
+    """
+    path, size, mtime = _file_key(pdf_path)
+    want = sorted(set(int(i) for i in indices))
+    with _lock:
+        hit = _entry(path, size, mtime) or {}
+        flags = dict(hit.get("text_pages")) if isinstance(hit.get("text_pages"), dict) else {}
+    missing = [i for i in want if str(i) not in flags]
+
+    if missing:
+        try:
+            import pypdfium2 as pdfium
+
+            pdf = pdfium.PdfDocument(path)
+            try:
+                n = len(pdf)
+                flags.update(_text_flags_pdfium(pdf, [i for i in missing if i < n]))
+            finally:
+                pdf.close()
+        except ImportError:
+            from pypdf import PdfReader
+
+            reader = PdfReader(path)
+            n = len(reader.pages)
+            flags.update(_text_flags_pypdf(reader, [i for i in missing if i < n]))
+        _update(path, size, mtime, text_pages=flags)
+
+    return {i for i in want if flags.get(str(i))}
+
+
+def get_page_count(pdf_path: str | Path) -> int:
+    """
+    Chỉ cần số trang: dùng cache kể cả entry "một phần" (do record_page_count ghi);
+    miss => chỉ đếm trang (không probe text / kích thước).
+    """
+    path, size, mtime = _file_key(pdf_path)
+    with _lock:
+        hit = _entry(path, size, mtime)
+        if hit and "page_count" in hit:
+            return int(hit["page_count"])
+    n = _count_pages(path)
+    _update(path, size, mtime, page_count=n)
+    return n
+
+
+def record_page_count(pdf_path: str | Path, page_count: int) -> None:
+    """
+    Stage vừa ghi PDF thì biết luôn số trang => ghi vào index, stage sau khỏi parse lại.
+    """
+    path, size, mtime = _file_key(pdf_path)
+    _update(path, size, mtime, page_count=int(page_count))
@@ -3,10 +3,18 @@ from __future__ import annotations
 
 import json
 import re
+import shutil
 from pathlib import Path
 from typing import Any, Dict, Iterable, List, Tuple, Optional
 from pypdf import PdfReader, PdfWriter
 
+from .chunk_index import open_chunk_index
+from .pdf_meta import get_page_count, record_page_count
+from .split_state import (
+    drop_dirty, get_item, item_hash, lesson_stem_of, load_split_state, mark_dirty,
+    orphan_keys, save_split_state, source_signature,
+)
+
 def _num_from_heading(heading: str) -> str:
     """
     "Bài 1." / "Chủ đề 2." / "1." / "1" -> "1"
@@ -128,7 +136,12 @@ def split_pdf_item_to_folder(
     parent_dir: Path,
     pdf_stem: str,
     kind: str,  # "topic" | "lesson"
+    lazy: bool = False,
 ) -> Optional[Path]:
+    """
+    lazy=True: chỉ ghi meta json, PDF để materialize_item_pdf() tạo khi thật sự cần
+    (vd: upload lesson lên Gemini). Return đường dẫn PDF (có thể chưa tồn tại).
+    """
     name = str(item["name"])
     start = int(item["start"])
     end = int(item["end"])
@@ -137,16 +150,23 @@ def split_pdf_item_to_folder(
     folder = parent_dir / safe_folder
     folder.mkdir(parents=True, exist_ok=True)
 
-    paths = split_pdf_by_ranges(
-        src_pdf=src_pdf,
-        ranges=[(name, start, end)],
-        out_dir=folder,
-        pdf_stem=pdf_stem,
-    )
-    if not paths:
-        return None
+    if lazy:
+        if start < 1 or start > end or start > get_page_count(src_pdf):
+            return None
+        pdf_path = folder / f"{pdf_stem}_{safe_folder}.pdf"
+        if pdf_path.exists():
+            pdf_path.unlink()   # PDF cũ (range cũ) không còn đúng
+    else:
+        paths = split_pdf_by_ranges(
+            src_pdf=src_pdf,
+            ranges=[(name, start, end)],
+            out_dir=folder,
+            pdf_stem=pdf_stem,
+        )
+        if not paths:
+            return None
+        pdf_path = paths[0]
 
-    pdf_path = paths[0]
     meta_path = pdf_path.with_suffix(".json")
 
     meta: Dict[str, Any] = {
@@ -156,6 +176,7 @@ def split_pdf_item_to_folder(
         "end": end,
         "source_pdf": str(Path(src_pdf).resolve()),
         "pdf": str(pdf_path.resolve()),
+        "lazy": lazy,
     }
 
     # ✅ “ghi đè/chuẩn hoá” theo schema bạn muốn
@@ -173,19 +194,86 @@ def split_pdf_item_to_folder(
     meta_path.write_text(json.dumps(meta, ensure_ascii=False, indent=2), encoding="utf-8")
     return pdf_path
 
+
+def _adopt_existing_item(
+    src_pdf: str,
+    item: Dict[str, Any],
+    parent_dir: Path,
+    pdf_stem: str,
+) -> Optional[Dict[str, Any]]:
+    """
+    Chưa có split_state (output cắt từ bản cũ): item đã có PDF/meta khớp range + tên + PDF gốc
+    => nhận luôn làm "đã cắt", không cắt lại và không đánh dirty (giữ nguyên Chunk/ của lesson).
+    Return entry cho split_state hoặc None.
+    """
+    safe_folder = str(item["name"]).replace("/", "_").replace("\\", "_").strip()
+    pdf_path = parent_dir / safe_folder / f"{pdf_stem}_{safe_folder}.pdf"
+    meta = load_item_meta(pdf_path)
+    if not meta:
+        return None
+    same = (
+        meta.get("name") == str(item["name"])
+        and meta.get("start") == item["start"]
+        and meta.get("end") == item["end"]
+        and meta.get("raw_heading", "") == item.get("heading", "")
+        and meta.get("raw_title", "") == item.get("title", "")
+        and meta.get("source_pdf") == str(Path(src_pdf).resolve())
+    )
+    lazy = bool(meta.get("lazy"))
+    if not same or not (pdf_path.exists() or lazy):
+        return None
+    return {"pdf": str(pdf_path), "lazy": lazy}
+
+
+def load_item_meta(pdf_path: str | Path) -> Dict[str, Any]:
+    """
+    Meta json nằm cạnh PDF topic/lesson (<stem>_lesson_01.json). {} nếu không có.
+    """
+    try:
+        data = json.loads(Path(pdf_path).with_suffix(".json").read_text(encoding="utf-8"))
+        return data if isinstance(data, dict) else {}
+    except Exception:
+        return {}
+
+
+def materialize_item_pdf(pdf_path: str | Path, reader: Optional[PdfReader] = None) -> Path:
+    """
+    PDF lesson/topic được cắt lazy => cắt từ PDF gốc theo meta (start/end) lúc cần.
+    Đã có file thì trả luôn. reader: reader của PDF gốc (dùng chung).
+    """
+    pdf_path = Path(pdf_path)
+    if pdf_path.exists():
+        return pdf_path
+
+    meta = load_item_meta(pdf_path)
+    src = meta.get("source_pdf")
+    if not src or not Path(src).exists():
+        raise FileNotFoundError(f"Không có PDF và không tìm thấy PDF gốc để cắt: {pdf_path}")
+
+    start, end = int(meta["start"]), int(meta["end"])
+    stem = pdf_path.stem[: -len(pdf_path.parent.name) - 1]   # <book>_lesson_01 -> <book>
+    paths = split_pdf_by_ranges(str(src), [(pdf_path.parent.name, start, end)], pdf_path.parent, stem, reader=reader)
+    if not paths:
+        raise RuntimeError(f"Range không hợp lệ trong meta: {pdf_path.with_suffix('.json')}")
+
+    meta["lazy"] = False
+    pdf_path.with_suffix(".json").write_text(json.dumps(meta, ensure_ascii=False, indent=2), encoding="utf-8")
+    return paths[0]
+
 def split_pdf_by_ranges(
     src_pdf: str,
     ranges: Iterable[Tuple[str, int, int]],
     out_dir: Path,
     pdf_stem: str,
+    reader: Optional[PdfReader] = None,
 ) -> List[Path]:
     """
     - start/end là PDF pages 1-based, inclusive.
     - Xuất file: <pdf_stem>_<name>.pdf vào out_dir
       Ví dụ: test1_topic_01.pdf
+    - reader: truyền vào để dùng lại khi gọi nhiều lần trên cùng src_pdf
     """
-    reader = PdfReader(src_pdf)
-    total_pages = len(reader.pages)
+    total_pages = len(reader.pages) if reader is not None else get_page_count(src_pdf)
 
     outputs: List[Path] = []
 
@@ -198,6 +286,9 @@ def split_pdf_by_ranges(
 
         end = min(end, total_pages)
 
+        if reader is None:
+            reader = PdfReader(src_pdf)   # chỉ parse khi có range hợp lệ
+
         writer = PdfWriter()
         for idx in range(start - 1, end):  # end inclusive
             writer.add_page(reader.pages[idx])
@@ -207,32 +298,101 @@ def split_pdf_by_ranges(
 
         with open(out_path, "wb") as f:
             writer.write(f)
+        record_page_count(out_path, end - start + 1)
 
         outputs.append(out_path)
 
     return outputs
 
-def split_from_manifest(src_pdf: str, data: Dict[str, Any], base_dir: Path) -> Dict[str, List[str]]:
+def split_from_manifest(
+    src_pdf: str,
+    data: Dict[str, Any],
+    base_dir: Path,
+    force: bool = False,
+    lazy_lessons: bool = False,
+) -> Dict[str, List[str]]:
+    """
+    Cắt topic/lesson theo manifest, INCREMENTAL:
+    - so hash từng item với lần cắt trước (<pdf_stem>.split_state.json)
+    - chỉ cắt lại item mới/đổi range; xoá item không còn trong manifest
+    - lesson đổi/mới/xoá => ghi vào dirty_lessons.json cho chunk/postprocess/keywords
+    - chưa có split_state (output của bản cũ) => item có meta khớp được nhận luôn, không cắt lại
+    force=True => cắt lại tất cả.
+    lazy_lessons=True => không ghi PDF lesson (chỉ meta); chunk stage cắt thẳng từ PDF gốc,
+    PDF lesson chỉ được tạo khi cần upload (materialize_item_pdf).
+    """
     pdf_stem = Path(src_pdf).stem
     topic_dir = base_dir / "Topic"
     lesson_dir = base_dir / "Lesson"
     topic_dir.mkdir(parents=True, exist_ok=True)
     lesson_dir.mkdir(parents=True, exist_ok=True)
 
-    result = {"topics": [], "lessons": []}
+    result = {"topics": [], "lessons": [], "unchanged": [], "removed": [], "failed": [], "dirty_lessons": []}
 
-    if isinstance(data.get("list_topic"), list):
-        items = _flatten_list_items(data["list_topic"], kind="topic")
-        for it in items:
-            p = split_pdf_item_to_folder(src_pdf, it, topic_dir, pdf_stem, kind="topic")
-            if p:
-                result["topics"].append(str(p))
+    old_state = load_split_state(base_dir, pdf_stem)
+    sig = source_signature(src_pdf, prev=old_state.get("source"))
+    bootstrap = bool(old_state.get("missing")) and not force
+    new_state: Dict[str, Any] = {"source": sig, "items": {}}
+    dirty: List[str] = []
+    removed_lessons: List[str] = []
+    manifest_keys: set = set()
 
-    if isinstance(data.get("list_lesson"), list):
-        items = _flatten_list_items(data["list_lesson"], kind="lesson")
+    for kind, key, parent in (("topic", "list_topic", topic_dir), ("lesson", "list_lesson", lesson_dir)):
+        if not isinstance(data.get(key), list):
+            continue
+        items = _flatten_list_items(data[key], kind=kind)
         for it in items:
-            p = split_pdf_item_to_folder(src_pdf, it, lesson_dir, pdf_stem, kind="lesson")
+            state_key = f"{kind}/{it['name']}"
+            manifest_keys.add(state_key)
+            h = item_hash(kind, it, sig)
+            prev = get_item(old_state, state_key)
+
+            prev_pdf = Path(str((prev or {}).get("pdf", "")))
+            prev_ok = prev_pdf.exists() or bool((prev or {}).get("lazy")) and prev_pdf.with_suffix(".json").exists()
+            if (not force) and prev and prev.get("hash") == h and prev_ok:
+                new_state["items"][state_key] = prev
+                result[f"{kind}s"].append(str(prev["pdf"]))
+                result["unchanged"].append(state_key)
+                continue
+
+            adopted = _adopt_existing_item(src_pdf, it, parent, pdf_stem) if bootstrap else None
+            if adopted:
+                new_state["items"][state_key] = {"hash": h, **adopted}
+                result[f"{kind}s"].append(adopted["pdf"])
+                result["unchanged"].append(state_key)
+                continue
+
+            lazy = lazy_lessons and kind == "lesson"
+            p = split_pdf_item_to_folder(src_pdf, it, parent, pdf_stem, kind=kind, lazy=lazy)
             if p:
-                result["lessons"].append(str(p))
-
-    return result
\ No newline at end of file
+                new_state["items"][state_key] = {"hash": h, "pdf": str(p), "lazy": lazy}
+                result[f"{kind}s"].append(str(p))
+                if kind == "lesson":
+                    dirty.append(lesson_stem_of(pdf_stem, str(it["name"])))
+            else:
+                # cắt lại lỗi => giữ output cũ (hash cũ => lần sau thử lại), không coi là bị xoá
+                if prev:
+                    new_state["items"][state_key] = prev
+                result["failed"].append(state_key)
+
+    # item không còn trong manifest => xoá folder (+ chunk của lesson đó)
+    for state_key in orphan_keys(old_state["items"], manifest_keys):
+        kind, name = state_key.split("/", 1)
+        safe_folder = name.replace("/", "_").replace("\\", "_").strip()
+        shutil.rmtree((topic_dir if kind == "topic" else lesson_dir) / safe_folder, ignore_errors=True)
+        if kind == "lesson":
+            stem = lesson_stem_of(pdf_stem, name)
+            shutil.rmtree(base_dir / "Chunk" / stem, ignore_errors=True)
+            open_chunk_index(base_dir).delete_lesson(stem)
+            removed_lessons.append(stem)
+        result["removed"].append(state_key)
+
+    if result["failed"]:
+        print(f"[Split][WARN] không cắt được {len(result['failed'])} item, giữ output cũ: {result['failed']}")
+
+    drop_dirty(base_dir, removed_lessons)
+    mark_dirty(base_dir, dirty)
+    result["dirty_lessons"] = dirty
+    save_split_state(base_dir, pdf_stem, new_state)
+
+    return result
@@ -0,0 +1,99 @@
+# sgk_extract/render_cache.py
+from __future__ import annotations
+
+import hashlib
+import os
+import threading
+from pathlib import Path
+from typing import Dict, Optional
+
+import numpy as np
+
+# Ảnh trang đã render, lưu .npy thô => lần sau np.load(mmap_mode="r"), không decode gì.
+# SGK_RENDER_CACHE_MB=0 => tắt
+RENDER_CACHE_DIR = os.getenv("SGK_RENDER_CACHE_DIR", str(Path("Output") / "_render_cache"))
+RENDER_CACHE_MB = int(os.getenv("SGK_RENDER_CACHE_MB", "4096"))   # trần dung lượng, vượt => xoá file ít dùng nhất
+
+_lock = threading.Lock()
+_caches: Dict[str, "RenderCache"] = {}
+
+
+def render_key(page_sha: str, page_index: int, dpi: int, colorspace: str, source: str = "") -> str:
+    """
+    source: định danh file (đường dẫn tuyệt đối) => 2 file khác nhau không bao giờ dùng chung ảnh,
+    kể cả khi hash nội dung trang sót thứ gì đó.
+    """
+    raw = f"{source}|{page_sha}|{int(page_index)}|{int(dpi)}|{colorspace}".encode("utf-8")
+    return hashlib.sha1(raw).hexdigest()
+
+
+class RenderCache:
+    """
+    LRU theo mtime: get() chạm mtime, put() vượt trần thì xoá file mtime cũ nhất.
+    Nhiều process dùng chung folder được (ghi tmp + os.replace; file bị xoá giữa chừng => miss).
+    """
+
+    def __init__(self, root: str | Path, max_mb: int):
+        self.root = Path(root)
+        self.max_bytes = int(max_mb) * 1024 * 1024
+        self._total: Optional[int] = None   # tính lần đầu khi put, sau đó cộng dồn
+
+    def _path(self, key: str) -> Path:
+        return self.root / key[:2] / f"{key}.npy"
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        p = self._path(key)
+        try:
+            arr = np.load(str(p), mmap_mode="r")
+            os.utime(str(p), None)
+            return arr
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+
+    def put(self, key: str, arr: np.ndarray) -> None:
+        p = self._path(key)
+        p.parent.mkdir(parents=True, exist_ok=True)
+        tmp = p.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp, "wb") as f:
+            np.save(f, np.ascontiguousarray(arr))
+        os.replace(str(tmp), str(p))
+        with _lock:
+            if self._total is None:
+                self._total = sum(f.stat().st_size for f in self.root.glob("*/*.npy"))
+            else:
+                self._total += p.stat().st_size
+            if self._total > self.max_bytes:
+                self._evict()
+
+    def _evict(self) -> None:
+        files = []
+        for f in self.root.glob("*/*.npy"):
+            try:
+                st = f.stat()
+            except FileNotFoundError:
+                continue
+            files.append((st.st_mtime, st.st_size, f))
+        files.sort()
+        total = sum(sz for _mt, sz, _f in files)
+        target = int(self.max_bytes * 0.9)   # xoá dư 10% => không evict mỗi lần put
+        for _mt, sz, f in files:
+            if total <= target:
+                break
+            try:
+                f.unlink()
+                total -= sz
+            except OSError:   # đã bị xoá / Windows: file đang được mmap
+                pass
+        self._total = total
+
+
+def get_render_cache() -> Optional[RenderCache]:
+    if RENDER_CACHE_MB <= 0:
+        return None
+    root = str(Path(RENDER_CACHE_DIR).resolve())
+    with _lock:
+        rc = _caches.get(root)
+        if rc is None:
+            rc = RenderCache(root, RENDER_CACHE_MB)
+            _caches[root] = rc
+        return rc
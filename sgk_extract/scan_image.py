@@ -0,0 +1,132 @@
+# sgk_extract/scan_image.py
+from __future__ import annotations
+
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import cv2
+import numpy as np
+
+# Trang scan: cả trang chỉ là 1 ảnh JPEG (DCTDecode) phủ kín, không xoay / lật.
+# Lấy thẳng stream JPEG trong PDF (không render lại), decode ở độ phân giải gốc để OCR,
+# line cắt (px trên ảnh gốc) tỉ lệ thẳng với toạ độ trang => cắt trên ảnh gốc, ghi lại JPEG cùng quality.
+
+SCAN_COVER_TOL = 0.01   # bbox ảnh lệch page.rect tối đa 1% mỗi cạnh
+
+# bảng lượng tử luminance chuẩn IJG (quality 50); chỉ cần tổng nên thứ tự zigzag không quan trọng
+_STD_LUMA_Q = (
+    16, 11, 10, 16, 24, 40, 51, 61,
+    12, 12, 14, 19, 26, 58, 60, 55,
+    14, 13, 16, 24, 40, 57, 69, 56,
+    14, 17, 22, 29, 51, 87, 80, 62,
+    18, 22, 37, 56, 68, 109, 103, 77,
+    24, 35, 55, 64, 81, 104, 113, 92,
+    49, 64, 78, 87, 103, 121, 120, 101,
+    72, 92, 95, 98, 112, 100, 103, 99,
+)
+
+
+def _luma_qtable(data: bytes) -> Optional[List[int]]:
+    # duyệt marker tới SOS, lấy bảng DQT id 0 (luminance)
+    if data[:2] != b"\xff\xd8":
+        return None
+    i = 2
+    while i + 4 <= len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:   # byte đệm
+            i += 1
+            continue
+        if marker in (0x01, 0xD8) or 0xD0 <= marker <= 0xD7:
+            i += 2
+            continue
+        if marker == 0xDA:
+            return None
+        seg_len = int.from_bytes(data[i + 2:i + 4], "big")
+        if marker == 0xDB:
+            j, end = i + 4, min(len(data), i + 2 + seg_len)
+            while j < end:
+                pq, tq = data[j] >> 4, data[j] & 0x0F
+                j += 1
+                if pq:
+                    vals = [int.from_bytes(data[j + 2 * k:j + 2 * k + 2], "big") for k in range(64)]
+                    j += 128
+                else:
+                    vals = list(data[j:j + 64])
+                    j += 64
+                if tq == 0 and len(vals) == 64:
+                    return vals
+        i += 2 + seg_len
+    return None
+
+
+def jpeg_quality(data: bytes) -> Optional[int]:
+    """
+    Ước lượng quality (1..100, thang IJG / libjpeg) từ bảng lượng tử luminance.
+    None nếu không đọc được DQT.
+    """
+    q = _luma_qtable(data)
+    if not q:
+        return None
+    scale = 100.0 * sum(q) / float(sum(_STD_LUMA_Q))
+    quality = (200.0 - scale) / 2.0 if scale <= 100.0 else 5000.0 / scale
+    return int(max(1, min(100, round(quality))))
+
+
+def embedded_jpeg(pdf_path: Path, page_index: int = 0) -> Optional[Dict[str, Any]]:
+    """
+    Trang scan => {"stream": bytes JPEG gốc, "w", "h", "dpi", "quality", "gray"}; trang khác => None.
+    Điều kiện: đúng 1 ảnh, DCTDecode, không mask, xám / RGB, phủ kín trang, không xoay / lật.
+    """
+    import fitz
+
+    doc = fitz.open(str(pdf_path))
+    try:
+        page = doc.load_page(page_index)
+        if page.rotation % 360 != 0:
+            return None
+        imgs = page.get_images(full=True)
+        if len(imgs) != 1:
+            return None
+        xref, smask, filt = imgs[0][0], imgs[0][1], imgs[0][8]
+        if smask or filt != "DCTDecode":
+            return None
+        infos = page.get_image_info(xrefs=True)
+        if len(infos) != 1 or infos[0].get("has-mask"):
+            return None   # ảnh vẽ nhiều lần / có mask
+        info = infos[0]
+        if int(info.get("colorspace") or 0) not in (1, 3):
+            return None   # CMYK: decode dễ ngược màu
+        a, b, c, d = info["transform"][:4]
+        if abs(b) > 1e-3 or abs(c) > 1e-3 or a <= 0 or d <= 0:
+            return None
+        r, bbox = page.rect, fitz.Rect(info["bbox"])
+        tx, ty = SCAN_COVER_TOL * r.width, SCAN_COVER_TOL * r.height
+        if (abs(bbox.x0 - r.x0) > tx or abs(bbox.x1 - r.x1) > tx
+                or abs(bbox.y0 - r.y0) > ty or abs(bbox.y1 - r.y1) > ty):
+            return None
+
+        data = doc.xref_stream_raw(xref)
+        w, h = int(info["width"]), int(info["height"])
+        return {
+            "stream": data,
+            "w": w,
+            "h": h,
+            "dpi": 72.0 * h / float(r.height),
+            "quality": jpeg_quality(data),
+            "gray": int(info.get("colorspace") or 0) == 1,
+        }
+    finally:
+        doc.close()
+
+
+def decode_jpeg(data: bytes, gray: bool = False) -> np.ndarray:
+    """
+    JPEG -> (H, W, 3) BGR, hoặc (H, W) nếu gray / ảnh gốc xám. Không xoay theo EXIF (PDF không dùng).
+    """
+    flag = cv2.IMREAD_GRAYSCALE if gray else (cv2.IMREAD_UNCHANGED | cv2.IMREAD_IGNORE_ORIENTATION)
+    img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flag)
+    if img is None:
+        raise RuntimeError("cv2.imdecode failed: embedded JPEG")
+    return img
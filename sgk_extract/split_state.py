@@ -0,0 +1,171 @@
+# sgk_extract/split_state.py
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional
+
+# Stage downstream bị ảnh hưởng khi 1 lesson đổi range
+STAGES = ("chunk", "postprocess", "keywords")
+DIRTY_FILE = "dirty_lessons.json"
+
+_lock = threading.Lock()
+
+
+def _read(path: Path) -> Dict[str, Any]:
+    try:
+        data = json.loads(path.read_text(encoding="utf-8"))
+        return data if isinstance(data, dict) else {}
+    except Exception:
+        return {}
+
+
+def _write_atomic(path: Path, data: Dict[str, Any]) -> None:
+    tmp = path.with_suffix(path.suffix + ".tmp")
+    tmp.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+    os.replace(str(tmp), str(path))
+
+
+# ============================
+# Split state: hash từng item của manifest lần cắt trước
+# ============================
+def _file_sha1(path: Path) -> str:
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def source_signature(src_pdf: str | Path, prev: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    Chữ ký PDF gốc: sha1 nội dung (copy / touch file không làm đổi).
+    prev: chữ ký lần trước; size + mtime y hệt thì dùng lại sha1, khỏi đọc lại cả file.
+    """
+    p = Path(src_pdf).resolve()
+    st = p.stat()
+    sig = {"path": str(p), "size": int(st.st_size), "mtime_ns": int(st.st_mtime_ns)}
+    if prev and prev.get("sha1") and prev.get("size") == sig["size"] and prev.get("mtime_ns") == sig["mtime_ns"]:
+        sig["sha1"] = prev["sha1"]
+    else:
+        sig["sha1"] = _file_sha1(p)
+    return sig
+
+
+def item_hash(kind: str, item: Dict[str, Any], source_sig: Dict[str, Any]) -> str:
+    """
+    Hash nội dung 1 topic/lesson đã chuẩn hoá (range + tên) + sha1 PDF gốc.
+    Nội dung PDF gốc đổi => mọi item đổi; chỉ đổi mtime thì không.
+    """
+    payload = {
+        "kind": kind,
+        "name": item.get("name"),
+        "start": item.get("start"),
+        "end": item.get("end"),
+        "num": item.get("num"),
+        "display_name": item.get("display_name"),
+        "heading": item.get("heading"),
+        "source_sha1": source_sig.get("sha1"),
+    }
+    raw = json.dumps(payload, ensure_ascii=False, sort_keys=True).encode("utf-8")
+    return hashlib.sha1(raw).hexdigest()
+
+
+def split_state_path(base_dir: Path, pdf_stem: str) -> Path:
+    return base_dir / f"{pdf_stem}.split_state.json"
+
+
+def load_split_state(base_dir: Path, pdf_stem: str) -> Dict[str, Any]:
+    """
+    {"source": {...}, "items": {...}}; chưa có file => {"items": {}, "missing": True}.
+    """
+    path = split_state_path(base_dir, pdf_stem)
+    data = _read(path)
+    if not isinstance(data.get("items"), dict):
+        data["items"] = {}
+    if not path.exists():
+        data["missing"] = True
+    return data
+
+
+def save_split_state(base_dir: Path, pdf_stem: str, state: Dict[str, Any]) -> Path:
+    out = split_state_path(base_dir, pdf_stem)
+    _write_atomic(out, state)
+    return out
+
+
+# ============================
+# Dirty lessons: stage nào cần chạy lại cho lesson nào
+#   Output/<book>/dirty_lessons.json
+#   {"<book>_lesson_03": ["chunk", "postprocess", "keywords"], ...}
+# ============================
+def load_dirty(book_dir: str | Path) -> Dict[str, List[str]]:
+    data = _read(Path(book_dir) / DIRTY_FILE)
+    return {k: list(v) for k, v in data.items() if isinstance(v, list)}
+
+
+def mark_dirty(book_dir: str | Path, lesson_stems: Iterable[str], stages: Iterable[str] = STAGES) -> None:
+    stems = list(lesson_stems)
+    if not stems:
+        return
+    with _lock:
+        path = Path(book_dir) / DIRTY_FILE
+        data = load_dirty(book_dir)
+        for st in stems:
+            cur = set(data.get(st, []))
+            cur.update(stages)
+            data[st] = [s for s in STAGES if s in cur]
+        _write_atomic(path, data)
+
+
+def drop_dirty(book_dir: str | Path, lesson_stems: Iterable[str]) -> None:
+    """
+    Lesson đã bị xoá khỏi manifest => không còn stage nào phải chạy cho nó.
+    """
+    stems = set(lesson_stems)
+    path = Path(book_dir) / DIRTY_FILE
+    if not stems or not path.exists():
+        return
+    with _lock:
+        data = load_dirty(book_dir)
+        if stems & set(data):
+            _write_atomic(path, {k: v for k, v in data.items() if k not in stems})
+
+
+def is_dirty(dirty: Dict[str, List[str]], lesson_stem: str, stage: str) -> bool:
+    return stage in dirty.get(lesson_stem, [])
+
+
+def clear_dirty(book_dir: str | Path, lesson_stem: str, stage: str) -> None:
+    with _lock:
+        path = Path(book_dir) / DIRTY_FILE
+        if not path.exists():
+            return
+        data = load_dirty(book_dir)
+        stages = [s for s in data.get(lesson_stem, []) if s != stage]
+        if stages:
+            data[lesson_stem] = stages
+        else:
+            data.pop(lesson_stem, None)
+        _write_atomic(path, data)
+
+
+def lesson_stem_of(pdf_stem: str, item_name: str) -> str:
+    """
+    Tên file lesson pdf (không đuôi) = stem mà chunk stage dùng: <book>_lesson_01
+    """
+    safe = item_name.replace("/", "_").replace("\\", "_").strip()
+    return f"{pdf_stem}_{safe}"
+
+
+def orphan_keys(old_items: Dict[str, Any], new_keys: Iterable[str]) -> List[str]:
+    keep = set(new_keys)
+    return [k for k in old_items if k not in keep]
+
+
+def get_item(state: Dict[str, Any], key: str) -> Optional[Dict[str, Any]]:
+    it = state.get("items", {}).get(key)
+    return it if isinstance(it, dict) else None
@@ -0,0 +1,197 @@
+# sgk_extract/state_db.py
+from __future__ import annotations
+
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+# Output/<book>/pipeline_state.sqlite  (đi kèm book dir => Kaggle pack/zip mang theo luôn)
+DB_NAME = "pipeline_state.sqlite"
+
+# scope: "book" (key=book_stem) | "lesson" (key=<book>_lesson_XX) | "chunk" (key=<book>_lesson_XX_chunk_YY)
+# status: "done" | "failed" | "skipped"
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS stage_state (
+    scope      TEXT NOT NULL,
+    key        TEXT NOT NULL,
+    stage      TEXT NOT NULL,
+    status     TEXT NOT NULL,
+    input_hash TEXT,
+    outputs    TEXT,
+    sec        REAL,
+    error      TEXT,
+    updated_at TEXT NOT NULL,
+    PRIMARY KEY (scope, key, stage)
+);
+CREATE INDEX IF NOT EXISTS idx_stage_status ON stage_state (scope, stage, status);
+"""
+
+_open_lock = threading.Lock()
+_dbs: Dict[str, "StateDB"] = {}
+
+
+class StateDB:
+    """
+    Journal trạng thái từng stage cho 1 book (book / lesson / chunk).
+    1 connection dùng chung nhiều thread (có lock), mỗi lần ghi là 1 transaction.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        # journal mặc định (DELETE): không để lại file -wal khi zip/pack book dir
+        self._conn = sqlite3.connect(str(path), check_same_thread=False, timeout=30.0)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._conn:
+            self._conn.executescript(_SCHEMA)
+
+    # ---------- read ----------
+    def get(self, scope: str, key: str, stage: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT * FROM stage_state WHERE scope=? AND key=? AND stage=?", (scope, key, stage)
+            ).fetchone()
+        if row is None:
+            return None
+        out = dict(row)
+        out["outputs"] = json.loads(out["outputs"]) if out["outputs"] else []
+        return out
+
+    def is_done(self, scope: str, key: str, stage: str, input_hash: Optional[str] = None) -> bool:
+        row = self.get(scope, key, stage)
+        if row is None or row["status"] != "done":
+            return False
+        return input_hash is None or row["input_hash"] == input_hash
+
+    def keys_with_status(self, scope: str, stage: str, status: str = "done") -> Set[str]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT key FROM stage_state WHERE scope=? AND stage=? AND status=?", (scope, stage, status)
+            ).fetchall()
+        return {r[0] for r in rows}
+
+    def pending(self, scope: str, stage: str, keys: Iterable[str]) -> List[str]:
+        """
+        keys chưa "done" ở stage này (giữ thứ tự).
+        """
+        done = self.keys_with_status(scope, stage, "done")
+        return [k for k in keys if k not in done]
+
+    def summary(self) -> Dict[str, Dict[str, Dict[str, int]]]:
+        """
+        {scope: {stage: {status: count}}} - trả lời "còn lại bao nhiêu" không cần quét Output.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT scope, stage, status, COUNT(*) FROM stage_state GROUP BY scope, stage, status"
+            ).fetchall()
+        out: Dict[str, Dict[str, Dict[str, int]]] = {}
+        for scope, stage, status, n in rows:
+            out.setdefault(scope, {}).setdefault(stage, {})[status] = int(n)
+        return out
+
+    # ---------- write ----------
+    def record(
+        self,
+        scope: str,
+        key: str,
+        stage: str,
+        status: str,
+        *,
+        input_hash: Optional[str] = None,
+        outputs: Optional[List[str]] = None,
+        sec: Optional[float] = None,
+        error: Optional[str] = None,
+    ) -> None:
+        self.record_many([{
+            "scope": scope, "key": key, "stage": stage, "status": status,
+            "input_hash": input_hash, "outputs": outputs, "sec": sec, "error": error,
+        }])
+
+    def record_many(self, rows: List[Dict[str, Any]]) -> None:
+        if not rows:
+            return
+        now = time.strftime("%Y-%m-%d %H:%M:%S")
+        params = [
+            (
+                r["scope"], r["key"], r["stage"], r["status"], r.get("input_hash"),
+                json.dumps(r.get("outputs") or [], ensure_ascii=False),
+                (round(float(r["sec"]), 3) if r.get("sec") is not None else None),
+                r.get("error"), now,
+            )
+            for r in rows
+        ]
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO stage_state "
+                "(scope, key, stage, status, input_hash, outputs, sec, error, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                params,
+            )
+
+    def invalidate(self, scope: str, keys: Iterable[str], stages: Optional[Iterable[str]] = None) -> None:
+        keys = list(keys)
+        if not keys:
+            return
+        st = list(stages) if stages is not None else None
+        with self._lock, self._conn:
+            for k in keys:
+                if st is None:
+                    self._conn.execute("DELETE FROM stage_state WHERE scope=? AND key=?", (scope, k))
+                else:
+                    self._conn.executemany(
+                        "DELETE FROM stage_state WHERE scope=? AND key=? AND stage=?", [(scope, k, s) for s in st]
+                    )
+
+    def invalidate_lesson(self, lesson_stem: str, stages: Optional[Iterable[str]] = None) -> None:
+        """
+        Lesson bị chunk lại => xoá state của lesson + mọi chunk của nó.
+        """
+        st = list(stages) if stages is not None else None
+        like = lesson_stem.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "\\_chunk\\_%"
+        with self._lock, self._conn:
+            if st is None:
+                self._conn.execute("DELETE FROM stage_state WHERE scope='lesson' AND key=?", (lesson_stem,))
+                self._conn.execute("DELETE FROM stage_state WHERE scope='chunk' AND key LIKE ? ESCAPE '\\'", (like,))
+            else:
+                for s in st:
+                    self._conn.execute(
+                        "DELETE FROM stage_state WHERE scope='lesson' AND key=? AND stage=?", (lesson_stem, s)
+                    )
+                    self._conn.execute(
+                        "DELETE FROM stage_state WHERE scope='chunk' AND key LIKE ? ESCAPE '\\' AND stage=?", (like, s)
+                    )
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+def open_state_db(book_dir: str | Path) -> StateDB:
+    """
+    1 StateDB / book dir / process (dùng chung giữa các thread).
+    """
+    path = (Path(book_dir) / DB_NAME).resolve()
+    with _open_lock:
+        db = _dbs.get(str(path))
+        if db is None:
+            db = StateDB(path)
+            _dbs[str(path)] = db
+        return db
+
+
+def close_state_db(book_dir: str | Path) -> None:
+    """
+    Đóng + bỏ cache trước khi book dir bị thay cả folder (vd: apply zip từ Kaggle),
+    lần open sau sẽ đọc file mới.
+    """
+    path = (Path(book_dir) / DB_NAME).resolve()
+    with _open_lock:
+        db = _dbs.pop(str(path), None)
+    if db is not None:
+        db.close()
@@ -0,0 +1,183 @@
+# sgk_extract/toc_detect.py
+from __future__ import annotations
+
+import os
+import re
+import tempfile
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from pypdf import PdfReader, PdfWriter
+
+from .page_ocr import fold_text
+from .pdf_meta import get_page_count, pages_with_text
+
+
+# ============================
+# CONFIG
+# ============================
+TOC_SCAN_HEAD = 30            # quét bao nhiêu trang đầu sách
+TOC_SCAN_TAIL = 15            # quét bao nhiêu trang cuối sách (mục lục nằm cuối)
+TOC_MIN_SCORE = 3.0           # điểm tối thiểu để coi là trang mục lục
+TOC_NEIGHBOR_SCORE = 1.5      # trang kế bên (mục lục nhiều trang) chỉ cần điểm này
+TOC_MAX_PAGES = 6             # tối đa số trang mục lục gửi lên Gemini
+TOC_MIN_TEXT_CHARS = 200      # ít hơn => coi như không có text layer => OCR
+TOC_OCR_DPI = 72              # OCR DPI thấp, chỉ cần đọc số trang + "Mục lục"
+FOOTER_SAMPLE_AT = 0.5        # trang mẫu chân trang: vị trí tương đối trong sách
+
+_LINE_END_NUM = re.compile(r"(?:\.{2,}|…|\s)\s*(\d{1,3})\s*$")
+_ITEM_LINE = re.compile(r"^\s*(?:bai|chu de)\s+\d+")
+
+
+def score_toc_text(text: str) -> float:
+    """
+    Chấm điểm 1 trang có giống MỤC LỤC không:
+    - có chữ "Mục lục"                      (+3)
+    - tỉ lệ dòng kết thúc bằng số trang      (+4 * ratio, nhân độ tăng dần của số)
+    - số dòng "Bài <n>" / "Chủ đề <n>"       (+2 * min(1, k/8))
+    - trang quá ít dòng thì không tin        (x0.5)
+    """
+    lines = [ln.strip() for ln in (text or "").splitlines() if ln.strip()]
+    if not lines:
+        return 0.0
+
+    has_kw = "muc luc" in fold_text(text)
+
+    nums: List[int] = []
+    for ln in lines:
+        m = _LINE_END_NUM.search(ln)
+        if m:
+            nums.append(int(m.group(1)))
+    ratio = len(nums) / len(lines)
+
+    # số trang trong mục lục tăng dần => tăng độ tin cậy
+    if len(nums) >= 2:
+        inc = sum(1 for a, b in zip(nums, nums[1:]) if b >= a) / (len(nums) - 1)
+    else:
+        inc = 0.0
+
+    items = sum(1 for ln in lines if _ITEM_LINE.match(fold_text(ln)))
+
+    score = (3.0 if has_kw else 0.0) + 4.0 * ratio * inc + 2.0 * min(1.0, items / 8.0)
+    if len(lines) < 5:
+        score *= 0.5
+    return score
+
+
+def _candidate_indices(n_total: int) -> List[int]:
+    head = list(range(min(TOC_SCAN_HEAD, n_total)))
+    tail = list(range(max(len(head), n_total - TOC_SCAN_TAIL), n_total))
+    return head + tail
+
+
+def _page_texts_from_layer(reader: PdfReader, indices: List[int]) -> Dict[int, str]:
+    out: Dict[int, str] = {}
+    for i in indices:
+        try:
+            out[i] = reader.pages[i].extract_text() or ""
+        except Exception:
+            out[i] = ""
+    return out
+
+
+def _page_texts_from_ocr(src_pdf: str, indices: List[int], dpi: int = TOC_OCR_DPI) -> Optional[Dict[int, str]]:
+    """
+    OCR DPI thấp cho sách scan (không có text layer).
+    Return None nếu máy không có pypdfium2/paddleocr hoặc render/OCR lỗi (caller bỏ qua mục lục).
+    """
+    from .page_ocr import build_ocr, dets_to_lines, ocr_image_dets, render_page
+
+    out: Dict[int, str] = {}
+    try:
+        ocr = build_ocr()
+        for i in indices:
+            dets = ocr_image_dets(ocr, render_page(Path(src_pdf), i, dpi))
+            out[i] = "\n".join(ln["text"] for ln in dets_to_lines(dets))
+    except Exception:
+        return None
+    return out
+
+
+def detect_toc_pages(src_pdf: str, reader: Optional[PdfReader] = None) -> Optional[Dict[str, Any]]:
+    """
+    Tìm trang MỤC LỤC (đầu hoặc cuối sách) bằng text layer, fallback OCR DPI thấp.
+    Return:
+      {"toc_pages": [0-based...], "footer_page": 0-based, "scores": {idx: score}, "source": "text"|"ocr"}
+    hoặc None nếu không tìm thấy trang nào đủ điểm.
+    """
+    n_total = get_page_count(src_pdf)
+    if n_total < 1:
+        return None
+
+    indices = _candidate_indices(n_total)
+    texts: Dict[int, str] = {}
+    source = "text"
+    text_pages = pages_with_text(src_pdf, indices)
+    layer_indices = [i for i in indices if i in text_pages]
+    if layer_indices:
+        texts = _page_texts_from_layer(reader or PdfReader(src_pdf), layer_indices)
+
+    if sum(len(t.strip()) for t in texts.values()) < TOC_MIN_TEXT_CHARS:
+        ocr_texts = _page_texts_from_ocr(src_pdf, indices)
+        if ocr_texts is None:
+            return None
+        texts = ocr_texts
+        source = "ocr"
+
+    scores = {i: score_toc_text(t) for i, t in texts.items()}
+    best = max(scores, key=lambda i: scores[i])
+    if scores[best] < TOC_MIN_SCORE:
+        return None
+
+    # mở rộng sang trang kề (mục lục 2-3 trang, trang sau không có chữ "Mục lục")
+    pages = [best]
+    lo = hi = best
+    while len(pages) < TOC_MAX_PAGES:
+        grew = False
+        if (hi + 1) in scores and scores[hi + 1] >= TOC_NEIGHBOR_SCORE:
+            hi += 1
+            pages.append(hi)
+            grew = True
+        if len(pages) < TOC_MAX_PAGES and (lo - 1) in scores and scores[lo - 1] >= TOC_NEIGHBOR_SCORE:
+            lo -= 1
+            pages.append(lo)
+            grew = True
+        if not grew:
+            break
+    pages.sort()
+
+    # trang mẫu chân trang để Gemini tính offset (printed -> pdf)
+    footer = int(n_total * FOOTER_SAMPLE_AT)
+    footer = max(0, min(footer, n_total - 1))
+    if footer in pages:
+        footer = min(n_total - 1, pages[-1] + 1)
+
+    return {"toc_pages": pages, "footer_page": footer, "scores": scores, "source": source}
+
+
+def make_toc_preview(src_pdf: str, reader: Optional[PdfReader] = None) -> Optional[Tuple[str, List[int]]]:
+    """
+    Tạo PDF tạm chỉ gồm các trang mục lục + 1 trang mẫu chân trang.
+    Return (tmp_path, page_map) với page_map[i] = số trang PDF gốc (1-based) của trang preview i+1.
+    None => caller fallback về preview 20 trang đầu.
+    """
+    reader = reader or PdfReader(src_pdf)
+    found = detect_toc_pages(src_pdf, reader=reader)
+    if not found:
+        return None
+
+    order = list(found["toc_pages"])
+    if found["footer_page"] not in order:
+        order.append(found["footer_page"])
+
+    writer = PdfWriter()
+    for i in order:
+        writer.add_page(reader.pages[i])
+
+    fd, tmp_path = tempfile.mkstemp(suffix=f"_toc_{len(order)}p.pdf")
+    os.close(fd)
+    with open(tmp_path, "wb") as f:
+        writer.write(f)
+
+    print(f"[TOC] source={found['source']} toc_pages={[i + 1 for i in found['toc_pages']]} footer={found['footer_page'] + 1}")
+    return tmp_path, [i + 1 for i in order]
@@ -0,0 +1,22 @@
+# tests/test_layout_equiv.py
+"""
+Layout engine (group_to_lines cửa sổ + find_heading_left_for_line bisect) phải cho kết quả
+y hệt bản quét cũ trên dets trang thật.
+
+tests/fixtures/layout_dets.json: 9 trang PDF thật (1-2 cột, mục lục có số mục tách rời, code đánh số dòng),
+box từng đoạn chữ quy về pixel ở 260 DPI giống dets OCR. Chạy: python -m pytest -q
+"""
+from scripts.check_layout_equiv import compare_pages, fixture_pages
+
+
+def test_fixture_is_not_empty():
+    pages = fixture_pages()
+    assert len(pages) >= 5
+    assert all(len(dets) >= 20 for dets in pages)
+
+
+def test_layout_matches_reference_on_real_pages():
+    res = compare_pages(fixture_pages())
+    assert res["bad"] == 0
+    assert res["lines"] > 0
+    assert res["heading_hits"] > 0   # fixture phải chạm tới nhánh tìm số mục bên trái
@@ -0,0 +1,18 @@
+# tests/test_match_equiv.py
+"""
+Lõi match heading_match.py phải cho kết quả y hệt bản cũ (bản rút gọn của scripts/check_match_equiv,
+ít case hơn, không benchmark). Chạy: python -m pytest -q
+"""
+import random
+
+from scripts.check_match_equiv import compare, initials_pairs, line_texts
+
+CASES = 2000
+
+
+def test_heading_match_matches_reference():
+    rng = random.Random(1610)
+    pairs = list(initials_pairs(rng, CASES))
+    texts = line_texts(rng, CASES // 4)
+    assert len(texts) > CASES // 4   # có cả text dòng từ fixture trang thật
+    assert compare(pairs, texts) == 0